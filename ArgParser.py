@@ -52,7 +52,7 @@ Command-line Arguments:
                                   (training) Convert and train with binary files.
     --use-dataloader-workers     (training) Use dataloader workers.
     --max-dataloader-workers MAX_DATALOADER_WORKERS
-                                  (training) Number of dataloader workers, default 3.
+                                  (training) Number of dataloader workers, default 3, or auto.
     --loss-fn LOSS_FN            (training) Loss function, default "CrossEntropyLoss".
     --gradcam-cnn-model-layer GRADCAM_CNN_MODEL_LAYER [GRADCAM_CNN_MODEL_LAYER ...]
                                   (training) Model layers for gradcam plots, default ['model_a.4.0', 'model_b.4.0'].
@@ -382,10 +382,11 @@ def get_args():
 
     parser.add_argument(
         "--max-dataloader-workers",
-        type=int,
-        default=3,
+        type=str,
+        default="3",
         required=False,
-        help="(training) The number of dataloader workers, default=3",
+        help="(training) The number of dataloader workers, default=3, or auto to measure the fastest "
+        "number for the node. Passed on to make_validation_training.py, which checks it.",
     )
 
     parser.add_argument(
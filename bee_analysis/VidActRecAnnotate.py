@@ -369,7 +369,8 @@ class VideoAnnotator:
                     np_frame = numpy.frombuffer(in_bytes, numpy.uint8)
                 in_frame = torch.tensor(data=np_frame, dtype=torch.uint8,
                     ).reshape([1, in_height, in_width, self.channels])
-                in_frame = in_frame.permute(0, 3, 1, 2).to(dtype=torch.float).cuda()
+                # Frames stay uint8 until they are on the GPU, which is a quarter of the bytes to copy
+                in_frame = in_frame.permute(0, 3, 1, 2).cuda()
                 sample_frames.append(in_frame)
 
 
@@ -391,6 +392,7 @@ class VideoAnnotator:
                     # Concatenate along the channel dimension since the first dimension will be
                     # treated as the batch size.
                     image_input = torch.cat(sample_frames, 1)
+                image_input = image_input.to(dtype=torch.float)
 
                 # Get the label for this frame. Multiframe inputs have the label of the newest frame.
                 label = self.video_labels.getLabel(frame)
@@ -409,7 +411,7 @@ class VideoAnnotator:
                     out = nn_postprocess(out)
 
                 # Reconvert to an image for the output video stream
-                display_frame = sample_frames[-1][0]
+                display_frame = sample_frames[-1][0].to(dtype=torch.float)
                 # Convert to a color image is necessary
                 if 3 != self.channels:
                     display_frame = display_frame.repeat(3, 1, 1)
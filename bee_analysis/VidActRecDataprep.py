@@ -24,6 +24,7 @@ import webdataset as wds
 # Helper function to convert to images
 from torchvision import transforms
 
+from utility.flatbin_dataset import summarizeValues, writeSidecar
 from utility.video_utility import (getVideoInfo, VideoSampler, vidSamplingCommonCrop)
 
 
@@ -128,6 +129,9 @@ args = parser.parse_args()
 
 # Create a writer for the WebDataset
 datawriter = wds.TarWriter(args.outpath, encoder=False)
+# Labels and image shape of the written samples, for the dataset summary sidecar
+written_labels = []
+image_shape = None
 
 with open(args.datalist, newline='') as datacsv:
     conf_reader = csv.reader(datacsv)
@@ -225,5 +229,9 @@ with open(args.datalist, newline='') as datacsv:
                         sample[f"{i}.png"] = buffers[i].getbuffer()
 
                 datawriter.write(sample)
+                written_labels.append(int(row[class_col]))
+                image_shape = tuple(frame.shape[1:])
 
 datawriter.close()
+# Training reads the sample count, image size, and class statistics from this instead of the dataset
+writeSidecar(args.outpath, summarizeValues(len(written_labels), image_shape, {"cls": written_labels}))
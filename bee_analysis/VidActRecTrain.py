@@ -30,7 +30,16 @@ import torch.cuda.amp
 import webdataset as wds
 from torchvision import transforms
 
+import utility.augment_utility as augment_utility
+import utility.checkpoint_utility as checkpoint_utility
+import utility.cache_utility as cache_utility
+import utility.cpu_utility as cpu_utility
+import utility.dataloader_utility as dataloader_utility
 import utility.dataset_utility as dataset_utility
+import utility.distributed_utility as distributed_utility
+import utility.multifold_utility as multifold_utility
+import utility.prefetch_utility as prefetch_utility
+import utility.profile_utility as profile_utility
 import utility.train_utility as train_utility
 from create_gradcam import run_gradcam
 from models.alexnet import AlexLikeNet
@@ -47,7 +56,6 @@ from models.resnext import ResNext18
 from models.resnext import ResNext34
 from models.resnext import ResNext50
 from utility.eval_utility import ConfusionMatrix
-from utility.eval_utility import OnlineStatistics
 from utility.eval_utility import RegressionResults
 from utility.eval_utility import WorstExamples
 from utility.model_utility import restoreModelAndState
@@ -97,6 +105,43 @@ parser.add_argument("--resume_from",
                     required=False,
                     help="Model weights to restore.")
 
+parser.add_argument(
+    "--auto_resume",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Continue training from the newest checkpoint of an earlier run with the same --outname "
+    "that can be loaded, such as after a job was preempted. Starts from scratch if there is none.",
+)
+
+parser.add_argument(
+    "--keep_checkpoints",
+    required=False,
+    default=1,
+    type=int,
+    help="Number of epoch checkpoints (<outname>_epoch<i>) to keep. The newest checkpoint is always "
+    "<outname> and the one with the lowest evaluation (or training) loss is <outname>_best.",
+)
+
+parser.add_argument(
+    "--sync_checkpoints",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Write checkpoints before continuing training instead of on a background thread.",
+)
+
+parser.add_argument(
+    "--checkpoint_batches",
+    required=False,
+    default=None,
+    type=int,
+    help="Also save a checkpoint (<outname>_progress) every N training batches, with the number of "
+    "samples read so far, so that --auto_resume continues part way through an epoch. Rounded up to "
+    "a multiple of --num_workers. Needs an iterable flatbin dataset and cannot be used with "
+    "--distributed or --folds.",
+)
+
 parser.add_argument("--epochs",
                     type=int,
                     required=False,
@@ -119,6 +164,44 @@ parser.add_argument(
     help="Normalize inputs: input = (input - mean) / stddev.",
 )
 
+parser.add_argument(
+    "--augment_shift",
+    required=False,
+    type=int,
+    default=0,
+    help="Shift each training sample by up to this many pixels in each dimension, repeating the edge "
+    "pixels, like the crop_noise of sampling but drawn anew every epoch.",
+)
+
+parser.add_argument(
+    "--augment_flip",
+    required=False,
+    type=float,
+    nargs=2,
+    default=[0.0, 0.0],
+    metavar=("HORIZONTAL", "VERTICAL"),
+    help="Probabilities of flipping a training sample left to right and top to bottom.",
+)
+
+parser.add_argument(
+    "--augment_jitter",
+    required=False,
+    type=float,
+    nargs=2,
+    default=[0.0, 0.0],
+    metavar=("BRIGHTNESS", "CONTRAST"),
+    help="Largest random change of the brightness (added to pixels from 0 to 1) and of the relative "
+    "contrast of each training sample. --normalize removes most of this change.",
+)
+
+parser.add_argument(
+    "--augment_frame_dropout",
+    required=False,
+    type=float,
+    default=0.0,
+    help="Probability of replacing each frame of a training sample, except the first, with the frame before it.",
+)
+
 parser.add_argument(
     "--normalize_outputs",
     required=False,
@@ -127,6 +210,15 @@ parser.add_argument(
     help="Normalize the outputs. (For regression loss only)",
 )
 
+parser.add_argument(
+    "--label_stats_batch_size",
+    required=False,
+    default=1024,
+    type=int,
+    help="Batch size when reading the labels to compute their statistics for --normalize_outputs. "
+    "Only webdatasets without summary sidecars need this pass.",
+)
+
 parser.add_argument(
     "--modeltype",
     type=str,
@@ -180,7 +272,8 @@ parser.add_argument(
     required=False,
     default=None,
     help=
-    "Save N images for class with lowest prediction score (with --evaluate).",
+    "Save N images for class with lowest prediction score (with --evaluate). With --flatbin_map_style "
+    "only the sample indices are kept during the epoch and the images are read again when saved.",
 )
 
 parser.add_argument(
@@ -264,8 +357,184 @@ parser.add_argument(
     "--num_workers",
     required=False,
     default=0,
+    type=dataloader_utility.workerCount,
+    help="Number of workers to use during dataloading, or auto to measure a few worker counts and "
+    "prefetch depths on the training data and use the fastest. The choice is cached for each host "
+    "and dataset format in ~/.cache/bee_analysis (or $BEE_LOADER_CACHE).",
+)
+
+parser.add_argument(
+    "--batch_size",
+    required=False,
+    default=None,
+    type=int,
+    help="Number of samples in each training batch. Defaults to --sample_frames.",
+)
+
+parser.add_argument(
+    "--auto_batch_size",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Use the largest batch size that fits into the memory of the training device (or into "
+    "the RAM when training on the cpu), up to --max_batch_size.",
+)
+
+parser.add_argument(
+    "--max_batch_size",
+    required=False,
+    default=512,
+    type=int,
+    help="Largest batch size considered by --auto_batch_size.",
+)
+
+parser.add_argument(
+    "--lr_scaling",
+    required=False,
+    default="none",
+    choices=["none", "linear", "sqrt"],
+    type=str,
+    help="Scale the learning rate with the batch size (linear) or its square root (sqrt), "
+    "relative to --lr_reference_batch_size.",
+)
+
+parser.add_argument(
+    "--lr_reference_batch_size",
+    required=False,
+    default=None,
+    type=int,
+    help="Batch size that the model learning rates were tuned with. Defaults to --sample_frames.",
+)
+
+parser.add_argument(
+    "--distributed",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Train with one process per device using DistributedDataParallel. Launch the processes with "
+    "torchrun (e.g. torchrun --standalone --nproc_per_node 4 VidActRecTrain.py --distributed ...) or "
+    "srun. Uses nccl with GPUs and gloo on the cpu.",
+)
+
+parser.add_argument(
+    "--folds",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Treat each dataset as a cross validation fold and train one model per fold in this process. "
+    "Model i trains on every dataset but dataset i, is evaluated on dataset i, and is saved to "
+    "<outname>_fold<i>. The models share a single pass through the data each epoch.",
+)
+
+parser.add_argument(
+    "--device",
+    required=False,
+    default=None,
+    choices=["cuda", "cpu"],
+    help="Device to train on. Defaults to cuda when it is available.",
+)
+
+parser.add_argument(
+    "--cpu_optimize",
+    required=False,
+    default=False,
+    action="store_true",
+    help="When running on the cpu, use bfloat16 autocast if the processor supports it natively and "
+    "fold BatchNorm layers into convolutions for evaluation (same as --bf16 --fuse_eval).",
+)
+
+parser.add_argument(
+    "--bf16",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Train and evaluate with bfloat16 autocast. Skipped with a warning on devices without native "
+    "bfloat16 support, where it would be slower than float32.",
+)
+
+parser.add_argument(
+    "--channels_last",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Store the model in the channels last memory format, which oneDNN and tensor core "
+    "convolutions prefer. Check the speed with benchmarks/cpu_training_benchmark.py.",
+)
+
+parser.add_argument(
+    "--compile",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Compile the training model with torch.compile. The first batches are slow while compiling.",
+)
+
+parser.add_argument(
+    "--fuse_eval",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Evaluate with a copy of the model whose BatchNorm layers are folded into the convolutions.",
+)
+
+parser.add_argument(
+    "--num_threads",
+    required=False,
+    default=None,
+    type=int,
+    help="Number of threads within each operation (torch.set_num_threads). Defaults to the number of "
+    "cores; give each process fewer when several training processes share a node.",
+)
+
+parser.add_argument(
+    "--num_interop_threads",
+    required=False,
+    default=None,
     type=int,
-    help="Number of workers to use during dataloading.",
+    help="Number of threads running operations in parallel (torch.set_num_interop_threads).",
+)
+
+parser.add_argument(
+    "--flatbin_mmap",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Memory map flatbin datasets so that dataloader workers and jobs on the same node share pages.",
+)
+
+parser.add_argument(
+    "--flatbin_map_style",
+    required=False,
+    default=False,
+    action="store_true",
+    help="Read flatbin datasets by sample index so that the training samples are shuffled every epoch.",
+)
+
+parser.add_argument(
+    "--flatbin_shuffle_block",
+    required=False,
+    default=None,
+    type=int,
+    help="Read flatbin training data in blocks of this many samples, in a new random order every "
+    "epoch. Each block is a single read, which is much faster than random access to single samples.",
+)
+
+parser.add_argument(
+    "--flatbin_shuffle_pool",
+    required=False,
+    default=8,
+    type=int,
+    help="Number of blocks whose samples are shuffled together with --flatbin_shuffle_block.",
+)
+
+parser.add_argument(
+    "--dataset_weights",
+    required=False,
+    default=None,
+    type=float,
+    nargs="+",
+    help="Relative chance of drawing each training sample from each of several flatbin files, in "
+    "the order of --dataset. By default every file is spread evenly through the epoch.",
 )
 
 # ---------------------- New GradCAM & Debug Options ----------------------
@@ -297,6 +566,74 @@ parser.add_argument(
     help="Enable debugging output.",
 )
 
+parser.add_argument(
+    "--cache_dataset",
+    required=False,
+    action="store_true",
+    default=False,
+    help="Keep the decoded training samples of the first epoch in shared memory and read later epochs "
+    "(and the evaluations of --folds) from there instead of decoding them again. Datasets larger "
+    "than --cache_memory_gb are read every epoch as usual.",
+)
+
+parser.add_argument(
+    "--cache_eval",
+    required=False,
+    action="store_true",
+    default=False,
+    help="Keep the decoded --evaluate samples of the first evaluation and evaluate from them afterwards, "
+    "in batches of --eval_batch_size. They are kept in memory if they fit into --cache_memory_gb "
+    "and otherwise in a memory mapped file in --cache_scratch.",
+)
+
+parser.add_argument(
+    "--cache_scratch",
+    required=False,
+    type=str,
+    default=None,
+    help="Directory for the --cache_eval file when the evaluation set does not fit into memory, "
+    "preferably on a local disk. Defaults to $TMPDIR or /tmp.",
+)
+
+parser.add_argument(
+    "--eval_batch_size",
+    required=False,
+    type=int,
+    default=None,
+    help="Batch size for evaluating from the --cache_eval cache. Defaults to four times the training "
+    "batch size, since evaluation keeps no activations for the backward pass.",
+)
+
+parser.add_argument(
+    "--cache_memory_gb",
+    required=False,
+    type=float,
+    default=None,
+    help="Memory budget of --cache_dataset and --cache_eval, shared by the processes on a node. "
+    "Defaults to half of the memory, or the free space of /dev/shm if that is smaller.",
+)
+
+parser.add_argument(
+    "--profile",
+    required=False,
+    action="store_true",
+    default=False,
+    help="Time each phase of the training and evaluation steps and report the samples per second "
+    "and the time spent waiting for data to RUN_DESCRIPTION.log and <outname>_profile.json. "
+    "Synchronizes the GPU between phases, which slows training a little.",
+)
+
+parser.add_argument(
+    "--profile_trace",
+    required=False,
+    type=int,
+    nargs=2,
+    default=None,
+    metavar=("FIRST_STEP", "STEPS"),
+    help="Record a torch.profiler trace of STEPS training and evaluation steps starting at "
+    "FIRST_STEP (counted over all epochs) to <outname>_trace.json. Implies --profile.",
+)
+
 parser.add_argument(
     "--k",
     type=int,
@@ -314,12 +651,34 @@ logging.basicConfig(format="%(asctime)s: %(message)s",
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 logging.info(f"Parsed arguments: {args}")
+cpu_utility.configureThreads(args.num_threads, args.num_interop_threads)
+
+# Join the other training processes. Only rank 0 logs, writes files, and makes plots.
+rank, world_size, local_rank = 0, 1, 0
+if args.distributed:
+    rank, world_size, local_rank = distributed_utility.initDistributed(
+        use_cuda="cpu" != args.device and torch.cuda.is_available())
+    if 0 != rank:
+        logging.getLogger().setLevel(logging.WARNING)
+    logging.info(f"Training with {world_size} processes")
+is_main = 0 == rank
 
 # use device rather than .cuda() because of the use case of running on cpu
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+device = torch.device(f"cuda:{local_rank}" if "cpu" != args.device and torch.cuda.is_available() else "cpu")
 
 logging.info(f"Using device: {device}")
 
+cpu_mode = args.cpu_optimize and "cpu" == device.type
+fuse_eval = args.fuse_eval or cpu_mode
+# Lower precision without gradient scaling
+amp_dtype = None
+if args.bf16 or cpu_mode:
+    if cpu_utility.bf16Supported(device):
+        amp_dtype = torch.bfloat16
+        logging.info("Using bfloat16 autocast")
+    else:
+        logging.warning(f"{device} has no native bfloat16 support, training in float32.")
+
 # ---------------------- Environment Setup ----------------------
 # Added: Log system information and set random seeds and deterministic mode.
 python_log = os.system("which python3")
@@ -349,6 +708,39 @@ if args.template is not None:
         if "--loss_fun" not in sys.argv:
             args.loss_fun = "BCEWithLogitsLoss"
 
+# Find truncated or damaged flatbin files before any time is spent training on them
+try:
+    dataset_utility.checkDatasetFiles(args.dataset)
+    if args.evaluate:
+        dataset_utility.checkDatasetFiles(args.evaluate)
+except ValueError as error:
+    logging.error(f"{error}. Run utility/flatbin_tool.py verify to find the damaged samples.")
+    exit(1)
+
+if args.folds:
+    if len(args.dataset) < 2:
+        logging.error("--folds needs a dataset for each of at least two folds.")
+        exit(1)
+    if (args.evaluate or args.distributed or args.resume_from or args.auto_resume or args.save_worst_n
+            or args.flatbin_map_style):
+        logging.error("--folds evaluates each model on its own fold and cannot be used with --evaluate, "
+                      "--distributed, --resume_from, --auto_resume, --save_worst_n, or --flatbin_map_style.")
+        exit(1)
+
+if args.profile_trace is not None:
+    args.profile = True
+
+if args.checkpoint_batches is not None:
+    if (args.distributed or args.folds or args.flatbin_map_style
+            or dataset_utility.isWebdataset(args.dataset)):
+        logging.error("--checkpoint_batches needs an iterable flatbin dataset and cannot be used with "
+                      "--distributed, --folds, or --flatbin_map_style.")
+        exit(1)
+    if args.cache_dataset:
+        logging.error("--checkpoint_batches cannot be used with --cache_dataset, whose later epochs do not "
+                      "read the flatbin files.")
+        exit(1)
+
 # ---------------------- Loss Function & Label Preprocessing ----------------------
 # Determine the loss function and configure label processing based on settings.
 loss_fn = getattr(torch.nn, args.loss_fun)().to(device=device)
@@ -418,24 +810,31 @@ label_handler = train_utility.LabelHandler(label_size, label_range,
 # labels and to put the labels in a better training range. Note that this only makes sense with a
 # regression loss, where the label_offset adjustment would not be used.
 if args.normalize_outputs:
-    logging.info(
-        "Reading dataset to compute label statistics for normalization.")
-    label_stats = [OnlineStatistics() for _ in range(label_size)]
-    label_dataset = dataset_utility.makeDataset(args.dataset, args.labels)
-    label_dataloader = torch.utils.data.DataLoader(label_dataset,
-                                                   num_workers=0,
-                                                   batch_size=1)
-    for data in label_dataloader:
-        for label, stat in zip(
-                dataset_utility.extractVectors(data,
-                                               slice(0,
-                                                     label_size))[0].tolist(),
-                label_stats,
-        ):
-            stat.sample(label)
-    label_means = torch.tensor([stat.mean() for stat in label_stats]).cuda()
-    label_stddevs = torch.tensor(
-        [math.sqrt(stat.variance()) for stat in label_stats]).cuda()
+    # The dataset summary sidecars hold the label statistics, otherwise they must be computed.
+    # Flat binary files can provide all of the labels without reading the images.
+    label_statistics = dataset_utility.getLabelStatistics(args.dataset, args.labels)
+    label_columns = None
+    if label_statistics is None:
+        logging.info(
+            "Reading dataset to compute label statistics for normalization.")
+        label_columns = dataset_utility.readVectorColumns(args.dataset, args.labels)
+    if label_statistics is not None:
+        label_means = label_statistics[0].float().to(device)
+        label_stddevs = label_statistics[1].sqrt().float().to(device)
+    elif label_columns is not None:
+        label_columns = label_columns.to(torch.float64)
+        label_means = label_columns.mean(dim=0).float().to(device)
+        label_stddevs = label_columns.var(dim=0, unbiased=False).sqrt().float().to(device)
+    else:
+        label_stats = dataset_utility.computeVectorStatistics(args.dataset, args.labels, label_size,
+                                                              batch_size=args.label_stats_batch_size,
+                                                              # Tuned later, once the training data is read
+                                                              num_workers=0 if "auto" == args.num_workers
+                                                              else args.num_workers)
+        # Distributed processes only read their own shards of a webdataset
+        label_stats = distributed_utility.reduceStats(label_stats)
+        label_means = label_stats.mean().float().to(device)
+        label_stddevs = label_stats.variance().sqrt().float().to(device)
     if (label_stddevs.abs() < 0.0001).any():
         logging.error(
             "Some labels have extremely low variance -- check your dataset.")
@@ -450,6 +849,10 @@ else:
     normalizer = None
     label_handler.setPreprocess(lambda labels: labels - label_offset)
 if args.convert_idx_to_classes == 1:
+    class_histogram = dataset_utility.getClassHistogram(args.dataset, args.labels[0],
+                                                         columns_only=True)
+    if class_histogram is not None:
+        logging.info(f"Training samples per class: {class_histogram.tolist()}")
     label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(
         (labels - label_offset), num_classes=label_handler.size()))
 
@@ -469,171 +872,411 @@ else:
                       if denormalizer is not None else (lambda x: x))
 
 # ---------------------- Dataset Setup ----------------------
-# Build the webdataset with the given transformations.
 logging.info(f"Training with dataset {args.dataset}")
+image_size = dataset_utility.getImageSize(args.dataset, decode_strs)
+logging.info(f"Decoding images of size {image_size}")
+
+# ---------------------- Model Setup ----------------------
+# Configure model arguments and instantiate the chosen model.
+model_args = {
+    "in_dimensions": (in_frames, image_size[-2], image_size[-1]),
+    "out_classes": label_handler.size(),
+}
+vector_input_size = 0
+if len(args.vector_inputs) > 0:
+    vector_input_size = dataset_utility.getVectorSize(args.dataset,
+                                                      decode_strs,
+                                                      vector_range)
+    model_args["vector_input_size"] = vector_input_size
+
+skip_last_relu = args.loss_fun in regression_loss
+
+
+def createNet():
+    """Create the network, its optimizer, and its learning rate schedule.
+
+    Returns:
+        (torch.nn.Module, torch.optim.Optimizer, lr_scheduler, bool): The network, optimizer, learning rate
+            schedule (None for models without one), and whether to use mixed precision training.
+    """
+    use_amp = False
+    # Models without a learning rate schedule leave this unset
+    lr_scheduler = None
+    if args.modeltype == "alexnet":
+        model_args["linear_size"] = 512
+        model_args["skip_last_relu"] = skip_last_relu
+        net = AlexLikeNet(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(), lr=1e-4)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[3, 5, 7],
+                                                            gamma=0.2)
+        use_amp = False
+    elif args.modeltype == "resnet18":
+        # Model specific arguments
+        model_args["expanded_linear"] = True
+        net = ResNet18(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(), lr=1e-5)
+    elif args.modeltype == "resnet34":
+        # Model specific arguments
+        model_args["expanded_linear"] = True
+        net = ResNet34(**model_args).to(device)
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
+    elif args.modeltype == "bennet":
+        # Model specific arguments
+        net = BenNet(**model_args).to(device)
+        optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
+    elif args.modeltype == "resnext50":
+        # Model specific arguments
+        model_args["expanded_linear"] = True
+        net = ResNext50(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-3,
+                                    momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[1, 2, 3],
+                                                            gamma=0.1)
+        batch_size = 64
+    elif args.modeltype == "resnext34":
+        # Model specific arguments
+        model_args["expanded_linear"] = False
+        model_args["use_dropout"] = False
+        # Learning parameters were tuned on a dataset with about 80,000 examples
+        net = ResNext34(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-3,
+                                    momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[2, 5, 9],
+                                                            gamma=0.2)
+    elif args.modeltype == "resnext18":
+        # Model specific arguments
+        model_args["expanded_linear"] = True
+        model_args["use_dropout"] = False
+        # Learning parameters were tuned on a dataset with about 80,000 examples
+        net = ResNext18(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-3,
+                                    momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[2, 5, 12],
+                                                            gamma=0.2)
+    elif args.modeltype == "convnextxt":
+        # Model specific arguments
+        net = ConvNextExtraTiny(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-4,
+                                    weight_decay=1e-4,
+                                    momentum=0.9,
+                                    nesterov=True)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[4, 5, 12],
+                                                            gamma=0.2)
+        use_amp = True
+    elif args.modeltype == "convnextt":
+        # Model specific arguments
+        net = ConvNextTiny(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-4,
+                                    momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[2, 5, 12],
+                                                            gamma=0.2)
+    elif args.modeltype == "convnexts":
+        # Model specific arguments
+        net = ConvNextSmall(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-4,
+                                    momentum=1e-3)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[2, 5, 12],
+                                                            gamma=0.2)
+    elif args.modeltype == "convnextb":
+        # Model specific arguments
+        net = ConvNextBase(**model_args).to(device)
+        optimizer = torch.optim.SGD(net.parameters(),
+                                    lr=1e-2,
+                                    weight_decay=1e-4,
+                                    momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
+                                                            milestones=[2, 5, 12],
+                                                            gamma=0.2)
+    if args.channels_last:
+        # Parameters are converted in place, so the optimizer keeps working
+        net = net.to(memory_format=torch.channels_last)
+    return net, optimizer, lr_scheduler, use_amp
+
+
+# With --folds every fold's model starts from the same weights, as when the folds were separate jobs
+init_rng_state = torch.get_rng_state()
+net, optimizer, lr_scheduler, use_amp = createNet()
+fold_models = [(net, optimizer, lr_scheduler)]
+if args.folds:
+    for fold in range(1, len(args.dataset)):
+        torch.set_rng_state(init_rng_state)
+        fold_models.append(createNet()[:3])
+logging.info(f"Model is {net}")
+
+# ---------------------- Batch Size ----------------------
+# Training used to always use the number of frames per sample as the batch size, and the learning
+# rates above were tuned with that batch size.
+if args.auto_batch_size:
+    train_batch_size = train_utility.findBatchSize(net, model_args["in_dimensions"], device,
+                                                   vector_size=vector_input_size,
+                                                   max_batch_size=args.max_batch_size)
+    batch_size_source = "found with --auto_batch_size"
+elif args.batch_size is not None:
+    train_batch_size = args.batch_size
+    batch_size_source = "set with --batch_size"
+else:
+    train_batch_size = args.sample_frames
+    batch_size_source = "the number of frames per sample"
+reference_batch_size = args.lr_reference_batch_size or args.sample_frames
+# Gradients are averaged over the batches of every process
+lr_scale = train_utility.learningRateScale(args.lr_scaling, train_batch_size * world_size,
+                                           reference_batch_size)
+# Restored optimizer states below keep their own learning rates
+for _, fold_optimizer, fold_scheduler in fold_models:
+    train_utility.scaleLearningRate(fold_optimizer, fold_scheduler, lr_scale)
+logging.info(f"Training batch size is {train_batch_size} ({batch_size_source}), "
+             f"learning rates are scaled by {lr_scale:.4g}")
+if is_main:
+    with open("RUN_DESCRIPTION.log", "a") as run_desc:
+        run_desc.write(f"\n-- Training batch size {train_batch_size} ({batch_size_source}) in each of "
+                       f"{world_size} processes, {args.lr_scaling} learning rate scaling by {lr_scale:.4g} --\n")
+
+# Checkpoints are written on a background thread, only by the first process
+checkpoints = [checkpoint_utility.CheckpointManager(
+    multifold_utility.foldCheckpointName(args.outname, fold) if args.folds else args.outname,
+    keep_last=args.keep_checkpoints, async_save=not args.sync_checkpoints) for fold in range(len(fold_models))]
+
+# Phase timers for --profile, a disabled profiler does nothing
+outname_root = os.path.splitext(args.outname)[0]
+profiler = profile_utility.StepProfiler(
+    device, enabled=args.profile, trace_path=f"{outname_root}_trace.json" if is_main else None,
+    trace_steps=args.profile_trace)
+
+
+def reportProfile(mode, epoch):
+    """Log the profile of an epoch and save the reports so far with --profile."""
+    report = profiler.report(mode, epoch)
+    if report is None:
+        return
+    logging.info(profile_utility.summarizeReport(report))
+    if is_main:
+        profiler.save(f"{outname_root}_profile.json", "RUN_DESCRIPTION.log")
+
+
+start_epoch = 0
+resume_checkpoint = None
+# Samples already read by each dataloader worker when resuming part way through an epoch
+resume_cursor = None
+if args.resume_from is not None:
+    restoreModelAndState(args.resume_from, net, optimizer)
+elif args.auto_resume:
+    resume_path, resume_checkpoint = checkpoint_utility.findLatestCheckpoint(args.outname)
+    if resume_checkpoint is None:
+        logging.info(f"No checkpoint of {args.outname} to resume from, starting from scratch.")
+    else:
+        restoreModelAndState(resume_checkpoint, net, optimizer, lr_scheduler)
+        checkpoints[0].restore()
+        start_epoch = resume_checkpoint.get("epoch", -1) + 1
+        if "cursor" in resume_checkpoint:
+            # Progress checkpoints are part way through their epoch
+            start_epoch -= 1
+            resume_cursor = resume_checkpoint["cursor"]
+            logging.info(f"Resuming from {resume_path} at epoch {start_epoch} after "
+                         f"{sum(resume_cursor.values())} samples")
+        else:
+            logging.info(f"Resuming from {resume_path} at epoch {start_epoch}")
+
+# The unwrapped network is saved and used for evaluation, which has no gradients to average
+base_net = net
+if args.distributed:
+    net = torch.nn.parallel.DistributedDataParallel(
+        net, device_ids=[local_rank] if "cuda" == device.type else None)
+if args.compile:
+    # The uncompiled network shares the weights and is still used for saving and evaluation
+    net = torch.compile(net)
+
+# ---------------------- Dataloader Setup ----------------------
+# Build the webdataset with the given transformations.
+# Webdatasets are batched inside of the dataloader workers rather than by the DataLoader
+worker_batching = dataset_utility.isWebdataset(args.dataset)
+worst_indices = args.save_worst_n is not None and args.flatbin_map_style and not worker_batching
 dataset = dataset_utility.makeDataset(
     args.dataset,
     decode_strs,
     shuffle=20000 // in_frames,
     shardshuffle=20000 // in_frames,
+    use_mmap=args.flatbin_mmap,
+    map_style=args.flatbin_map_style,
+    shuffle_block=args.flatbin_shuffle_block,
+    shuffle_pool=args.flatbin_shuffle_pool,
+    seed=args.seed,
+    weights=args.dataset_weights,
+    # Images are converted to floats on the training device
+    uint8_images=True,
+    batch_size=train_batch_size if worker_batching else None,
+    # The fold of each sample decides which models train on it
+    source_index=args.folds,
+    # Worst examples are read again by their index when they are saved instead of being kept
+    sample_index=worst_indices,
 )
-image_size = dataset_utility.getImageSize(args.dataset, decode_strs)
-logging.info(f"Decoding images of size {image_size}")
 
-# Use the number of frames_per_sample as the batch size, and allow multiple workers if requested
-train_batch_size = args.sample_frames
+# Iterable datasets split their samples between the processes themselves (see
+# flatbin_dataset.readerShard), map style datasets need a sampler
+train_sampler = None
+if args.distributed and not isinstance(dataset, torch.utils.data.IterableDataset):
+    train_sampler = torch.utils.data.distributed.DistributedSampler(dataset, seed=args.seed)
+# The workers pack the frames of each batch into one tensor that is copied to the device at once
+train_collate = functools.partial(prefetch_utility.packFrames if worker_batching else prefetch_utility.collateFrames,
+                                  in_frames)
+loader_settings = {"num_workers": args.num_workers, "pin_memory": True}
+if "auto" == args.num_workers:
+    loader_format = ("webdataset" if worker_batching else "flatbin" + ("-mmap" if args.flatbin_mmap else "")
+                     + ("-map" if args.flatbin_map_style else ""))
+    # Processes on the same node share its cores
+    tune = functools.partial(
+        dataloader_utility.tuneLoader, dataset, loader_format, device,
+        max_workers=max(1, dataloader_utility.availableCores() // int(os.environ.get("LOCAL_WORLD_SIZE", 1))),
+        batch_size=None if worker_batching else train_batch_size, collate_fn=train_collate)
+    # The first process on each node measures and the others use its cached choice
+    if 0 == local_rank:
+        loader_settings = tune()
+    if args.distributed:
+        torch.distributed.barrier()
+    if 0 != local_rank:
+        loader_settings = tune()
+if resume_cursor is not None:
+    # The cursor counts the samples of each reader, which only lines up with the same readers
+    readers = resume_checkpoint.get("readers")
+    if readers is None:
+        logging.warning("The progress checkpoint does not record its dataloader workers, so they are assumed "
+                        "to be the same as in this run.")
+    elif readers["world_size"] != world_size:
+        logging.error(f"The progress checkpoint was saved by {readers['world_size']} processes, not "
+                      f"{world_size}. Resume with the same number of processes or from an epoch checkpoint.")
+        exit(1)
+    elif readers["num_workers"] != loader_settings["num_workers"]:
+        if "auto" != args.num_workers:
+            logging.error(f"The progress checkpoint was saved with --num_workers {readers['num_workers']}, not "
+                          f"{args.num_workers}. Resume with the same number of workers or from an epoch "
+                          "checkpoint.")
+            exit(1)
+        logging.info(f"Using the {readers['num_workers']} dataloader workers of the progress checkpoint "
+                     f"instead of {loader_settings['num_workers']}.")
+        loader_settings = dict(loader_settings, num_workers=readers["num_workers"])
+        if 0 == readers["num_workers"]:
+            loader_settings.update(prefetch_factor=None, persistent_workers=False)
+if args.checkpoint_batches is not None:
+    # Batches come from the dataloader workers in turn, so resuming starts at the first worker
+    workers = max(1, loader_settings["num_workers"])
+    args.checkpoint_batches = workers * math.ceil(args.checkpoint_batches / workers)
 dataloader = torch.utils.data.DataLoader(
     dataset,
-    batch_size=train_batch_size,
-    shuffle=True,                             # you almost certainly want to shuffle
-    num_workers=args.num_workers,
-    pin_memory=True,
+    batch_size=None if worker_batching else train_batch_size,
+    collate_fn=train_collate,
+    # Iterable datasets shuffle internally (or not at all) and cannot use a sampler
+    shuffle=train_sampler is None and not isinstance(dataset, torch.utils.data.IterableDataset),
+    sampler=train_sampler,
+    # Reseeded every epoch so that a resumed epoch gives its workers the same seeds
+    generator=torch.Generator(),
+    **loader_settings,
 )
 
+# Random access to the first frame of each training sample, to read the worst examples again
+worst_reader = None
+if worst_indices:
+    worst_reader = dataset_utility.makeDataset(args.dataset, decode_strs[:1], use_mmap=args.flatbin_mmap,
+                                               map_style=True, uint8_images=True)
+
 if args.evaluate:
     eval_dataset = dataset_utility.makeDataset(
         args.evaluate,
         decode_strs,
-        shuffle=20000 // in_frames,
+        # Evaluation does not need a shuffle buffer
+        shuffle=False,
         shardshuffle=20000 // in_frames,
+        use_mmap=args.flatbin_mmap,
+        uint8_images=True,
+        batch_size=train_batch_size if dataset_utility.isWebdataset(args.evaluate) else None,
     )
     eval_dataloader = torch.utils.data.DataLoader(
         eval_dataset,
-        batch_size=train_batch_size,
+        batch_size=None if dataset_utility.isWebdataset(args.evaluate) else train_batch_size,
+        collate_fn=functools.partial(prefetch_utility.packFrames if dataset_utility.isWebdataset(args.evaluate)
+                                     else prefetch_utility.collateFrames, in_frames),
         shuffle=False,
-        num_workers=args.num_workers,
-        pin_memory=True,
+        **loader_settings,
     )
     
     logging.info(f"Loaded train dataloader (batch_size={train_batch_size})"
                 + (f" and eval dataloader(batch_size={train_batch_size})" if args.evaluate else ""))
 
     logging.info(f"Loaded evaluation dataset from {args.evaluate}")
+elif args.folds:
+    # Every model is evaluated on its own fold during a single pass through all of the folds
+    eval_dataloader = torch.utils.data.DataLoader(
+        dataset_utility.makeDataset(
+            args.dataset,
+            decode_strs,
+            shuffle=False,
+            shardshuffle=False,
+            use_mmap=args.flatbin_mmap,
+            uint8_images=True,
+            batch_size=train_batch_size if worker_batching else None,
+            source_index=True,
+        ),
+        batch_size=None if worker_batching else train_batch_size,
+        collate_fn=functools.partial(prefetch_utility.packFrames if worker_batching else prefetch_utility.collateFrames,
+                                     in_frames),
+        **loader_settings,
+    )
 
-# ---------------------- Model Setup ----------------------
-# Configure model arguments and instantiate the chosen model.
-model_args = {
-    "in_dimensions": (in_frames, image_size[-2], image_size[-1]),
-    "out_classes": label_handler.size(),
-}
-vector_input_size = 0
-if len(args.vector_inputs) > 0:
-    vector_input_size = dataset_utility.getVectorSize(args.dataset,
-                                                      decode_strs,
-                                                      vector_range)
-    model_args["vector_input_size"] = vector_input_size
+# The decoded samples of the first epoch (and evaluation) are copied into memory for the later ones
+cache_builder = None
+eval_cache_builder = None
+if args.cache_dataset or args.cache_eval:
+    cache_budget = (int(args.cache_memory_gb * 2**30) if args.cache_memory_gb is not None
+                    else cache_utility.memoryBudget()) // int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+if args.cache_dataset:
+    try:
+        # Each process reads its own part of the dataset
+        cache_samples = len(dataset) // world_size
+    except TypeError:
+        cache_samples = None
+    cache_builder = cache_utility.CacheBuilder(cache_budget, cache_samples)
+if args.cache_eval and args.evaluate:
+    # The evaluation set is cached after the training set, from what is left of the budget
+    eval_cache_builder = cache_utility.CacheBuilder(
+        cache_budget, spill_dir=args.cache_scratch or os.environ.get("TMPDIR", "/tmp"))
 
-skip_last_relu = args.loss_fun in regression_loss
-use_amp = False
-
-# See if the model weights and optimizer state should be restored.
-if args.modeltype == "alexnet":
-    model_args["linear_size"] = 512
-    model_args["skip_last_relu"] = skip_last_relu
-    net = AlexLikeNet(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(), lr=1e-4)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[3, 5, 7],
-                                                        gamma=0.2)
-    use_amp = False
-elif args.modeltype == "resnet18":
-    # Model specific arguments
-    model_args["expanded_linear"] = True
-    net = ResNet18(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(), lr=1e-5)
-elif args.modeltype == "resnet34":
-    # Model specific arguments
-    model_args["expanded_linear"] = True
-    net = ResNet34(**model_args).to(device)
-    optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
-elif args.modeltype == "bennet":
-    # Model specific arguments
-    net = BenNet(**model_args).to(device)
-    optimizer = torch.optim.Adam(net.parameters(), lr=1e-5)
-elif args.modeltype == "resnext50":
-    # Model specific arguments
-    model_args["expanded_linear"] = True
-    net = ResNext50(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-3,
-                                momentum=0.9)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[1, 2, 3],
-                                                        gamma=0.1)
-    batch_size = 64
-elif args.modeltype == "resnext34":
-    # Model specific arguments
-    model_args["expanded_linear"] = False
-    model_args["use_dropout"] = False
-    # Learning parameters were tuned on a dataset with about 80,000 examples
-    net = ResNext34(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-3,
-                                momentum=0.9)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[2, 5, 9],
-                                                        gamma=0.2)
-elif args.modeltype == "resnext18":
-    # Model specific arguments
-    model_args["expanded_linear"] = True
-    model_args["use_dropout"] = False
-    # Learning parameters were tuned on a dataset with about 80,000 examples
-    net = ResNext18(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-3,
-                                momentum=0.9)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[2, 5, 12],
-                                                        gamma=0.2)
-elif args.modeltype == "convnextxt":
-    # Model specific arguments
-    net = ConvNextExtraTiny(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-4,
-                                weight_decay=1e-4,
-                                momentum=0.9,
-                                nesterov=True)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[4, 5, 12],
-                                                        gamma=0.2)
-    use_amp = True
-elif args.modeltype == "convnextt":
-    # Model specific arguments
-    net = ConvNextTiny(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-4,
-                                momentum=0.9)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[2, 5, 12],
-                                                        gamma=0.2)
-elif args.modeltype == "convnexts":
-    # Model specific arguments
-    net = ConvNextSmall(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-4,
-                                momentum=1e-3)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[2, 5, 12],
-                                                        gamma=0.2)
-elif args.modeltype == "convnextb":
-    # Model specific arguments
-    net = ConvNextBase(**model_args).to(device)
-    optimizer = torch.optim.SGD(net.parameters(),
-                                lr=1e-2,
-                                weight_decay=1e-4,
-                                momentum=0.9)
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-                                                        milestones=[2, 5, 12],
-                                                        gamma=0.2)
-logging.info(f"Model is {net}")
 
-if args.resume_from is not None:
-    restoreModelAndState(args.resume_from, net, optimizer)
+# Augmentation of the training batches on the device, seeded like the dataloader
+augmenter = augment_utility.BatchAugmenter(
+    shift=args.augment_shift,
+    hflip=args.augment_flip[0],
+    vflip=args.augment_flip[1],
+    brightness=args.augment_jitter[0],
+    contrast=args.augment_jitter[1],
+    frame_dropout=args.augment_frame_dropout,
+    seed=args.seed,
+)
+if augmenter.enabled:
+    logging.info(f"Augmenting training batches: {vars(augmenter)}")
+
+
+def cachedLoader(cache, shuffle, batch_size=None):
+    """Return a dataloader of the decoded cache, reseeded with the training dataloader when shuffled."""
+    return torch.utils.data.DataLoader(cache, batch_size=batch_size or train_batch_size, shuffle=shuffle,
+                                       collate_fn=cache_utility.keepBatch,
+                                       generator=dataloader.generator if shuffle else None, **loader_settings)
+
 
 # TODO(bfirner) Read class names from something instead of assigning them numbers.
 # Note that we can't just use the label names since we may be getting classes by converting a
@@ -645,48 +1288,174 @@ class_names = []
 for i in range(label_size):
     class_names.append(f"{i}")
 
+
+
+def newStatistics():
+    """Return empty training or evaluation statistics for the loss function."""
+    if args.loss_fun in regression_loss:
+        return RegressionResults(size=label_handler.size(), names=label_handler.names())
+    return ConfusionMatrix(size=label_handler.size())
+
+
+def checkpointState(net, optimizer, lr_scheduler, scaler=None):
+    """Return the model, optimizer, and random states along with the model metadata to save."""
+    return {
+        "model_dict":
+        net.state_dict(),
+        "optim_dict":
+        optimizer.state_dict(),
+        "lr_scheduler_dict":
+        (lr_scheduler.state_dict()
+         if lr_scheduler is not None else None),
+        "scaler_dict":
+        (scaler.state_dict()
+         if scaler is not None else None),
+        "py_random_state":
+        random.getstate(),
+        "np_random_state":
+        numpy.random.get_state(),
+        "torch_rng_state":
+        torch.get_rng_state(),
+        "cuda_rng_state":
+        (torch.cuda.get_rng_state_all()
+         if torch.cuda.is_available() else None),
+        "denormalizer_state_dict":
+        (denormalizer.state_dict()
+         if denormalizer is not None else None),
+        "normalizer_state_dict":
+        (normalizer.state_dict()
+         if normalizer is not None else None),
+        "metadata": {
+            "modeltype": args.modeltype,
+            "labels": args.labels,
+            "vector_inputs": args.vector_inputs,
+            "convert_idx_to_classes": args.convert_idx_to_classes,
+            "label_size": label_handler.size(),
+            "model_args": model_args,
+            "normalize_images": args.normalize,
+            "normalize_labels": args.normalize_outputs,
+            "batch_size": train_batch_size,
+            "lr_scale": lr_scale,
+        },
+    }
+
+
 # ---------------------- Training Loop ----------------------
 # Added: Wrap the training loop in a try/except to log and re-raise exceptions.
-if not args.no_train:
+if not args.no_train and args.folds:
+    # Every model gets its own gradient scaler
+    scalers = [torch.amp.GradScaler("cuda") if use_amp and amp_dtype is None else None for _ in fold_models]
+    fold_nets = [torch.compile(fold_net) if args.compile else fold_net for fold_net, _, _ in fold_models]
+    try:
+        for epoch in range(start_epoch, args.epochs):
+            logging.info(f"Starting epoch {epoch}")
+            if hasattr(dataset, "set_epoch"):
+                dataset.set_epoch(epoch)
+            dataloader.generator.manual_seed(int(numpy.random.SeedSequence([args.seed, epoch]).generate_state(1)[0]))
+            augmenter.set_epoch(epoch)
+            multifold_utility.trainFoldsEpoch(
+                nets=fold_nets,
+                optimizers=[fold_optimizer for _, fold_optimizer, _ in fold_models],
+                scalers=scalers,
+                label_handler=label_handler,
+                train_stats=[newStatistics() for _ in fold_models],
+                dataloader=(dataloader if cache_builder is None
+                            else cache_utility.RecordingLoader(dataloader, cache_builder)),
+                vector_range=vector_range,
+                train_frames=in_frames,
+                normalize_images=args.normalize,
+                loss_fn=loss_fn,
+                nn_postprocess=nn_postprocess,
+                device=device,
+                amp_dtype=amp_dtype,
+                augment=augmenter if augmenter.enabled else None,
+                profiler=profiler,
+            )
+            reportProfile("train", epoch)
+            if cache_builder is not None:
+                cache = cache_builder.finish()
+                cache_builder = None
+                # Evaluation of the folds reads the same samples
+                if cache is not None:
+                    dataloader = cachedLoader(cache, shuffle=True)
+                    eval_dataloader = cachedLoader(cache, shuffle=False)
+            for _, _, fold_scheduler in fold_models:
+                if fold_scheduler is not None:
+                    fold_scheduler.step()
+            logging.info(f"Evaluating epoch {epoch}")
+            eval_losses = multifold_utility.evalFoldsEpoch(
+                nets=([cpu_utility.fuseConvBatchNorm(fold_net) for fold_net, _, _ in fold_models]
+                      if fuse_eval else fold_nets),
+                label_handler=label_handler,
+                eval_stats=[newStatistics() for _ in fold_models],
+                eval_dataloader=eval_dataloader,
+                vector_range=vector_range,
+                train_frames=in_frames,
+                normalize_images=args.normalize,
+                loss_fn=loss_fn,
+                nn_postprocess=nn_postprocess,
+                outnames=args.dataset,
+                write_to_description=epoch >= args.epochs - 1,
+                device=device,
+                amp_dtype=amp_dtype,
+                profiler=profiler,
+            )
+            reportProfile("eval", epoch)
+            # Save checkpoints, keeping the one with the lowest loss on the fold
+            for fold_checkpoints, (fold_net, fold_optimizer, fold_scheduler), eval_loss in zip(
+                    checkpoints, fold_models, eval_losses):
+                fold_checkpoints.save(checkpointState(fold_net, fold_optimizer, fold_scheduler), epoch, eval_loss)
+    except Exception as e:
+        logging.error(f"Exception during training: {e}")
+        raise e
+elif not args.no_train:
     # Gradient scaler for mixed precision training
-    scaler = torch.amp.GradScaler("cuda") if use_amp else None
+    scaler = torch.amp.GradScaler("cuda") if use_amp and amp_dtype is None else None
+    if scaler is not None and resume_checkpoint is not None and resume_checkpoint.get("scaler_dict") is not None:
+        scaler.load_state_dict(resume_checkpoint["scaler_dict"])
+
+    def saveProgress(batches, cursor):
+        """Save a mid-epoch checkpoint every --checkpoint_batches batches."""
+        if 0 == batches % args.checkpoint_batches:
+            checkpoints[0].saveProgress(checkpointState(base_net, optimizer, lr_scheduler, scaler), epoch, cursor,
+                                        loader_settings["num_workers"], world_size)
+
     try:
         worst_training = None
-        for epoch in range(args.epochs):
-            if args.save_worst_n is not None:
-                worst_training = WorstExamples(
-                    args.outname.split(".")[0] + "-worstN-train-epoch{}",
-                    class_names,
-                    args.save_worst_n,
-                    epoch,
-                )
-                logging.info(
-                    f"Saving worst training examples to {worst_training.worstn_path}."
-                )
+        for epoch in range(start_epoch, args.epochs):
             logging.info(f"Starting epoch {epoch}")
-            if args.save_worst_n is not None:
+            # Block shuffled flatbin datasets change their order every epoch
+            if hasattr(dataset, "set_epoch"):
+                dataset.set_epoch(epoch)
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            dataloader.generator.manual_seed(int(numpy.random.SeedSequence([args.seed, epoch]).generate_state(1)[0]))
+            augmenter.set_epoch(epoch)
+            # Skip the samples that were trained on before a mid-epoch checkpoint, without decoding them
+            start_cursor = None
+            if resume_cursor is not None and epoch == start_epoch:
+                dataset.set_skip(resume_cursor)
+                start_cursor = resume_cursor
+            if args.save_worst_n is not None and is_main:
                 worst_training = WorstExamples(
-                    args.outname.split(".")[0] + "-worstN-train-epoch{}",
+                    args.outname.split(".")[0] + f"-worstN-train-epoch{epoch}",
                     class_names,
                     args.save_worst_n,
-                    epoch,
+                    reader=worst_reader,
                 )
                 logging.info(
                     f"Saving worst training examples to {worst_training.worstn_path}."
                 )
-            if args.loss_fun in regression_loss:
-                totals = RegressionResults(size=label_handler.size(),
-                                           names=label_handler.names())
-            else:
-                totals = ConfusionMatrix(size=label_handler.size())
+            totals = newStatistics()
 
-            train_utility.trainEpoch(
+            train_loss = train_utility.trainEpoch(
                 net=net,
                 optimizer=optimizer,
                 scaler=scaler,
                 label_handler=label_handler,
                 train_stats=totals,
-                dataloader=dataloader,
+                dataloader=(dataloader if cache_builder is None
+                            else cache_utility.RecordingLoader(dataloader, cache_builder)),
                 vector_range=vector_range,
                 train_frames=in_frames,
                 normalize_images=args.normalize,
@@ -694,56 +1463,37 @@ if not args.no_train:
                 nn_postprocess=nn_postprocess,
                 worst_training=worst_training,
                 skip_metadata=args.skip_metadata,
+                device=device,
+                amp_dtype=amp_dtype,
+                sample_indices=worst_indices,
+                start_cursor=start_cursor,
+                progress_fn=saveProgress if args.checkpoint_batches is not None and is_main else None,
+                profiler=profiler,
+                augment=augmenter if augmenter.enabled else None,
             )
+            reportProfile("train", epoch)
+            if cache_builder is not None:
+                cache = cache_builder.finish()
+                cache_builder = None
+                if cache is not None:
+                    dataloader = cachedLoader(cache, shuffle=True)
+                    if eval_cache_builder is not None:
+                        eval_cache_builder.max_bytes -= cache.nbytes()
             # Adjust learning rate according to the learning rate schedule
             if lr_scheduler is not None:
                 lr_scheduler.step()
-            # Save checkpoint
-            torch.save(
-                {
-                    "model_dict":
-                    net.state_dict(),
-                    "optim_dict":
-                    optimizer.state_dict(),
-                    "py_random_state":
-                    random.getstate(),
-                    "np_random_state":
-                    numpy.random.get_state(),
-                    "torch_rng_state":
-                    torch.get_rng_state(),
-                    "denormalizer_state_dict":
-                    (denormalizer.state_dict()
-                     if denormalizer is not None else None),
-                    "normalizer_state_dict":
-                    (normalizer.state_dict()
-                     if normalizer is not None else None),
-                    "metadata": {
-                        "modeltype": args.modeltype,
-                        "labels": args.labels,
-                        "vector_inputs": args.vector_inputs,
-                        "convert_idx_to_classes": args.convert_idx_to_classes,
-                        "label_size": label_handler.size(),
-                        "model_args": model_args,
-                        "normalize_images": args.normalize,
-                        "normalize_labels": args.normalize_outputs,
-                    },
-                },
-                args.outname,
-            )
             # Evaluation step during training if requested
             # Validation step if requested
+            eval_loss = None
             if args.evaluate is not None:
-                print(f"Evaluating epoch {epoch}")
-                if args.loss_fun in regression_loss:
-                    eval_totals = RegressionResults(
-                        size=label_handler.size(), names=label_handler.names())
-                else:
-                    eval_totals = ConfusionMatrix(size=label_handler.size())
-                train_utility.evalEpoch(
-                    net=net,
+                logging.info(f"Evaluating epoch {epoch}")
+                eval_totals = newStatistics()
+                eval_loss = train_utility.evalEpoch(
+                    net=cpu_utility.fuseConvBatchNorm(base_net) if fuse_eval else base_net,
                     label_handler=label_handler,
                     eval_stats=eval_totals,
-                    eval_dataloader=eval_dataloader,
+                    eval_dataloader=(eval_dataloader if eval_cache_builder is None
+                                     else cache_utility.RecordingLoader(eval_dataloader, eval_cache_builder)),
                     vector_range=vector_range,
                     train_frames=in_frames,
                     normalize_images=args.normalize,
@@ -751,7 +1501,21 @@ if not args.no_train:
                     nn_postprocess=nn_postprocess,
                     write_to_description=epoch >= args.epochs - 1,
                     outname=args.evaluate,
+                    device=device,
+                    amp_dtype=amp_dtype,
+                    profiler=profiler,
                 )
+                reportProfile("eval", epoch)
+                if eval_cache_builder is not None:
+                    eval_cache = eval_cache_builder.finish()
+                    eval_cache_builder = None
+                    if eval_cache is not None:
+                        eval_dataloader = cachedLoader(eval_cache, shuffle=False,
+                                                       batch_size=args.eval_batch_size or 4 * train_batch_size)
+            # Save checkpoint, keeping the one with the lowest evaluation (or training) loss
+            if is_main:
+                checkpoints[0].save(checkpointState(base_net, optimizer, lr_scheduler, scaler), epoch,
+                                    train_loss if eval_loss is None else eval_loss)
             # End training loop; final checkpoint saved above.
     except Exception as e:
         logging.error(f"Exception during training: {e}")
@@ -759,7 +1523,14 @@ if not args.no_train:
 
 # ---------------------- Post-Training Evaluation & GradCAM ----------------------
 # Added: If evaluation dataset was provided, perform post-training evaluation and optionally generate GradCAM plots.
-if args.evaluate:
+profiler.close()
+# Finish writing the checkpoints, which GradCAM reads
+for fold_checkpoints in checkpoints:
+    fold_checkpoints.close()
+    if 0 < fold_checkpoints.saves:
+        logging.info(fold_checkpoints.summary())
+distributed_utility.cleanupDistributed()
+if args.evaluate and is_main:
     logging.info("Starting post-training evaluation.")
     # GradCAM plotting if enabled (only for alexnet type with gradcam layers)
     if args.gradcam_cnn_model_layer and args.modeltype in [
@@ -0,0 +1,132 @@
+"""
+Common functions used by the data loading and training benchmarks.
+
+The benchmarks are meant to be run from the top level bee_analysis directory, e.g.
+> python3 benchmarks/flatbin_reader_benchmark.py
+"""
+
+import multiprocessing
+import os
+import resource
+import time
+import torch
+
+import utility.flatbin_dataset as flatbin_dataset
+
+
+def makeSyntheticFrames(count, height, width, channels=1, generator=None):
+    """Make uint8 frames that compress like real video frames rather than like pure noise.
+
+    Low resolution noise is upscaled so that the frames have some structure, then a small amount of
+    full resolution noise is added.
+    """
+    coarse = torch.rand((count, channels, max(1, height // 8), max(1, width // 8)), generator=generator)
+    frames = torch.nn.functional.interpolate(coarse, size=(height, width), mode='bilinear', align_corners=False)
+    frames = frames * 200 + torch.rand((count, channels, height, width), generator=generator) * 16
+    return frames.clamp(0, 255).to(torch.uint8)
+
+
+def makeSyntheticFlatbin(path, samples, height, width, frames=1, numpy_entry=False, num_classes=3,
+        batch_size=64, seed=0, image_type="png", index_entry=False, **writer_args):
+    """Write a flatbin file with synthetic frames and class labels.
+
+    Arguments:
+        path        (str): Output path.
+        samples     (int): Number of samples to write.
+        height      (int): Frame height.
+        width       (int): Frame width.
+        frames      (int): Number of png frames per sample.
+        numpy_entry (bool): Also store the frames as a raw uint8 tensor in a "frames.numpy" entry.
+        image_type  (str): "png" or "raw".
+        index_entry (bool): Also store the number of each sample in an "index.int" entry.
+        writer_args: Passed through to dataloaderToFlatbin.
+    Returns:
+        [str]: The entry names in the file.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    entries = [f"{i}.{image_type}" for i in range(frames)] + ["cls"]
+    if numpy_entry:
+        entries.append("frames.numpy")
+    if index_entry:
+        entries.append("index.int")
+
+    def batches():
+        remaining = samples
+        while 0 < remaining:
+            count = min(batch_size, remaining)
+            remaining -= count
+            images = [makeSyntheticFrames(count, height, width, generator=generator) for _ in range(frames)]
+            labels = torch.randint(1, num_classes + 1, (count,), generator=generator)
+            batch = images + [labels]
+            if numpy_entry:
+                batch.append(torch.cat(images, dim=1))
+            if index_entry:
+                batch.append(torch.arange(samples - remaining - count, samples - remaining))
+            yield batch
+
+    flatbin_dataset.dataloaderToFlatbin(batches(), entries, path, handlers={'cls': 'stoi'}, **writer_args)
+    return entries
+
+
+def dropFromPageCache(path):
+    """Ask the kernel to drop the cached pages of a file so that the next read comes from storage."""
+    with open(path, "rb") as dropfile:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(dropfile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def memoryStatus():
+    """Return the memory use of this process in MiB.
+
+    RssAnon is private memory, RssFile is memory backed by files (such as memory maps) that is
+    shared through the page cache, and VmHWM is the peak resident set size.
+    """
+    status = {}
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM", "RssAnon", "RssFile", "RssShmem"):
+                    status[key] = int(value.split()[0]) / 1024.0
+    except OSError:
+        # Not linux, fall back to the peak usage
+        status["VmHWM"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return status
+
+
+def timeDataloader(dataloader, max_batches=None):
+    """Iterate through a dataloader and return the number of samples and the elapsed seconds."""
+    samples = 0
+    begin_time = time.perf_counter()
+    for batch_num, batch in enumerate(dataloader):
+        samples += len(batch[0])
+        if max_batches is not None and batch_num + 1 >= max_batches:
+            break
+    return samples, time.perf_counter() - begin_time
+
+
+def _runAndReport(queue, fn, args):
+    queue.put(fn(*args))
+
+
+def runIsolated(fn, args=(), processes=1):
+    """Run fn(*args) in separate processes, concurrently, and return the list of their results.
+
+    Running in a fresh process isolates the memory measurements of each benchmark case.
+    """
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    workers = [context.Process(target=_runAndReport, args=(queue, fn, args)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    results = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def printTable(header, rows):
+    """Print a simple aligned table."""
+    widths = [max(len(str(item)) for item in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(item).rjust(width) for item, width in zip(row, widths)))
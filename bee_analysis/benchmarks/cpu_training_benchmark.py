@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+Compare training and evaluation speed on the cpu in float32 against the optimized cpu mode.
+
+Every model that model_utility.createModel builds is timed on synthetic batches, without any data
+loading, in two configurations:
+  fp32:      float32 in the default memory format, as the training script used to run on the cpu
+  optimized: bfloat16 autocast (if the processor supports it natively), the channels last memory
+             format, and BatchNorm folded into the convolutions for evaluation, optionally with
+             torch.compile
+
+Example:
+> python3 benchmarks/cpu_training_benchmark.py --models alexnet resnet18 bennet --num_threads 8
+"""
+
+import argparse
+import sys
+import time
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.cpu_utility as cpu_utility
+import utility.model_utility as model_utility
+import utility.train_utility as train_utility
+
+from benchmark_common import printTable
+
+all_models = ["alexnet", "bennet", "compactingbennet", "dragonfly", "resnet18", "resnet34", "resnext18",
+              "resnext34", "resnext50", "convnextxt", "convnextt", "convnexts", "convnextb"]
+
+parser = argparse.ArgumentParser(description='Benchmark training and evaluation on the cpu.')
+parser.add_argument('--models', type=str, nargs='+', required=False, default=all_models, choices=all_models)
+parser.add_argument('--height', type=int, required=False, default=128)
+parser.add_argument('--width', type=int, required=False, default=128)
+parser.add_argument('--frames', type=int, required=False, default=1)
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--steps', type=int, required=False, default=5,
+    help="Timed steps of each case, after two untimed warm up steps.")
+parser.add_argument('--num_threads', type=int, required=False, default=None)
+parser.add_argument('--compile', action='store_true', default=False,
+    help="Also compile the optimized models with torch.compile.")
+args = parser.parse_args()
+
+cpu_utility.configureThreads(args.num_threads)
+amp_dtype = torch.bfloat16 if cpu_utility.bf16Supported("cpu") else None
+if amp_dtype is None:
+    print("This processor has no native bfloat16 support, the optimized mode stays in float32.")
+
+
+def timeSteps(step):
+    """Return the samples per second of a step function, after warming up."""
+    for _ in range(2):
+        step()
+    begin = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    return args.steps * args.batch_size / (time.perf_counter() - begin)
+
+
+def benchmarkModel(model_type, optimized):
+    """Return the training and evaluation samples per second of a model."""
+    torch.manual_seed(0)
+    net = model_utility.createModel(model_type, args.frames, args.height, args.width, 3, device="cpu")
+    images = torch.rand((args.batch_size, args.frames, args.height, args.width))
+    labels = torch.randint(0, 3, (args.batch_size,))
+    loss_fn = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(net.parameters(), lr=1e-4)
+    step_dtype = None
+    if optimized:
+        net = net.to(memory_format=torch.channels_last)
+        step_dtype = amp_dtype
+    train_net = torch.compile(net) if optimized and args.compile else net
+
+    net.train()
+    train_rate = timeSteps(lambda: train_utility.updateWithoutScaler(loss_fn, train_net, images, None, labels,
+                                                                     optimizer, step_dtype))
+
+    eval_net = cpu_utility.fuseConvBatchNorm(net) if optimized else net.eval()
+    if optimized and args.compile:
+        eval_net = torch.compile(eval_net)
+
+    def evalStep():
+        with torch.inference_mode(), train_utility.autocastContext("cpu", step_dtype):
+            eval_net(images)
+    eval_rate = timeSteps(evalStep)
+    return train_rate, eval_rate
+
+
+rows = []
+for model_type in args.models:
+    fp32_train, fp32_eval = benchmarkModel(model_type, optimized=False)
+    opt_train, opt_eval = benchmarkModel(model_type, optimized=True)
+    rows.append([model_type, f"{fp32_train:.1f}", f"{opt_train:.1f}", f"{opt_train / fp32_train:.2f}x",
+                 f"{fp32_eval:.1f}", f"{opt_eval:.1f}", f"{opt_eval / fp32_eval:.2f}x"])
+
+printTable(["model", "fp32 train/s", "optimized train/s", "speedup", "fp32 eval/s", "optimized eval/s", "speedup"],
+           rows)
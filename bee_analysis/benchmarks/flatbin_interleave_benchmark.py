@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""
+Measure the read throughput of InterleavedFlatbinDatasets over many flatbin files.
+
+Each dataloader worker only opens the files (or file ranges) assigned to it, so the throughput
+should stay flat as the number of files grows. The table also shows the largest number of files
+that a single worker reads from.
+
+Example:
+> python3 benchmarks/flatbin_interleave_benchmark.py --files 8 16 32 --num_workers 0 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.flatbin_dataset as flatbin_dataset
+
+from benchmark_common import dropFromPageCache, makeSyntheticFlatbin, printTable, timeDataloader
+
+parser = argparse.ArgumentParser(description='Benchmark interleaved reading of many flatbin files.')
+parser.add_argument('--files', type=int, nargs='+', required=False, default=[8, 16, 32],
+    help="Numbers of files to interleave.")
+parser.add_argument('--samples', type=int, required=False, default=8000,
+    help="Total number of samples, split between the files.")
+parser.add_argument('--height', type=int, required=False, default=100)
+parser.add_argument('--width', type=int, required=False, default=100)
+parser.add_argument('--image_type', type=str, required=False, default="png", choices=["png", "raw"])
+parser.add_argument('--num_workers', type=int, nargs='+', required=False, default=[0, 2, 4])
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--dir', type=str, required=False, default=None,
+    help="Directory for the synthetic files. Defaults to a temporary directory.")
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+    rows = []
+    for num_files in args.files:
+        paths = []
+        for file_idx in range(num_files):
+            path = os.path.join(tmpdir, f"{num_files}_{file_idx}.bin")
+            entries = makeSyntheticFlatbin(path, args.samples // num_files, args.height, args.width,
+                    seed=file_idx, image_type=args.image_type)
+            paths.append(path)
+        for num_workers in args.num_workers:
+            for path in paths:
+                dropFromPageCache(path)
+            dataset = flatbin_dataset.InterleavedFlatbinDatasets(paths, entries)
+            files_per_worker = max(len(ranges) for ranges in dataset.workerRanges(max(1, num_workers)))
+            loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=num_workers)
+            samples, seconds = timeDataloader(loader)
+            rows.append([num_files, num_workers, files_per_worker, samples, f"{samples / seconds:.1f}"])
+    printTable(["files", "workers", "files/worker", "samples", "samples/s"], rows)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""
+Compare read throughput of png flatbin entries against raw uint8 entries, with and without block
+compression.
+
+Raw entries are returned as uint8 and are converted to floats once per batch, as the training loop
+does, so that conversion is included in the timing.
+
+Example:
+> python3 benchmarks/flatbin_raw_benchmark.py --samples 2000 --num_workers 2
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.flatbin_dataset as flatbin_dataset
+import utility.train_utility as train_utility
+
+from benchmark_common import (makeSyntheticFlatbin, printTable)
+
+parser = argparse.ArgumentParser(description='Benchmark png and raw flatbin entries.')
+parser.add_argument('--samples', type=int, required=False, default=2000)
+parser.add_argument('--height', type=int, required=False, default=400)
+parser.add_argument('--width', type=int, required=False, default=400)
+parser.add_argument('--frames', type=int, required=False, default=1)
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--num_workers', type=int, required=False, default=0)
+parser.add_argument('--block_samples', type=int, required=False, default=64)
+parser.add_argument('--device', type=str, required=False, default=None,
+    help="Device for the float conversion. Defaults to cuda if available.")
+args = parser.parse_args()
+
+device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+cases = [("png", None), ("raw", None), ("raw", "zlib")]
+for codec, module in [("lz4", "lz4"), ("zstd", "zstandard")]:
+    if importlib.util.find_spec(module) is not None:
+        cases.append(("raw", codec))
+    else:
+        print(f"Skipping {codec}, the {module} package is not installed.")
+
+rows = []
+with tempfile.TemporaryDirectory() as tmpdir:
+    for image_type, compression in cases:
+        path = os.path.join(tmpdir, f"{image_type}_{compression}.bin")
+        entries = makeSyntheticFlatbin(path, args.samples, args.height, args.width, args.frames,
+                image_type=image_type, compression=compression, block_samples=args.block_samples)
+        # Request the png names, as the training script does
+        desired = [f"{i}.png" for i in range(args.frames)] + ["cls"]
+        dataset = flatbin_dataset.FlatbinDataset(path, desired)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
+                num_workers=args.num_workers)
+        samples = 0
+        begin_time = time.perf_counter()
+        for batch in dataloader:
+            images = train_utility.imagesToFloat(batch[0].to(device))
+            samples += images.size(0)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - begin_time
+        rows.append([image_type, compression or "none", f"{os.path.getsize(path) / 2**20:.1f}",
+            f"{samples / seconds:.1f}"])
+
+printTable(["entry", "compression", "file MiB", "samples/s"], rows)
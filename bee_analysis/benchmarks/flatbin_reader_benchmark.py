@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+Compare the regular flatbin reader against the memory mapped reader.
+
+Reports samples per second and the resident memory of each reading process. With --concurrent the
+same file is read by several processes at once, as happens with dataloader workers or with several
+fold jobs on one node. Memory mapped pages show up as RssFile, which is shared through the page
+cache, while the regular reader copies everything into private (RssAnon) memory.
+
+Example:
+> python3 benchmarks/flatbin_reader_benchmark.py --samples 2000 --numpy_entry --concurrent 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.flatbin_dataset as flatbin_dataset
+
+from benchmark_common import (makeSyntheticFlatbin, memoryStatus, printTable, runIsolated, timeDataloader)
+
+parser = argparse.ArgumentParser(description='Benchmark the flatbin readers.')
+parser.add_argument('--path', type=str, required=False, default=None,
+    help="Existing flatbin file to read. A synthetic file is created if not provided.")
+parser.add_argument('--entries', type=str, nargs='+', required=False, default=None,
+    help="Entries to read. Defaults to every entry in the file.")
+parser.add_argument('--samples', type=int, required=False, default=2000,
+    help="Number of samples in the synthetic file.")
+parser.add_argument('--height', type=int, required=False, default=400)
+parser.add_argument('--width', type=int, required=False, default=400)
+parser.add_argument('--frames', type=int, required=False, default=1,
+    help="Number of png frames per synthetic sample.")
+parser.add_argument('--numpy_entry', required=False, default=False, action="store_true",
+    help="Add a raw uint8 tensor of the frames to the synthetic samples.")
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--epochs', type=int, required=False, default=2,
+    help="Passes through the data. Later passes read from a warm page cache.")
+parser.add_argument('--concurrent', type=int, required=False, default=1,
+    help="Number of processes reading the file at the same time.")
+args = parser.parse_args()
+
+
+def readFile(path, entries, use_mmap, batch_size, epochs):
+    dataset = flatbin_dataset.FlatbinDataset(path, entries, use_mmap=use_mmap)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=0)
+    total_samples = 0
+    total_time = 0.0
+    for _ in range(epochs):
+        samples, seconds = timeDataloader(dataloader)
+        total_samples += samples
+        total_time += seconds
+    return total_samples / total_time, memoryStatus()
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = args.path
+    if path is None:
+        path = os.path.join(tmpdir, "benchmark.bin")
+        entries = makeSyntheticFlatbin(path, args.samples, args.height, args.width, args.frames,
+                numpy_entry=args.numpy_entry)
+    else:
+        entries = flatbin_dataset.FlatbinDataset(path, []).header_names
+    if args.entries is not None:
+        entries = args.entries
+    print(f"Reading {entries} from {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+
+    rows = []
+    for use_mmap in [False, True]:
+        results = runIsolated(readFile, (path, entries, use_mmap, args.batch_size, args.epochs),
+                processes=args.concurrent)
+        rate = sum(result[0] for result in results) / len(results)
+        anon = sum(result[1].get("RssAnon", 0) for result in results)
+        shared = max(result[1].get("RssFile", 0) for result in results)
+        peak = max(result[1].get("VmHWM", 0) for result in results)
+        rows.append(["mmap" if use_mmap else "read", args.concurrent, f"{rate:.1f}",
+            f"{anon:.1f}", f"{shared:.1f}", f"{peak:.1f}"])
+    printTable(["reader", "procs", "samples/s/proc", "private MiB (sum)", "file MiB (shared)",
+        "peak RSS MiB"], rows)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""
+Compare the throughput and shuffle quality of the flatbin reading orders.
+
+The sequential reader is fastest but returns the same order every epoch. Random access through
+FlatbinMapDataset shuffles perfectly but needs a seek for every sample. Block shuffling reads blocks
+of consecutive samples in a random order and shuffles the samples of a pool of blocks.
+
+Shuffle quality is reported as the rank correlation between the read order and the stored order
+(0 is best) and as the mean distance of a sample from its stored position, relative to that of a
+uniform random permutation (1 is best).
+
+The file is dropped from the page cache before each run so that the reads come from storage.
+
+Example:
+> python3 benchmarks/flatbin_shuffle_benchmark.py --samples 5000 --blocks 16 64 256 --pools 4 16
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.flatbin_dataset as flatbin_dataset
+
+from benchmark_common import dropFromPageCache, makeSyntheticFlatbin, printTable
+
+parser = argparse.ArgumentParser(description='Benchmark block shuffled flatbin reading.')
+parser.add_argument('--samples', type=int, required=False, default=5000,
+    help="Number of samples in the synthetic file.")
+parser.add_argument('--height', type=int, required=False, default=200)
+parser.add_argument('--width', type=int, required=False, default=200)
+parser.add_argument('--dir', type=str, required=False, default=None,
+    help="Directory for the synthetic file, e.g. a network or spinning disk mount. Defaults to a "
+         "temporary directory.")
+parser.add_argument('--blocks', type=int, nargs='+', required=False, default=[16, 64, 256],
+    help="Block sizes, in samples, to test.")
+parser.add_argument('--pools', type=int, nargs='+', required=False, default=[1, 4, 16],
+    help="Pool sizes, in blocks, to test.")
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--num_workers', type=int, required=False, default=0)
+args = parser.parse_args()
+
+
+def shuffleQuality(order):
+    """Return the rank correlation with the stored order and the relative mean displacement."""
+    order = torch.tensor(order, dtype=torch.float64)
+    positions = torch.arange(len(order), dtype=torch.float64)
+    correlation = torch.corrcoef(torch.stack([order, positions]))[0, 1].item()
+    # The mean displacement of a uniform random permutation is about n/3
+    displacement = (order - positions).abs().mean().item() / (len(order) / 3)
+    return correlation, displacement
+
+
+def readOrder(path, dataset, sampler=None):
+    """Read one epoch. Returns the samples per second and the stored index of each sample read."""
+    dropFromPageCache(path)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, sampler=sampler,
+            num_workers=args.num_workers)
+    order = []
+    begin_time = time.perf_counter()
+    for batch in loader:
+        order.extend(batch[1].tolist())
+    return len(order) / (time.perf_counter() - begin_time), order
+
+
+with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+    path = os.path.join(tmpdir, "benchmark.bin")
+    makeSyntheticFlatbin(path, args.samples, args.height, args.width, index_entry=True)
+    entries = ["0.png", "index.int"]
+    print(f"Reading {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+
+    cases = [("sequential", flatbin_dataset.FlatbinDataset(path, entries), None)]
+    for block, pool in itertools.product(args.blocks, args.pools):
+        cases.append((f"block {block} pool {pool}",
+            flatbin_dataset.FlatbinDataset(path, entries, shuffle_block=block, shuffle_pool=pool), None))
+    random_access = flatbin_dataset.FlatbinMapDataset(path, entries)
+    cases.append(("random access", random_access, torch.utils.data.RandomSampler(random_access)))
+
+    rows = []
+    for name, dataset, sampler in cases:
+        rate, order = readOrder(path, dataset, sampler)
+        correlation, displacement = shuffleQuality(order)
+        rows.append([name, f"{rate:.1f}", f"{correlation:.3f}", f"{displacement:.3f}"])
+    printTable(["order", "samples/s", "correlation", "displacement"], rows)
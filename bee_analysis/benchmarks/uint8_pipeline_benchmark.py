@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+"""
+Compare loading images as floats against loading them as uint8 and converting them on the device.
+
+The float path decodes images to float32 in the dataloader workers, so four bytes per pixel pass
+through the worker queues and the host to device copy, then normalizes them on the device. The
+uint8 path passes one byte per pixel and does the conversion and normalization together with
+train_utility.prepareImages.
+
+Reports the image bytes per batch (what crosses the worker queues and the copy to the device), the
+loader throughput, and the time spent preparing each batch on the device.
+
+Example:
+> python3 benchmarks/uint8_pipeline_benchmark.py --samples 2000 --num_workers 2
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import torch
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.flatbin_dataset as flatbin_dataset
+import utility.train_utility as train_utility
+
+from benchmark_common import (makeSyntheticFlatbin, printTable)
+
+parser = argparse.ArgumentParser(description='Benchmark the float and uint8 image pipelines.')
+parser.add_argument('--samples', type=int, required=False, default=2000)
+parser.add_argument('--height', type=int, required=False, default=400)
+parser.add_argument('--width', type=int, required=False, default=400)
+parser.add_argument('--frames', type=int, required=False, default=1)
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+parser.add_argument('--num_workers', type=int, required=False, default=2)
+parser.add_argument('--device', type=str, required=False, default=None,
+    help="Training device. Defaults to cuda if available.")
+args = parser.parse_args()
+
+device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def synchronize():
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def oldPrepare(images):
+    return train_utility.normalizeImages(train_utility.imagesToFloat(images))
+
+
+def newPrepare(images):
+    return train_utility.prepareImages(images, normalize=True)
+
+
+rows = []
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, "benchmark.bin")
+    entries = makeSyntheticFlatbin(path, args.samples, args.height, args.width, args.frames)
+    for name, uint8_images, prepare in [("float", False, oldPrepare), ("uint8", True, newPrepare)]:
+        dataset = flatbin_dataset.FlatbinDataset(path, entries, uint8_images=uint8_images)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
+                num_workers=args.num_workers, pin_memory=device.startswith("cuda"))
+        samples = 0
+        batches = 0
+        image_bytes = 0
+        prepare_seconds = 0.0
+        begin_time = time.perf_counter()
+        for batch in dataloader:
+            images = torch.cat([batch[i].unsqueeze(1) if 3 == batch[i].dim() else batch[i]
+                                for i in range(args.frames)], dim=1)
+            image_bytes += images.nbytes
+            prepare_begin = time.perf_counter()
+            prepare(images.to(device))
+            synchronize()
+            prepare_seconds += time.perf_counter() - prepare_begin
+            samples += images.size(0)
+            batches += 1
+        seconds = time.perf_counter() - begin_time
+        rows.append([name, f"{image_bytes / batches / 2**20:.2f}", f"{samples / seconds:.1f}",
+            f"{1000 * prepare_seconds / batches:.2f}"])
+
+printTable(["images", "MiB/batch", "samples/s", "copy+prepare ms/batch"], rows)
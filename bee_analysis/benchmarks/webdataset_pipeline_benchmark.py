@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""
+Compare the webdataset pipeline of dataset_utility.makeDataset with the flatbin reader.
+
+The same synthetic samples are written to webdataset shards and to a flatbin file. Three readers
+are timed:
+  wds generic: the previous pipeline, the generic "l" decoder with the DataLoader collating samples
+  wds tuned:   makeDataset, which splits shards between workers, decodes only the requested pngs to
+               uint8, and batches inside of the workers
+  flatbin:     makeDataset on the flatbin file with uint8 images
+
+Example:
+> python3 benchmarks/webdataset_pipeline_benchmark.py --samples 4000 --shards 8 --num_workers 0 2
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import torch
+import webdataset as wds
+
+from PIL import Image
+
+# Allow running from the top level directory or from the benchmarks directory.
+sys.path.append('./')
+sys.path.append('../')
+
+import utility.dataset_utility as dataset_utility
+import utility.flatbin_dataset as flatbin_dataset
+
+from benchmark_common import makeSyntheticFrames, printTable, timeDataloader
+
+parser = argparse.ArgumentParser(description='Benchmark the webdataset pipeline against flatbin files.')
+parser.add_argument('--samples', type=int, required=False, default=4000)
+parser.add_argument('--shards', type=int, required=False, default=8)
+parser.add_argument('--height', type=int, required=False, default=200)
+parser.add_argument('--width', type=int, required=False, default=200)
+parser.add_argument('--shuffle', type=int, required=False, default=1000,
+    help="Shuffle buffer of the webdataset pipelines.")
+parser.add_argument('--num_workers', type=int, nargs='+', required=False, default=[0, 2, 4])
+parser.add_argument('--batch_size', type=int, required=False, default=32)
+args = parser.parse_args()
+
+
+def writeShards(directory, frames, labels):
+    """Write the samples into webdataset shards, also holding an unused image like a real dataset."""
+    paths = []
+    per_shard = -(-len(frames) // args.shards)
+    for shard in range(args.shards):
+        path = os.path.join(directory, f"shard{shard}.tar")
+        writer = wds.TarWriter(path, encoder=False)
+        for idx in range(shard * per_shard, min(len(frames), (shard + 1) * per_shard)):
+            buf = io.BytesIO()
+            Image.fromarray(frames[idx, 0].numpy()).save(buf, format="png")
+            writer.write({"__key__": f"sample{idx}", "0.png": buf.getvalue(), "unused.png": buf.getvalue(),
+                          "cls": str(labels[idx].item()).encode('utf-8'), "metadata.txt": b"synthetic"})
+        writer.close()
+        paths.append(path)
+    return paths
+
+
+rows = []
+with tempfile.TemporaryDirectory() as tmpdir:
+    generator = torch.Generator().manual_seed(0)
+    frames = makeSyntheticFrames(args.samples, args.height, args.width, generator=generator)
+    labels = torch.randint(1, 4, (args.samples,), generator=generator)
+    shards = writeShards(tmpdir, frames, labels)
+    binpath = os.path.join(tmpdir, "benchmark.bin")
+    flatbin_dataset.dataloaderToFlatbin([(frames[i:i + 64], labels[i:i + 64]) for i in range(0, args.samples, 64)],
+            ["0.png", "cls"], binpath, handlers={'cls': 'stoi'})
+    decode_strs = ["0.png", "cls"]
+
+    for num_workers in args.num_workers:
+        generic = (wds.WebDataset(shards, shardshuffle=len(shards)).shuffle(args.shuffle)
+                   .decode("l").to_tuple(*decode_strs))
+        readers = [
+            ("wds generic", torch.utils.data.DataLoader(generic, batch_size=args.batch_size,
+                                                        num_workers=num_workers)),
+            ("wds tuned", torch.utils.data.DataLoader(
+                dataset_utility.makeDataset(shards, decode_strs, shuffle=args.shuffle, shardshuffle=len(shards),
+                                            uint8_images=True, batch_size=args.batch_size),
+                batch_size=None, num_workers=num_workers)),
+            ("flatbin", torch.utils.data.DataLoader(
+                dataset_utility.makeDataset(binpath, decode_strs, uint8_images=True),
+                batch_size=args.batch_size, num_workers=num_workers)),
+        ]
+        for name, dataloader in readers:
+            samples, seconds = timeDataloader(dataloader)
+            rows.append([name, num_workers, samples, f"{samples / seconds:.1f}"])
+
+printTable(["reader", "workers", "samples", "samples/s"], rows)
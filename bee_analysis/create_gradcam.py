@@ -4,6 +4,8 @@ import os
 import torch
 import webdataset as wds
 
+from utility.dataloader_utility import availableCores
+
 # Import or define your models and GradCAM utility:
 #
 # from models.alexnet import AlexLikeNet
@@ -163,16 +165,17 @@ def run_gradcam(
     # plus a 'cls' label. Adjust the keys if your data is different.
     decode_strs = [f"{i}.png" for i in range(sample_frames)] + ["cls"]
 
+    # After distributed training only the first process makes GradCAM images, from every shard
     dataset = (
         wds.
-        WebDataset(dataset_path, shardshuffle=20000 // sample_frames).decode(
+        WebDataset(dataset_path, shardshuffle=20000 // sample_frames, nodesplitter=None).decode(
             "l")  # decode as grayscale images; adjust if you have color data
         .to_tuple(*decode_strs))
 
-    # We'll just load one small batch with `num_images` items:
+    # We'll just load one small batch with `num_images` items, without more workers than cores
     loader = torch.utils.data.DataLoader(dataset,
                                          batch_size=num_images,
-                                         num_workers=12)
+                                         num_workers=min(12, availableCores()))
 
     # --------------------------------------------------------------------------
     # 5. Forward pass and GradCAM
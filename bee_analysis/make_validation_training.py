@@ -23,11 +23,15 @@ import os
 import random
 import sys
 
+from utility.dataloader_utility import workerCount
+
 logging.basicConfig(
     format="%(asctime)s: %(message)s",
     level=logging.INFO,
     datefmt="%Y-%m-%d %H:%M:%S",
 )
+
+
 parser = argparse.ArgumentParser(description="Create k-fold validation sets.")
 
 parser.add_argument(
@@ -213,11 +217,29 @@ parser.add_argument(
 
 parser.add_argument(
     "--max-dataloader-workers",
-    type=int,
+    type=workerCount,
     default=3,
     required=False,
     help=
-    "The number of dataloader workers, default=3. Only works when the `--use-dataloader-workers` flag is passed.",
+    "The number of dataloader workers, default=3, or auto to measure the fastest number for the node. Only "
+    "works when the `--use-dataloader-workers` flag is passed.",
+)
+
+parser.add_argument(
+    "--multi-fold-training",
+    action="store_true",
+    default=False,
+    required=False,
+    help="Write a single training job that trains the models of every fold together (VidActRecTrain.py "
+    "--folds), reading the data once per epoch instead of once per fold.",
+)
+
+parser.add_argument(
+    "--distributed-training",
+    action="store_true",
+    default=False,
+    required=False,
+    help="Train with one process per GPU (see --gpus) instead of a single process.",
 )
 
 parser.add_argument(
@@ -237,6 +259,8 @@ parser.add_argument(
 )
 
 args = parser.parse_args()
+if args.multi_fold_training and args.distributed_training:
+    parser.error("--multi-fold-training cannot be combined with --distributed-training")
 
 # program_dir = "/research/projects/grail/rmartin/analysis-results/code/bee_analysis"
 program_dir = os.path.join(os.getcwd(), args.path_to_file)
@@ -259,8 +283,11 @@ training_only = args.training_only
 
 # command to run the evaluation and training program
 # <eval-set> <a-set> <b-set> ...
+trainLauncher = "python3"
+if args.distributed_training and 1 < args.gpus:
+    trainLauncher = f"torchrun --standalone --nproc_per_node {args.gpus}"
 trainCommand = (
-    f"python3 {trainProgram} --num_outputs {args.num_outputs}"
+    f"{trainLauncher} {trainProgram} --num_outputs {args.num_outputs}"
     f" --sample_frames {args.frames_per_sample} "
     f" --gradcam_cnn_model_layer {' '.join(args.gradcam_cnn_model_layer)} "
     f" --not_deterministic --epochs {args.epochs}"
@@ -274,7 +301,11 @@ if args.binary_training_optimization:
 if args.use_dataloader_workers:
     trainCommand += f" --num_workers {args.max_dataloader_workers} "
 
+if args.distributed_training and 1 < args.gpus:
+    trainCommand += " --distributed "
+
 # evaluation has to be last because it has to be placed adjacent to the tar files
+foldsCommand = trainCommand + " --folds "
 trainCommand+=  " --evaluate " 
 
 logging.info(f"dataset is {datacsvname}")
@@ -349,7 +380,35 @@ training_batch_file.write("cd " + currentDir + " \n")
 training_batch_file.write(
     "echo start-is: `date` \n \n")  # add start timestamp to training file
 
-for dataset_num in range(numOfSets):
+if args.multi_fold_training:
+    # One job trains the model of every fold, see VidActRecTrain.py --folds
+    train_job_filename = "train_folds.sh"
+    with open(train_job_filename, "w") as trainFile:
+        trainFile.write("#!/usr/bin/bash \n")
+        trainFile.write("source venv/bin/activate \n")
+        trainFile.write("# command to run \n \n")
+        trainFile.write("export TRAINPROGRAM=" + trainProgram + "\n")
+        trainFile.write("cd " + currentDir + " \n")
+        trainFile.write("echo start-is: `date` \n \n")  # add start timestamp
+        trainFile.write(foldsCommand + " " + " ".join(
+            f"{baseName}_{str(dataset_num)}.{'tar' if not args.binary_training_optimization else 'bin'}"
+            for dataset_num in range(numOfSets)) + "\n")
+        trainFile.write(
+            "chmod -R 777 gradcam_plots saliency_maps *.log >> /dev/null 2>&1 \n"
+        )
+        trainFile.write("echo end-is: `date` \n \n")  # add end timestamp
+    training_batch_file.write(
+        f"sbatch "
+        f"-G 1"
+        f" -c 8 "
+        f" -n 4 "
+        f" --mem=300G "
+        f" --time={args.time_to_run_training} "
+        f" -o {baseName}_trainlog_folds.log "
+        f"{train_job_filename} "
+        "\n")
+
+for dataset_num in range(0 if args.multi_fold_training else numOfSets):
     train_job_filename = "train" + "_" + str(dataset_num) + ".sh"
 
     # open the batch file that runs the testing and training commands
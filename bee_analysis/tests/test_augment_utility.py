@@ -0,0 +1,69 @@
+import torch
+
+from utility.augment_utility import BatchAugmenter
+
+
+def makeImages(batch_size=4, frames=3, channels=2, height=5, width=6):
+    """uint8 images where every pixel holds its own channel, row, and column."""
+    total = frames * channels
+    return torch.arange(total * height * width, dtype=torch.int64).remainder(251).to(torch.uint8).view(
+        1, total, height, width).repeat(batch_size, 1, 1, 1)
+
+
+def testDisabledAugmenter():
+    """Without any augmentation the same batch comes back."""
+    images = makeImages()
+    augmenter = BatchAugmenter()
+    assert not augmenter.enabled
+    assert augmenter(images, train_frames=3, sample_keys=torch.arange(4)) is images
+
+
+def testGeometricAugmentation():
+    """Flips, shifts, and frame dropout move pixels without changing their values or the image size."""
+    images = makeImages()
+    flipped = BatchAugmenter(hflip=1.0, vflip=1.0)(images, train_frames=3, sample_keys=torch.arange(4))
+    assert torch.equal(flipped, images.flip(-1).flip(-2))
+
+    shifted = BatchAugmenter(shift=2)(images, train_frames=3, sample_keys=torch.arange(4))
+    assert shifted.shape == images.shape and torch.uint8 == shifted.dtype
+    assert set(shifted.unique().tolist()) <= set(images.unique().tolist())
+
+    dropped = BatchAugmenter(frame_dropout=1.0)(images, train_frames=3, sample_keys=torch.arange(4))
+    # Every frame is replaced by the first, channel by channel
+    assert torch.equal(dropped, images[:, :2].repeat(1, 3, 1, 1))
+
+
+def testJitter():
+    """Brightness and contrast jitter returns floats from 0 to 1."""
+    images = makeImages()
+    jittered = BatchAugmenter(brightness=0.2, contrast=0.5)(images, train_frames=3, sample_keys=torch.arange(4))
+    assert jittered.is_floating_point()
+    assert 0.0 <= jittered.min() and jittered.max() <= 1.0
+    assert not torch.allclose(jittered, images.float() / 255.0)
+
+
+def testSeeding():
+    """A sample's augmentation depends on the seed, the epoch, and its key, not on its batch."""
+    images = makeImages(batch_size=16)
+    keys = torch.arange(100, 116)
+    augmenter = BatchAugmenter(shift=2, hflip=0.5, frame_dropout=0.5, brightness=0.1, seed=3)
+    first = augmenter(images, train_frames=3, sample_keys=keys)
+    assert torch.equal(first, BatchAugmenter(shift=2, hflip=0.5, frame_dropout=0.5, brightness=0.1, seed=3)(
+        images, train_frames=3, sample_keys=keys))
+    # The same samples in another order and in smaller batches
+    order = torch.randperm(16, generator=torch.Generator().manual_seed(0))
+    halves = [augmenter(images[part], train_frames=3, sample_keys=keys[part]) for part in order.split(8)]
+    assert torch.equal(first[order], torch.cat(halves))
+    assert not torch.equal(first, augmenter(images, train_frames=3, sample_keys=keys + 16))
+    augmenter.set_epoch(1)
+    assert not torch.equal(first, augmenter(images, train_frames=3, sample_keys=keys))
+
+
+def testHashUniforms():
+    """Hashed values are spread evenly over [0, 1)."""
+    from utility.augment_utility import hashUniforms
+    values = hashUniforms(torch.arange(10000), 3, seed=7)
+    assert (10000, 3) == values.shape
+    assert 0.0 <= values.min() and values.max() < 1.0
+    assert abs(values.mean().item() - 0.5) < 0.01
+    assert torch.equal(values, hashUniforms(torch.arange(10000), 3, seed=7))
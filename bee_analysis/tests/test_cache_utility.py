@@ -0,0 +1,65 @@
+import functools
+import pytest
+import torch
+
+import utility.cache_utility as cache_utility
+import utility.prefetch_utility as prefetch_utility
+
+
+def makeLoader(samples=30, batch_size=8):
+    """Dataloader of two uint8 frames, a label, and a metadata string per sample."""
+    images = torch.randint(0, 256, (samples, 2, 6, 8), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+    dataset = [(images[idx, 0], images[idx, 1], idx, f"sample {idx}") for idx in range(samples)]
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                       collate_fn=functools.partial(prefetch_utility.collateFrames, 2)), images
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def testDecodedCache(num_workers):
+    """Batches of the cache match the samples that were recorded, including from workers."""
+    loader, images = makeLoader()
+    builder = cache_utility.CacheBuilder(max_bytes=2**20, num_samples=30)
+    recorded = [batch[2] for batch in cache_utility.RecordingLoader(loader, builder)]
+    assert 30 == sum(len(labels) for labels in recorded)
+    cache = builder.finish()
+    assert 30 == len(cache)
+    assert cache.images.is_shared()
+
+    cached_loader = torch.utils.data.DataLoader(cache, batch_size=7, shuffle=True, num_workers=num_workers,
+                                                collate_fn=cache_utility.keepBatch)
+    seen = []
+    for batch in cached_loader:
+        assert isinstance(batch, prefetch_utility.PackedBatch)
+        for frame in range(2):
+            assert torch.equal(batch[frame], images[batch[2], frame])
+        assert [f"sample {idx}" for idx in batch[2].tolist()] == batch[3]
+        seen.extend(batch[2].tolist())
+    assert sorted(seen) == list(range(30))
+
+
+def testCacheBudget():
+    """Datasets larger than the budget are not cached, whether or not their size is known."""
+    loader, _ = makeLoader()
+    for num_samples in [30, None]:
+        builder = cache_utility.CacheBuilder(max_bytes=1000, num_samples=num_samples)
+        for batch in cache_utility.RecordingLoader(loader, builder):
+            pass
+        assert builder.failed
+        assert builder.finish() is None
+
+
+def testSpilledCache(tmp_path):
+    """A cache larger than the budget is memory mapped from the scratch directory, which is left empty."""
+    loader, images = makeLoader()
+    builder = cache_utility.CacheBuilder(max_bytes=1000, num_samples=30, spill_dir=str(tmp_path))
+    for batch in cache_utility.RecordingLoader(loader, builder):
+        pass
+    cache = builder.finish()
+    assert 30 == len(cache)
+    assert not cache.images.is_shared()
+    assert [] == list(tmp_path.iterdir())
+
+    batch = cache.__getitems__(list(range(30)))
+    assert torch.equal(batch[0], images[:, 0])
+    assert torch.equal(batch[1], images[:, 1])
+    assert list(range(30)) == batch[2].tolist()
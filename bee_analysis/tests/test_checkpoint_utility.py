@@ -0,0 +1,74 @@
+import os
+import pytest
+import torch
+
+import utility.checkpoint_utility as checkpoint_utility
+
+
+@pytest.mark.parametrize("async_save", [True, False])
+def testCheckpointManager(tmp_path, async_save):
+    """The newest, best, and last few checkpoints are kept, and saves are not changed by training."""
+    outname = os.path.join(tmp_path, "model.checkpoint")
+    manager = checkpoint_utility.CheckpointManager(outname, keep_last=2, async_save=async_save)
+    weights = torch.zeros(3)
+    for epoch, metric in enumerate([3.0, 1.0, 2.0, 4.0]):
+        weights += 1
+        manager.save({"model_dict": {"weights": weights}, "step": epoch}, epoch, metric)
+        # Training continues to update the weights while the checkpoint is written
+        weights += 100
+    manager.close()
+
+    assert checkpoint_utility.listEpochCheckpoints(outname) == [2, 3]
+    newest = torch.load(outname, weights_only=False)
+    assert 3 == newest["epoch"] and 3 == newest["step"]
+    assert torch.equal(newest["model_dict"]["weights"], torch.full((3,), 304.0))
+    best = torch.load(checkpoint_utility.bestCheckpointName(outname), weights_only=False)
+    assert 1 == best["epoch"] and 1.0 == best["metric"]
+    assert 4 == manager.saves
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+
+def testResume(tmp_path):
+    """Resuming skips damaged checkpoints and continues the retention and best metric."""
+    outname = os.path.join(tmp_path, "model.checkpoint")
+    manager = checkpoint_utility.CheckpointManager(outname, keep_last=2)
+    for epoch in range(2):
+        manager.save({"step": epoch}, epoch, 5.0 - epoch)
+    manager.close()
+    # A checkpoint that was cut off by a crash while it was written without the manager
+    with open(checkpoint_utility.epochCheckpointName(outname, 2), "wb") as damaged:
+        damaged.write(b"PK\x03\x04")
+
+    path, checkpoint = checkpoint_utility.findLatestCheckpoint(outname)
+    assert path == checkpoint_utility.epochCheckpointName(outname, 1)
+    assert 1 == checkpoint["epoch"]
+
+    resumed = checkpoint_utility.CheckpointManager(outname, keep_last=2)
+    resumed.restore()
+    assert 4.0 == resumed.best_metric
+    resumed.save({"step": 2}, 2, 4.5)
+    resumed.save({"step": 3}, 3, 3.0)
+    resumed.close()
+    assert checkpoint_utility.listEpochCheckpoints(outname) == [2, 3]
+    assert 3 == torch.load(checkpoint_utility.bestCheckpointName(outname), weights_only=False)["epoch"]
+    assert (None, None) == checkpoint_utility.findLatestCheckpoint(os.path.join(tmp_path, "other.checkpoint"))
+
+
+def testProgressCheckpoint(tmp_path):
+    """A progress checkpoint is resumed from until the checkpoint at the end of its epoch replaces it."""
+    outname = os.path.join(tmp_path, "model.checkpoint")
+    manager = checkpoint_utility.CheckpointManager(outname)
+    manager.save({"step": 0}, 0, 1.0)
+    manager.saveProgress({"step": 1}, 1, {0: 8, 1: 4}, num_workers=2)
+    manager.wait()
+    path, checkpoint = checkpoint_utility.findLatestCheckpoint(outname)
+    assert path == checkpoint_utility.progressCheckpointName(outname)
+    assert 1 == checkpoint["epoch"] and {0: 8, 1: 4} == checkpoint["cursor"]
+    assert {"num_workers": 2, "world_size": 1} == checkpoint["readers"]
+
+    manager.save({"step": 2}, 1, 1.0)
+    manager.close()
+    assert not os.path.exists(checkpoint_utility.progressCheckpointName(outname))
+    path, checkpoint = checkpoint_utility.findLatestCheckpoint(outname)
+    assert path == checkpoint_utility.epochCheckpointName(outname, 1)
+    assert "cursor" not in checkpoint
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+import utility.cpu_utility as cpu_utility
+import utility.model_utility as model_utility
+import utility.train_utility as train_utility
+
+
+def countBatchNorms(net):
+    return sum(isinstance(module, torch.nn.BatchNorm2d) for module in net.modules())
+
+
+def testFuseConvBatchNorm():
+    """The fused copy evaluates like the original and the original is unchanged."""
+    torch.manual_seed(0)
+    net = model_utility.createModel("resnet18", 1, 64, 64, 3, device="cpu")
+    # Give the BatchNorm layers running statistics that are not the identity
+    with torch.no_grad():
+        for _ in range(3):
+            net(torch.rand(8, 1, 64, 64))
+    net.eval()
+    fused = cpu_utility.fuseConvBatchNorm(net)
+    assert countBatchNorms(fused) < countBatchNorms(net)
+    assert not fused.training
+    images = torch.rand(4, 1, 64, 64)
+    with torch.no_grad():
+        torch.testing.assert_close(fused(images), net(images), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.skipif(not cpu_utility.bf16Supported("cpu"), reason="Needs native bfloat16 support")
+def testBf16Update():
+    """Training steps with bfloat16 autocast keep float32 weights and reduce the loss."""
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Conv2d(1, 4, 3), torch.nn.Flatten(), torch.nn.Linear(4 * 6 * 6, 3))
+    net = net.to(memory_format=torch.channels_last)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+    images = torch.rand(16, 1, 8, 8)
+    labels = torch.randint(0, 3, (16,))
+    losses = []
+    for _ in range(20):
+        out, loss = train_utility.updateWithoutScaler(torch.nn.CrossEntropyLoss(), net, images, None, labels,
+                                                      optimizer, torch.bfloat16)
+        assert out.dtype == torch.bfloat16
+        losses.append(loss.item())
+    assert all(param.dtype == torch.float32 for param in net.parameters())
+    assert losses[-1] < losses[0]
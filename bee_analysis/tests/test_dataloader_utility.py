@@ -0,0 +1,52 @@
+import functools
+import json
+import os
+import pytest
+import socket
+import torch
+
+import utility.dataloader_utility as dataloader_utility
+import utility.prefetch_utility as prefetch_utility
+
+
+def testCandidateSettings():
+    assert [(0, None)] == dataloader_utility.candidateSettings(0)
+    workers = sorted({workers for workers, _ in dataloader_utility.candidateSettings(6)})
+    assert [0, 1, 2, 4, 6] == workers
+    assert {2, 4} == {prefetch for workers, prefetch in dataloader_utility.candidateSettings(6) if 0 < workers}
+
+
+class UnreadableDataset(torch.utils.data.Dataset):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, idx):
+        raise RuntimeError("Cached settings should not read the dataset")
+
+
+def testTuneLoader(tmp_path):
+    """The fastest setting is measured once and then read from the cache for the host and format."""
+    cache_path = os.path.join(tmp_path, "settings.json")
+    dataset = torch.utils.data.TensorDataset(torch.zeros(200, 1, 4, 4), torch.arange(200))
+    loader_args = {"batch_size": 8, "collate_fn": functools.partial(prefetch_utility.collateFrames, 1)}
+    settings = dataloader_utility.tuneLoader(dataset, "tensors", "cpu", max_workers=1, max_seconds=0.2,
+                                             cache_path=cache_path, **loader_args)
+    assert settings["num_workers"] in [0, 1]
+    assert not settings["pin_memory"]
+    with open(cache_path) as cache_file:
+        cache = json.load(cache_file)
+    key = f"{socket.gethostname()}/tensors"
+    assert settings["num_workers"] == cache[key]["num_workers"]
+    assert 0 < cache[key]["samples_per_second"]
+
+    cached = dataloader_utility.tuneLoader(UnreadableDataset(), "tensors", "cpu", cache_path=cache_path,
+                                           **loader_args)
+    assert settings == cached
+
+
+def testWorkerCount():
+    """Worker counts are numbers or auto."""
+    assert 4 == dataloader_utility.workerCount("4")
+    assert "auto" == dataloader_utility.workerCount("auto")
+    with pytest.raises(ValueError):
+        dataloader_utility.workerCount("many")
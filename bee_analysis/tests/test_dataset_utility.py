@@ -0,0 +1,69 @@
+import io
+import numpy
+import os
+import pytest
+import torch
+import webdataset as wds
+
+from PIL import Image
+
+import utility.dataset_utility as dataset_utility
+
+
+def writeShards(tmp_path, shards=3, samples=10):
+    """Write webdataset shards whose single pixel images hold the index of each sample."""
+    paths = []
+    for shard in range(shards):
+        path = os.path.join(tmp_path, f"shard{shard}.tar")
+        writer = wds.TarWriter(path, encoder=False)
+        for idx in range(shard * samples, (shard + 1) * samples):
+            buf = io.BytesIO()
+            Image.fromarray(numpy.full((4, 5), idx, dtype=numpy.uint8)).save(buf, format="png")
+            writer.write({"__key__": f"sample{idx}", "0.png": buf.getvalue(), "unused.png": buf.getvalue(),
+                          "cls": str(idx % 3).encode('utf-8')})
+        writer.close()
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def testWebdatasetPipeline(tmp_path, num_workers):
+    """Shards are split between workers, images are decoded to uint8, and batches come from the workers."""
+    paths = writeShards(tmp_path)
+    dataset = dataset_utility.makeDataset(paths, ["0.png", "cls"], shuffle=8, shardshuffle=3,
+                                          uint8_images=True, batch_size=4)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    indices = []
+    for images, labels in dataloader:
+        assert images.dtype == torch.uint8
+        assert images.shape[1:] == (1, 4, 5)
+        assert len(images) <= 4
+        batch_indices = images[:, 0, 0, 0].to(torch.long)
+        assert (labels == batch_indices % 3).all()
+        indices.extend(batch_indices.tolist())
+    assert sorted(indices) == list(range(30))
+    # The shuffle buffer mixes the samples
+    assert indices != list(range(30))
+
+    images, _ = next(iter(dataset_utility.makeDataset(paths, ["0.png", "cls"])))
+    assert images.dtype == torch.float
+    assert images.max() <= 1.0
+
+
+def testWebdatasetSourceIndex(tmp_path):
+    """Webdataset samples can carry the index of their shard."""
+    paths = writeShards(tmp_path)
+    dataset = dataset_utility.makeDataset(paths, ["0.png", "cls"], uint8_images=True, batch_size=4,
+                                          source_index=True)
+    for images, _, sources in torch.utils.data.DataLoader(dataset, batch_size=None):
+        assert (torch.as_tensor(sources) == images[:, 0, 0, 0].to(torch.long) // 10).all()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def testComputeVectorStatistics(tmp_path, num_workers):
+    """Label statistics from a webdataset match those of the labels that were written."""
+    paths = writeShards(tmp_path)
+    stats = dataset_utility.computeVectorStatistics(paths, ["cls"], 1, batch_size=4, num_workers=num_workers)
+    labels = torch.arange(30, dtype=torch.float64) % 3
+    torch.testing.assert_close(stats.mean(), labels.mean().reshape(1))
+    torch.testing.assert_close(stats.variance(), labels.var(unbiased=False).reshape(1))
@@ -0,0 +1,103 @@
+import os
+import socket
+import torch
+
+import utility.distributed_utility as distributed_utility
+import utility.eval_utility as eval_utility
+import utility.flatbin_dataset as flatbin_dataset
+import utility.train_utility as train_utility
+
+from test_flatbin_dataset import writeTestFile
+
+WORLD_SIZE = 2
+
+
+def joinGroup(rank, port):
+    """Join a gloo process group of WORLD_SIZE processes on the cpu."""
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port), "RANK": str(rank),
+                       "WORLD_SIZE": str(WORLD_SIZE), "LOCAL_RANK": str(rank)})
+    # The test has to run the same way with or without a gpu
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    distributed_utility.initDistributed()
+
+
+def freePort():
+    """Return a port for the process group."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def runRank(rank, port, binpath, results):
+    """Join a gloo process group, reduce statistics, and read this rank's share of a flatbin file."""
+    joinGroup(rank, port)
+    try:
+        cmatrix = eval_utility.ConfusionMatrix(3)
+        # Rank 0 predicts class 0 correctly twice, rank 1 mistakes class 2 for class 1 once
+        if 0 == rank:
+            cmatrix.update(torch.tensor([[1., 0., 0.], [1., 0., 0.]]), torch.tensor([[1, 0, 0], [1, 0, 0]]))
+        else:
+            cmatrix.update(torch.tensor([[0., 1., 0.]]), torch.tensor([[0, 0, 1]]))
+        distributed_utility.reduceStats(cmatrix)
+        mean = distributed_utility.reduceMean(float(rank + 1) * 10, rank + 1)
+        labels = [int(sample[0]) for sample in flatbin_dataset.FlatbinDataset(binpath, ["cls"])]
+        results[rank] = (cmatrix.cmatrix, cmatrix.correct_count, mean, distributed_utility.isMainProcess(),
+                         labels)
+    finally:
+        distributed_utility.cleanupDistributed()
+
+
+def testReduceAndShard(tmp_path):
+    """Statistics are merged across processes and every sample is read by exactly one process."""
+    binpath = str(tmp_path / "data.bin")
+    writeTestFile(binpath, samples=10)
+    all_labels = [int(sample[0]) for sample in flatbin_dataset.FlatbinDataset(binpath, ["cls"])]
+    results = torch.multiprocessing.Manager().dict()
+    torch.multiprocessing.spawn(runRank, args=(freePort(), binpath, results), nprocs=WORLD_SIZE)
+    for rank in range(WORLD_SIZE):
+        cmatrix, correct_count, mean, is_main, _ = results[rank]
+        assert cmatrix == [[2, 0, 0], [0, 0, 0], [0, 1, 0]]
+        assert correct_count == 2
+        # (10 + 20) / (1 + 2)
+        assert abs(mean - 10.0) < 1e-9
+        assert is_main == (0 == rank)
+    read_labels = results[0][4] + results[1][4]
+    assert sorted(read_labels) == sorted(all_labels)
+    assert 0 < len(results[0][4]) and 0 < len(results[1][4])
+
+
+def runTrainingRank(rank, port, results):
+    """Train a DistributedDataParallel model for an epoch on this rank's share of 15 samples."""
+    joinGroup(rank, port)
+    try:
+        torch.manual_seed(0)
+        images = torch.randint(0, 256, (15, 1, 4, 4), dtype=torch.uint8)
+        labels = torch.randint(0, 3, (15,))
+        # Rank 0 has 5 batches and rank 1 has 3, so rank 1 joins early
+        begin, end = (0, 9) if 0 == rank else (9, 15)
+        batches = [(images[idx:min(idx + 2, end)], labels[idx:min(idx + 2, end)]) for idx in range(begin, end, 2)]
+        # Different initial weights on each rank, which DistributedDataParallel replaces with those of rank 0
+        torch.manual_seed(rank)
+        net = torch.nn.parallel.DistributedDataParallel(
+            torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 3)))
+        optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+        label_handler = train_utility.LabelHandler(3, slice(1, 2))
+        label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(labels, num_classes=3))
+        loss = train_utility.trainEpoch(net, optimizer, None, label_handler, eval_utility.ConfusionMatrix(3), batches,
+                                        vector_range=slice(2, 2), train_frames=1, normalize_images=False,
+                                        loss_fn=torch.nn.CrossEntropyLoss(), nn_postprocess=lambda x: x,
+                                        skip_metadata=True, device="cpu")
+        results[rank] = ([param.detach().clone() for param in net.module.parameters()], loss)
+    finally:
+        distributed_utility.cleanupDistributed()
+
+
+def testDistributedTraining():
+    """Ranks with different numbers of batches finish the epoch with the same weights and mean loss."""
+    results = torch.multiprocessing.Manager().dict()
+    torch.multiprocessing.spawn(runTrainingRank, args=(freePort(), results), nprocs=WORLD_SIZE)
+    params, loss = results[0]
+    other_params, other_loss = results[1]
+    for param, other_param in zip(params, other_params):
+        torch.testing.assert_close(param, other_param, rtol=0, atol=0)
+    assert loss == other_loss
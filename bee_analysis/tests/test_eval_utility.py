@@ -0,0 +1,74 @@
+import os
+import pytest
+import torch
+
+from utility.eval_utility import BatchedOnlineStatistics, OnlineStatistics, WorstExamples
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 100])
+def testBatchedOnlineStatistics(batch_size):
+    """Batched statistics match one scalar OnlineStatistics per element."""
+    generator = torch.Generator().manual_seed(0)
+    values = torch.randn(100, 3, generator=generator, dtype=torch.float64) * torch.tensor([1.0, 50.0, 1e-3]) + 1e4
+    values[5, 1] = float("nan")
+    scalar = [OnlineStatistics() for _ in range(3)]
+    for row in values.tolist():
+        for value, stat in zip(row, scalar):
+            stat.sample(value)
+
+    batched = BatchedOnlineStatistics(3)
+    for begin in range(0, len(values), batch_size):
+        batched.sample(values[begin:begin + batch_size])
+    assert batched.population().tolist() == [100, 99, 100]
+    torch.testing.assert_close(batched.mean(), torch.tensor([stat.mean() for stat in scalar], dtype=torch.float64))
+    torch.testing.assert_close(batched.variance(),
+                               torch.tensor([stat.variance() for stat in scalar], dtype=torch.float64))
+    assert batched.max().tolist() == [stat.max() for stat in scalar]
+
+
+def testBatchedOnlineStatisticsMerge():
+    """Merging the statistics of parts of the population gives the statistics of the whole."""
+    values = torch.arange(30, dtype=torch.float64).reshape(15, 2) ** 2
+    whole, first, second, empty = (BatchedOnlineStatistics(2) for _ in range(4))
+    whole.sample(values)
+    first.sample(values[:4])
+    second.sample(values[4:])
+    first.merge(empty)
+    first.merge(second)
+    empty.merge(first)
+    for merged in [first, empty]:
+        torch.testing.assert_close(merged.mean(), whole.mean())
+        torch.testing.assert_close(merged.variance(), whole.variance())
+        torch.testing.assert_close(merged.max(), whole.max())
+    assert BatchedOnlineStatistics(2).variance().isnan().all()
+
+
+@pytest.mark.parametrize("worst_mode", [True, False])
+@pytest.mark.parametrize("with_indices", [True, False])
+def testWorstExamples(tmp_path, worst_mode, with_indices):
+    """Batched tests keep the examples with the largest (or smallest) errors of each class."""
+    generator = torch.Generator().manual_seed(0)
+    labels = torch.nn.functional.one_hot(torch.randint(0, 3, (50,), generator=generator), 3).float()
+    outputs = torch.rand(50, 3, generator=generator)
+    images = torch.randint(0, 256, (50, 1, 4, 5), dtype=torch.uint8, generator=generator)
+    # The reader returns samples that begin with the image, like a FlatbinMapDataset
+    reader = [(images[index].numpy(), index) for index in range(50)]
+    examples = WorstExamples(os.path.join(tmp_path, "worst"), ["0", "1", "2"], 4, worst_mode=worst_mode,
+                             reader=reader if with_indices else None)
+    for begin in range(0, 50, 8):
+        rows = slice(begin, begin + 8)
+        indices = torch.arange(50)[rows] if with_indices else None
+        examples.testBatch(labels[rows], outputs[rows], images[rows],
+                           [f",,sample_{index}" for index in range(begin, min(50, begin + 8))], indices)
+
+    errors = (labels - outputs).abs()
+    for label_position, nodes in enumerate(examples.worstn):
+        expected = errors[:, label_position].topk(4, largest=worst_mode).indices.tolist()
+        assert sorted(int(node.metadata.split("_")[1]) for node in nodes) == sorted(expected)
+        assert all((node.image is None) == with_indices for node in nodes)
+    examples.save()
+    for node in examples.worstn[0]:
+        index = int(node.metadata.split("_")[1])
+        assert torch.equal(node.image, images[index])
+        assert node.label == labels[index].tolist()
+    assert 12 == len(os.listdir(os.path.join(tmp_path, "worst")))
@@ -0,0 +1,309 @@
+import numpy
+import os
+import pytest
+import torch
+
+import utility.flatbin_dataset as flatbin_dataset
+
+
+def makeBatches(samples=10, height=12, width=16, batch_size=4, seed=0):
+    """Make batches of frames, class labels, and a raw tensor for writing with dataloaderToFlatbin."""
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.randint(0, 256, (samples, 1, height, width), dtype=torch.uint8, generator=generator)
+    labels = torch.randint(1, 4, (samples,), generator=generator)
+    vectors = torch.rand((samples, 2, 3), generator=generator)
+    return [(images[i:i+batch_size], labels[i:i+batch_size], vectors[i:i+batch_size])
+            for i in range(0, samples, batch_size)]
+
+
+ENTRIES = ["0.png", "cls", "vector.numpy"]
+
+
+def writeTestFile(path, samples=10, **kwargs):
+    batches = makeBatches(samples=samples)
+    flatbin_dataset.dataloaderToFlatbin(batches, ENTRIES, path, handlers={'cls': 'stoi'}, **kwargs)
+    return batches
+
+
+def checkSamples(read_samples, batches):
+    expected = [(b[0][i], b[1][i], b[2][i]) for b in batches for i in range(len(b[0]))]
+    assert len(read_samples) == len(expected)
+    for (image, label, vector), (e_image, e_label, e_vector) in zip(read_samples, expected):
+        numpy.testing.assert_allclose(numpy.asarray(image), e_image.numpy() / 255.0, rtol=1e-6)
+        assert int(label) == e_label.item()
+        numpy.testing.assert_array_equal(numpy.asarray(vector), e_vector.numpy())
+
+
+def testRoundTrip(tmp_path):
+    """Samples written by dataloaderToFlatbin should be read back unchanged."""
+    path = os.path.join(tmp_path, "test.bin")
+    batches = writeTestFile(path)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES)
+    assert len(dataset) == 10
+    checkSamples(list(dataset), batches)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def testUint8Images(tmp_path, use_mmap):
+    """With uint8_images the png images are returned as their stored values."""
+    path = os.path.join(tmp_path, "test.bin")
+    batches = writeTestFile(path)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES, use_mmap=use_mmap, uint8_images=True)
+    expected = torch.cat([batch[0] for batch in batches])
+    for (image, _, _), expected_image in zip(dataset, expected):
+        assert image.dtype == numpy.uint8
+        numpy.testing.assert_array_equal(image, expected_image.numpy())
+
+
+def testMmapReader(tmp_path):
+    """The memory mapped reader returns the same data, with tensors as views into the mapping."""
+    path = os.path.join(tmp_path, "test.bin")
+    batches = writeTestFile(path)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES, use_mmap=True)
+    samples = list(dataset)
+    checkSamples(samples, batches)
+    mapping = dataset.getMapping()
+    map_begin = mapping.ctypes.data
+    vector = samples[3][2]
+    assert isinstance(vector, torch.Tensor)
+    assert map_begin <= vector.data_ptr() < map_begin + mapping.size
+
+    # Only a subset of the entries, in a different order
+    subset = list(flatbin_dataset.FlatbinDataset(path, ["cls", "0.png"], use_mmap=True))
+    assert [s[0] for s in subset] == [s[1] for s in samples]
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def testRawImages(tmp_path, compression, use_mmap):
+    """Raw entries are returned as uint8 frames and can be requested by their png name."""
+    path = os.path.join(tmp_path, "test.bin")
+    batches = makeBatches(samples=11)
+    entries = ["0.raw", "cls", "vector.numpy"]
+    flatbin_dataset.dataloaderToFlatbin(batches, entries, path, handlers={'cls': 'stoi'},
+            compression=compression, block_samples=4)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES, use_mmap=use_mmap)
+    assert dataset.getDataSize(0) == (1, 12, 16)
+    samples = list(dataset)
+    for sample, expected in zip(samples, [b[0][i] for b in batches for i in range(len(b[0]))]):
+        assert sample[0].dtype == numpy.uint8 or sample[0].dtype == torch.uint8
+        numpy.testing.assert_array_equal(numpy.asarray(sample[0]), expected.numpy())
+    assert [s[1] for s in samples] == [l.item() for b in batches for l in b[1]]
+
+    # Blocks are divided between dataloader workers
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=3, num_workers=2)
+    labels = torch.cat([batch[1] for batch in dataloader])
+    assert sorted(labels.tolist()) == sorted(s[1] for s in samples)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def testColumnLayout(tmp_path, compression, use_mmap):
+    """Version 2 files store the labels as a column and return the same samples as version 1."""
+    path = os.path.join(tmp_path, "test.bin")
+    batches = writeTestFile(path, compression=compression, block_samples=3, layout_version=2)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES, use_mmap=use_mmap)
+    assert dataset.getPatchInfo()['flatbin_version'] == 2
+    assert "cls" in dataset.columns
+    checkSamples(list(dataset), batches)
+
+    labels = torch.cat([batch[1] for batch in batches]).numpy()
+    numpy.testing.assert_array_equal(dataset.readColumn("cls"), labels)
+    # Version 1 files return the same column by scanning the samples
+    v1_path = os.path.join(tmp_path, "v1.bin")
+    writeTestFile(v1_path, compression=compression, block_samples=3)
+    v1_dataset = flatbin_dataset.FlatbinDataset(v1_path, ENTRIES, use_mmap=use_mmap)
+    numpy.testing.assert_array_equal(v1_dataset.readColumn("cls"), labels)
+
+    interleaved = flatbin_dataset.InterleavedFlatbinDatasets([path, v1_path], ["cls"])
+    numpy.testing.assert_array_equal(interleaved.readColumn("cls"), numpy.concatenate([labels, labels]))
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def testMapDataset(tmp_path, compression, use_mmap):
+    """The map-style dataset returns samples by index across files and works with samplers."""
+    paths = [os.path.join(tmp_path, f"test{i}.bin") for i in range(2)]
+    batches = writeTestFile(paths[0], compression=compression, block_samples=3)
+    writeTestFile(paths[1], samples=7, compression=compression, block_samples=3, layout_version=2)
+    dataset = flatbin_dataset.FlatbinMapDataset(paths, ENTRIES, use_mmap=use_mmap)
+    assert len(dataset) == 17
+
+    checkSamples([dataset[i] for i in range(10)], batches)
+    # A batch is returned in the requested order, including repeated indices
+    order = [9, 2, 12, 2, 0, 16]
+    batch = dataset.__getitems__(order)
+    for sample, index in zip(batch, order):
+        numpy.testing.assert_array_equal(numpy.asarray(sample[2]), numpy.asarray(dataset[index][2]))
+        assert sample[1] == dataset[index][1]
+    with pytest.raises(IndexError):
+        dataset[17]
+
+    # Each replica of a DistributedSampler reads its own part of the dataset
+    all_labels = dataset.readColumn("cls").tolist()
+    replica_indices = []
+    for rank in range(2):
+        sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=2, rank=rank, shuffle=True, seed=1)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=4, sampler=sampler, num_workers=2)
+        labels = torch.cat([batch[1] for batch in loader]).tolist()
+        assert labels == [all_labels[index] for index in sampler]
+        replica_indices += list(sampler)
+    assert set(replica_indices) == set(range(len(dataset)))
+
+
+def testOffsetsWithoutFooter(tmp_path):
+    """Files without an offsets footer are indexed by reading the size fields of each sample."""
+    path = os.path.join(tmp_path, "test.bin")
+    writeTestFile(path)
+    dataset = flatbin_dataset.FlatbinDataset(path, ENTRIES)
+    offsets = dataset.readOffsets()
+    assert len(offsets) == 11
+    with open(path, "rb") as binfile:
+        footer_begin = flatbin_dataset.read_footer(binfile)['offsets'][0]
+    with open(path, "r+b") as binfile:
+        binfile.truncate(footer_begin)
+    numpy.testing.assert_array_equal(dataset.readOffsets(), offsets)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def testBlockShuffle(tmp_path, compression):
+    """Block shuffling returns every sample once, in an order that depends on the seed and epoch."""
+    path = os.path.join(tmp_path, "test.bin")
+    images = torch.randint(0, 256, (40, 1, 6, 8), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+    batches = [(images[i:i+8], torch.arange(i, i+8)) for i in range(0, 40, 8)]
+    flatbin_dataset.dataloaderToFlatbin(batches, ["0.png", "index.int"], path,
+            compression=compression, block_samples=4)
+
+    def readOrder(dataset, num_workers=0):
+        loader = torch.utils.data.DataLoader(dataset, batch_size=5, num_workers=num_workers)
+        return torch.cat([batch[1] for batch in loader]).tolist()
+
+    dataset = flatbin_dataset.FlatbinDataset(path, ["0.png", "index.int"], shuffle_block=4, shuffle_pool=3)
+    first = readOrder(dataset)
+    assert sorted(first) == list(range(40))
+    assert first != list(range(40))
+    assert readOrder(dataset) == first
+    dataset.set_epoch(1)
+    assert readOrder(dataset) != first
+    assert sorted(readOrder(dataset, num_workers=2)) == list(range(40))
+
+    # The images still belong to their samples
+    mapped = flatbin_dataset.FlatbinDataset(path, ["0.png", "index.int"], use_mmap=True, shuffle_block=4)
+    for image, index in mapped:
+        numpy.testing.assert_allclose(numpy.asarray(image), images[index].numpy() / 255.0, rtol=1e-6)
+
+
+def writeIndexFiles(tmp_path, sizes, compression=None):
+    """Write files whose samples hold a unique index. Returns the paths and the indices of each file."""
+    paths, indices = [], []
+    first = 0
+    for file_idx, size in enumerate(sizes):
+        path = os.path.join(tmp_path, f"index{file_idx}.bin")
+        values = torch.arange(first, first + size)
+        flatbin_dataset.dataloaderToFlatbin([(values,)], ["index.int"], path, compression=compression,
+                block_samples=4)
+        paths.append(path)
+        indices.append(values.tolist())
+        first += size
+    return paths, indices
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("num_workers", [1, 2, 5])
+def testInterleavedSharding(tmp_path, compression, num_workers):
+    """Each worker reads its own ranges of the files and together they read every sample once."""
+    paths, indices = writeIndexFiles(tmp_path, [13, 3, 30], compression)
+    dataset = flatbin_dataset.InterleavedFlatbinDatasets(paths, ["index.int"])
+    ranges = dataset.workerRanges(num_workers)
+    assert len(ranges) == num_workers
+    covered = sorted(index for worker in ranges for file_idx, begin, end in worker
+                     for index in indices[file_idx][begin:end])
+    assert covered == list(range(46))
+    if compression is not None:
+        # Files are only split between workers at block boundaries
+        assert all(begin % 4 == 0 for worker in ranges for _, begin, _ in worker)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=num_workers)
+    first = torch.cat([batch[0] for batch in loader]).tolist()
+    assert sorted(first) == list(range(46))
+    dataset.set_epoch(1)
+    second = torch.cat([batch[0] for batch in loader]).tolist()
+    assert sorted(second) == list(range(46))
+    assert first != second
+
+
+def testInterleavedWeights(tmp_path):
+    """Weighted files are drawn from more often until they run out, files with no weight are not read."""
+    paths, indices = writeIndexFiles(tmp_path, [100, 100, 100])
+    dataset = flatbin_dataset.InterleavedFlatbinDatasets(paths, ["index.int"], weights=[8, 1, 0])
+    order = [sample[0] for sample in dataset]
+    assert sorted(order) == indices[0] + indices[1]
+    early = order[:50]
+    assert sum(index < 100 for index in early) > 35
+
+    with pytest.raises(ValueError):
+        flatbin_dataset.InterleavedFlatbinDatasets(paths, ["index.int"], weights=[1])
+
+
+def testInterleavedSourceIndex(tmp_path):
+    """Samples can carry the index of the file that they came from."""
+    paths, indices = writeIndexFiles(tmp_path, [5, 7, 3])
+    dataset = flatbin_dataset.InterleavedFlatbinDatasets(paths, ["index.int"], source_index=True)
+    for index, file_idx in dataset:
+        assert index in indices[file_idx]
+    assert sorted(index for index, _ in dataset) == list(range(15))
+
+
+def testMapSampleIndex(tmp_path):
+    """Map style samples can carry their index, which reads the same sample again."""
+    paths, _ = writeIndexFiles(tmp_path, [5, 7], compression="zlib")
+    dataset = flatbin_dataset.FlatbinMapDataset(paths, ["index.int"], sample_index=True)
+    reader = flatbin_dataset.FlatbinMapDataset(paths, ["index.int"])
+    for value, index in dataset.__getitems__([11, 3, 6]):
+        assert value == reader[index][0] == index
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("shuffle_block", [None, 4])
+def testSkip(tmp_path, compression, use_mmap, shuffle_block):
+    """Skipping the samples already read continues with the same order as reading them."""
+    paths, _ = writeIndexFiles(tmp_path, [13, 3, 30], compression)
+    single = flatbin_dataset.FlatbinDataset(paths[2], ["index.int"], use_mmap=use_mmap,
+                                            shuffle_block=shuffle_block, shuffle_pool=2)
+    interleaved = flatbin_dataset.InterleavedFlatbinDatasets(paths, ["index.int"], use_mmap=use_mmap,
+                                                             shuffle_block=shuffle_block, shuffle_pool=2)
+    for dataset in [single, interleaved]:
+        dataset.set_epoch(1)
+        full = [sample[0] for sample in dataset]
+        for skip in [1, 5, 17, len(full)]:
+            dataset.set_skip([skip])
+            assert [sample[0] for sample in dataset] == full[skip:]
+        dataset.set_epoch(1)
+        assert [sample[0] for sample in dataset] == full
+
+
+def testSummarySidecar(tmp_path):
+    """Written files get a summary sidecar, the summaries of several files combine, and stale ones are ignored."""
+    paths = [os.path.join(tmp_path, f"test{idx}.bin") for idx in range(2)]
+    labels = []
+    for path, samples in zip(paths, [10, 7]):
+        batches = writeTestFile(path, samples=samples)
+        labels.append(torch.cat([batch[1] for batch in batches]).numpy())
+        summary = flatbin_dataset.readSidecar(path)
+        assert summary["sample_count"] == samples
+        assert summary["image_shape"] == [1, 12, 16]
+        assert summary["vector_sizes"] == {"cls": 1}
+        assert summary["class_histograms"]["cls"] == numpy.bincount(labels[-1]).tolist()
+
+    combined = flatbin_dataset.combineSummaries([flatbin_dataset.readSidecar(path) for path in paths])
+    all_labels = numpy.concatenate(labels)
+    assert combined["sample_count"] == 17
+    assert combined["class_histograms"]["cls"] == numpy.bincount(all_labels).tolist()
+    numpy.testing.assert_allclose(combined["statistics"]["cls"]["mean"], [all_labels.mean()])
+    numpy.testing.assert_allclose(combined["statistics"]["cls"]["variance"], [all_labels.var()])
+
+    # A sidecar that does not match its file is not used
+    with open(paths[0], "ab") as binfile:
+        binfile.write(b"\0")
+    assert flatbin_dataset.readSidecar(paths[0]) is None
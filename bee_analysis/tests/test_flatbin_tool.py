@@ -0,0 +1,109 @@
+import numpy
+import os
+import subprocess
+import sys
+import pytest
+import torch
+
+import utility.flatbin_dataset as flatbin_dataset
+import utility.flatbin_tool as flatbin_tool
+
+ENTRIES = ["0.png", "cls", "index.int"]
+
+
+def writeFile(path, first, count, **kwargs):
+    generator = torch.Generator().manual_seed(first)
+    images = torch.randint(0, 256, (count, 1, 6, 8), dtype=torch.uint8, generator=generator)
+    labels = torch.arange(first, first + count) % 3 + 1
+    flatbin_dataset.dataloaderToFlatbin([(images, labels, torch.arange(first, first + count))], ENTRIES,
+            path, handlers={'cls': 'stoi'}, block_samples=4, **kwargs)
+    return images
+
+
+def readAll(path):
+    return list(flatbin_dataset.FlatbinDataset(path, ENTRIES))
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("layout_version", [1, 2])
+def testConcatAndSubset(tmp_path, compression, layout_version):
+    """Copied samples are identical to the originals."""
+    paths = [os.path.join(tmp_path, f"in{i}.bin") for i in range(2)]
+    writeFile(paths[0], 0, 10, compression=compression, layout_version=layout_version)
+    writeFile(paths[1], 10, 7, compression=compression, layout_version=layout_version)
+    originals = readAll(paths[0]) + readAll(paths[1])
+
+    datasets = flatbin_tool.openInputs(paths)
+    output = os.path.join(tmp_path, "concat.bin")
+    assert 17 == flatbin_tool.copySamples([(dataset, None) for dataset in datasets], output)
+    copied = readAll(output)
+    assert [sample[2] for sample in copied] == list(range(17))
+    for original, copy in zip(originals, copied):
+        numpy.testing.assert_array_equal(numpy.asarray(original[0]), numpy.asarray(copy[0]))
+        assert original[1] == copy[1]
+    assert flatbin_dataset.FlatbinDataset(output, ENTRIES).columns.keys() == datasets[0].columns.keys()
+
+    selected = flatbin_tool.selectIndices(datasets[0], indices=[1, 2, 3, 8], exclude_classes=[3])
+    assert selected == [1, 3]
+    selected = flatbin_tool.selectIndices(datasets[1], where="(cls == 2) & (index_int > 12)")
+    assert selected == [3, 6]
+    output = os.path.join(tmp_path, "subset.bin")
+    flatbin_tool.copySamples([(datasets[1], selected)], output, compression="zlib")
+    assert [sample[2] for sample in readAll(output)] == [13, 16]
+
+
+def testIncompatibleInputs(tmp_path):
+    paths = [os.path.join(tmp_path, f"in{i}.bin") for i in range(2)]
+    writeFile(paths[0], 0, 4)
+    writeFile(paths[1], 4, 4, layout_version=2)
+    with pytest.raises(ValueError):
+        flatbin_tool.openInputs(paths)
+
+
+def testSplitCommand(tmp_path):
+    """The split command divides the samples between the outputs."""
+    path = os.path.join(tmp_path, "in.bin")
+    writeFile(path, 0, 20)
+    outputs = [os.path.join(tmp_path, f"out{i}.bin") for i in range(2)]
+    tool = os.path.join(os.path.dirname(flatbin_tool.__file__), "flatbin_tool.py")
+    subprocess.run([sys.executable, tool, "split", path, "--outputs", *outputs, "--counts", "6", "--seed", "3"],
+                   check=True)
+    first = [sample[2] for sample in readAll(outputs[0])]
+    second = [sample[2] for sample in readAll(outputs[1])]
+    assert len(first) == 6 and len(second) == 14
+    assert first == sorted(first) and first != list(range(6))
+    assert sorted(first + second) == list(range(20))
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def testVerify(tmp_path, compression):
+    """Damaged blocks and truncated files are found."""
+    path = os.path.join(tmp_path, "in.bin")
+    writeFile(path, 0, 20, compression=compression)
+    assert flatbin_dataset.checkFlatbin(path)
+    assert flatbin_dataset.verifyFlatbin(path, processes=2, chunk_blocks=2) is None
+
+    # Damage the record of sample 9, which is in the third block of 4 samples
+    offsets = flatbin_dataset.FlatbinDataset(path, []).readOffsets()
+    damaged_offset = int(offsets[9] if compression is None else offsets[2]) + 20
+    with open(path, "r+b") as binfile:
+        binfile.seek(damaged_offset)
+        value = binfile.read(1)
+        binfile.seek(damaged_offset)
+        binfile.write(bytes([value[0] ^ 0xFF]))
+    assert flatbin_dataset.checkFlatbin(path)
+    assert flatbin_dataset.verifyFlatbin(path, processes=2, chunk_blocks=2) == 8
+
+    # A truncated file loses its footer, so the sizes of the samples are followed instead
+    truncated = os.path.join(tmp_path, "truncated.bin")
+    writeFile(truncated, 0, 20, compression=compression)
+    with open(truncated, "r+b") as binfile:
+        binfile.truncate(int(offsets[12 if compression is None else 3]) + 10)
+    assert not flatbin_dataset.checkFlatbin(truncated)
+    assert flatbin_dataset.verifyFlatbin(truncated) == 12
+
+    # An unfinished file still has a sample count of 0
+    with open(truncated, "r+b") as binfile:
+        binfile.write((0).to_bytes(4, byteorder='big'))
+    with pytest.raises(ValueError):
+        flatbin_dataset.checkFlatbin(truncated)
@@ -0,0 +1,97 @@
+import copy
+import pytest
+import torch
+
+import utility.multifold_utility as multifold_utility
+import utility.profile_utility as profile_utility
+import utility.train_utility as train_utility
+from utility.eval_utility import ConfusionMatrix
+
+
+class TinyNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(16, 3)
+
+    def forward(self, x, vector_input=None):
+        return self.linear(x.flatten(1))
+
+
+def makeBatches(num_batches=5, batch_size=6, num_folds=3):
+    """Make batches of (images, class labels, fold indices)."""
+    generator = torch.Generator().manual_seed(0)
+    return [(torch.randint(0, 256, (batch_size, 1, 4, 4), dtype=torch.uint8, generator=generator),
+             torch.randint(0, 3, (batch_size,), generator=generator),
+             torch.randint(0, num_folds, (batch_size,), generator=generator))
+            for _ in range(num_batches)]
+
+
+def testFoldMasks():
+    masks = multifold_utility.foldMasks(torch.tensor([0, 2, 1, 2]), 3)
+    assert masks.tolist() == [[False, True, True, True], [True, True, False, True], [True, False, True, False]]
+
+
+@pytest.mark.parametrize("num_batches, batch_size", [(5, 6), (30, 1)])
+def testTrainFoldsMatchesSeparateTraining(num_batches, batch_size):
+    """Each model ends up where training it alone on the samples outside of its fold would."""
+    torch.manual_seed(0)
+    initial = TinyNet()
+    batches = makeBatches(num_batches, batch_size)
+    nets = [copy.deepcopy(initial) for _ in range(3)]
+    optimizers = [torch.optim.SGD(net.parameters(), lr=0.1) for net in nets]
+    label_handler = train_utility.LabelHandler(3, slice(1, 2))
+    label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(labels, num_classes=3))
+    train_stats = [ConfusionMatrix(3) for _ in nets]
+    multifold_utility.trainFoldsEpoch(nets, optimizers, [None] * 3, label_handler, train_stats, batches,
+                                      vector_range=slice(2, 2), train_frames=1, normalize_images=False,
+                                      loss_fn=torch.nn.CrossEntropyLoss(), nn_postprocess=lambda x: x,
+                                      device="cpu")
+
+    for fold, net in enumerate(nets):
+        expected = copy.deepcopy(initial)
+        optimizer = torch.optim.SGD(expected.parameters(), lr=0.1)
+        sample_count = 0
+        for images, labels, folds in batches:
+            keep = folds != fold
+            # A separate job would not see batches made only of held out samples
+            if not keep.any():
+                continue
+            train_utility.updateWithoutScaler(torch.nn.CrossEntropyLoss(), expected,
+                                              train_utility.prepareImages(images[keep]), None, labels[keep],
+                                              optimizer)
+            sample_count += int(keep.sum())
+        for param, expected_param in zip(net.parameters(), expected.parameters()):
+            torch.testing.assert_close(param, expected_param)
+        assert train_stats[fold].prediction_count == sample_count
+
+    # Every model is evaluated only on its own fold
+    eval_stats = [ConfusionMatrix(3) for _ in nets]
+    multifold_utility.evalFoldsEpoch(nets, label_handler, eval_stats, batches, vector_range=slice(2, 2),
+                                     train_frames=1, normalize_images=False, loss_fn=torch.nn.CrossEntropyLoss(),
+                                     nn_postprocess=lambda x: x, outnames=["a", "b", "c"], device="cpu")
+    for fold, stats in enumerate(eval_stats):
+        assert stats.prediction_count == sum(int((folds == fold).sum()) for _, _, folds in batches)
+
+
+def testFoldsProfile():
+    """Training and evaluating the folds with a profiler reports their steps and phases."""
+    nets = [TinyNet() for _ in range(3)]
+    optimizers = [torch.optim.SGD(net.parameters(), lr=0.1) for net in nets]
+    label_handler = train_utility.LabelHandler(3, slice(1, 2))
+    label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(labels, num_classes=3))
+    profiler = profile_utility.StepProfiler("cpu")
+    multifold_utility.trainFoldsEpoch(nets, optimizers, [None] * 3, label_handler, [ConfusionMatrix(3) for _ in nets],
+                                      makeBatches(), vector_range=slice(2, 2), train_frames=1,
+                                      normalize_images=False, loss_fn=torch.nn.CrossEntropyLoss(),
+                                      nn_postprocess=lambda x: x, device="cpu", profiler=profiler)
+    report = profiler.report("train", 0)
+    assert 5 == report["steps"] and 30 == report["samples"]
+    assert {"data", "copy", "forward", "backward", "optimizer", "metrics"} == set(report["phase_seconds"])
+
+    multifold_utility.evalFoldsEpoch(nets, label_handler, [ConfusionMatrix(3) for _ in nets], makeBatches(),
+                                     vector_range=slice(2, 2), train_frames=1, normalize_images=False,
+                                     loss_fn=torch.nn.CrossEntropyLoss(), nn_postprocess=lambda x: x,
+                                     outnames=["a", "b", "c"], device="cpu", profiler=profiler)
+    report = profiler.report("eval", 0)
+    assert 5 == report["steps"] and 30 == report["samples"]
+    assert {"data", "copy", "forward", "metrics"} == set(report["phase_seconds"])
@@ -0,0 +1,71 @@
+import functools
+import pytest
+import torch
+
+import utility.prefetch_utility as prefetch_utility
+import utility.train_utility as train_utility
+from utility.dataset_utility import extractVectors, makeDataset
+
+from test_dataset_utility import writeShards
+
+
+def makeSamples(count=10, frames=2, channels=None):
+    """Make samples of frames, a class label, and a vector."""
+    generator = torch.Generator().manual_seed(0)
+    shape = (5, 6) if channels is None else (channels, 5, 6)
+    return [tuple(torch.randint(0, 256, shape, dtype=torch.uint8, generator=generator) for _ in range(frames))
+            + (torch.tensor(idx % 3), torch.rand(4, generator=generator)) for idx in range(count)]
+
+
+@pytest.mark.parametrize("channels", [None, 3])
+@pytest.mark.parametrize("num_workers", [0, 2])
+def testPackedBatches(channels, num_workers):
+    """Packed batches index like the dataloader tuples and give the same network input."""
+    samples = makeSamples(channels=channels)
+    reference = torch.utils.data.DataLoader(samples, batch_size=4)
+    packed = torch.utils.data.DataLoader(samples, batch_size=4, num_workers=num_workers,
+                                         collate_fn=functools.partial(prefetch_utility.collateFrames, 2))
+    prefetcher = prefetch_utility.BatchPrefetcher(packed, "cpu")
+    for expected, batch in zip(reference, prefetcher):
+        assert isinstance(batch, prefetch_utility.PackedBatch)
+        assert len(batch) == len(expected)
+        for entry, expected_entry in zip(batch[0:len(batch)], expected):
+            torch.testing.assert_close(entry, expected_entry)
+        torch.testing.assert_close(batch[-1], expected[-1])
+        torch.testing.assert_close(extractVectors(batch, slice(2, 4)), extractVectors(expected, slice(2, 4)))
+        torch.testing.assert_close(train_utility.batchImages(batch, 2, "cpu"),
+                                   train_utility.batchImages(expected, 2, "cpu"))
+    assert 3 == prefetcher.batches
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def testPackedWebdataset(tmp_path, num_workers):
+    """Webdataset batches from the workers are packed with tensor labels that training can read."""
+    dataset = makeDataset(writeShards(tmp_path, shards=2), ["0.png", "cls"], uint8_images=True, batch_size=4)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers,
+                                             collate_fn=functools.partial(prefetch_utility.packFrames, 1))
+    labels = []
+    for batch in dataloader:
+        assert isinstance(batch, prefetch_utility.PackedBatch)
+        assert isinstance(batch[1], torch.Tensor)
+        images = train_utility.batchImages(batch, 1, "cpu")
+        assert torch.uint8 == images.dtype and (1, 4, 5) == images.shape[1:]
+        # Each image holds the index of its sample, whose label is the index modulo 3
+        batch_labels = extractVectors(batch, slice(1, 2)).flatten()
+        assert torch.equal(batch_labels, images[:, 0, 0, 0].long() % 3)
+        labels.extend(batch_labels.tolist())
+    assert 20 == len(labels)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Needs a cuda device")
+def testCudaPrefetch():
+    """Batches arrive on the gpu unchanged."""
+    samples = makeSamples(count=20)
+    packed = torch.utils.data.DataLoader(samples, batch_size=4, pin_memory=True,
+                                         collate_fn=functools.partial(prefetch_utility.collateFrames, 2))
+    prefetcher = prefetch_utility.BatchPrefetcher(packed, "cuda")
+    for expected, batch in zip(torch.utils.data.DataLoader(samples, batch_size=4), prefetcher):
+        assert batch.images.is_cuda
+        torch.testing.assert_close(batch[1].cpu(), expected[1])
+        torch.testing.assert_close(batch[3].cpu(), expected[3])
+    assert 5 == prefetcher.batches
@@ -0,0 +1,51 @@
+import json
+import os
+import torch
+
+import utility.profile_utility as profile_utility
+import utility.train_utility as train_utility
+from utility.eval_utility import ConfusionMatrix
+
+
+def testDisabledProfiler():
+    """A disabled profiler records nothing and hands out the same empty context every time."""
+    profiler = profile_utility.StepProfiler(enabled=False)
+    assert profiler.phase("forward") is profiler.phase("backward")
+    with profiler.phase("forward"):
+        pass
+    profiler.step(4)
+    assert profiler.report("train", 0) is None
+    assert {} == profiler.phase_seconds and 0 == profiler.samples
+
+
+def testTrainEpochProfile(tmp_path):
+    """Training with a profiler reports the phases of the steps, the throughput, and a trace."""
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 3))
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1)
+    batches = [(torch.randint(0, 256, (6, 1, 4, 4), dtype=torch.uint8), torch.randint(0, 3, (6,)))
+               for _ in range(5)]
+    label_handler = train_utility.LabelHandler(3, slice(1, 2))
+    label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(labels, num_classes=3))
+    trace_path = os.path.join(tmp_path, "trace.json")
+    profiler = profile_utility.StepProfiler("cpu", trace_path=trace_path, trace_steps=(1, 2))
+    train_utility.trainEpoch(net, optimizer, None, label_handler, ConfusionMatrix(3), batches,
+                             vector_range=slice(2, 2), train_frames=1, normalize_images=False,
+                             loss_fn=lambda out, labels: torch.nn.functional.cross_entropy(out, labels),
+                             nn_postprocess=lambda x: x, skip_metadata=True, device="cpu", profiler=profiler)
+    profiler.close()
+    report = profiler.report("train", 0)
+    assert 5 == report["steps"] and 30 == report["samples"]
+    assert {"data", "copy", "forward", "backward", "optimizer", "metrics", "examples"} == set(report["phase_seconds"])
+    assert 0 < report["samples_per_second"]
+    assert 0 <= report["data_stall_percent"] <= 100
+    assert sum(report["phase_seconds"].values()) <= report["seconds"]
+    assert os.path.exists(trace_path)
+
+    json_path = os.path.join(tmp_path, "profile.json")
+    description_path = os.path.join(tmp_path, "RUN_DESCRIPTION.log")
+    profiler.save(json_path, description_path)
+    with open(json_path) as json_file:
+        assert [report] == json.load(json_file)
+    with open(description_path) as run_desc:
+        assert "samples/s" in run_desc.read()
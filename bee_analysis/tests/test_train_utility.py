@@ -0,0 +1,137 @@
+import copy
+import functools
+import os
+import pytest
+import torch
+
+import utility.flatbin_dataset as flatbin_dataset
+from utility.augment_utility import BatchAugmenter
+import utility.prefetch_utility as prefetch_utility
+import utility.train_utility as train_utility
+from utility.eval_utility import ConfusionMatrix
+
+
+@pytest.mark.parametrize("normalize", [False, True])
+def testPrepareImages(normalize):
+    """uint8 batches prepared on the device match float batches prepared the old way."""
+    images = torch.randint(0, 256, (4, 3, 10, 12), dtype=torch.uint8, generator=torch.Generator().manual_seed(0))
+    expected = images.to(torch.float32) / 255.0
+    if normalize:
+        expected = train_utility.normalizeImages(expected)
+    prepared = train_utility.prepareImages(images, normalize)
+    assert prepared.dtype == torch.float32
+    torch.testing.assert_close(prepared, expected, rtol=1e-5, atol=1e-5)
+    # Float inputs give the same result
+    torch.testing.assert_close(train_utility.prepareImages(images.to(torch.float32) / 255.0, normalize), expected)
+
+
+def testScaleLearningRate():
+    """Scaled learning rates carry through the schedule."""
+    param = torch.nn.Parameter(torch.zeros(1))
+    optimizer = torch.optim.SGD([param], lr=0.1)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[1], gamma=0.5)
+    scale = train_utility.learningRateScale("linear", 64, 16)
+    assert scale == 4.0
+    assert train_utility.learningRateScale("sqrt", 64, 16) == 2.0
+    train_utility.scaleLearningRate(optimizer, scheduler, scale)
+    assert optimizer.param_groups[0]["lr"] == pytest.approx(0.4)
+    optimizer.step()
+    scheduler.step()
+    assert optimizer.param_groups[0]["lr"] == pytest.approx(0.2)
+
+
+def testFindBatchSize():
+    """The batch size on the cpu grows with the memory and leaves the network unchanged."""
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Conv2d(1, 8, 3), torch.nn.BatchNorm2d(8), torch.nn.ReLU(),
+                              torch.nn.Flatten(), torch.nn.Linear(8 * 30 * 30, 3))
+    before = {name: value.clone() for name, value in net.state_dict().items()}
+    device = torch.device("cpu")
+    small = train_utility.findBatchSize(net, (1, 32, 32), device, memory_limit=2**22)
+    large = train_utility.findBatchSize(net, (1, 32, 32), device, memory_limit=2**25)
+    assert 1 <= small < large
+    assert train_utility.findBatchSize(net, (1, 32, 32), device, max_batch_size=16, memory_limit=2**30) == 16
+    for name, value in net.state_dict().items():
+        torch.testing.assert_close(value, before[name])
+    assert all(param.grad is None for param in net.parameters())
+
+
+class DropoutNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.dropout = torch.nn.Dropout(0.5)
+        self.linear = torch.nn.Linear(6 * 8, 3)
+
+    def forward(self, x, vector_input=None):
+        return self.linear(self.dropout(x.flatten(1)))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def testMidEpochResume(tmp_path, num_workers):
+    """Training that stops part way through an epoch and resumes from its cursor ends with the same weights."""
+    path = os.path.join(tmp_path, "train.bin")
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randint(0, 256, (48, 1, 6, 8), dtype=torch.uint8, generator=generator)
+    labels = torch.randint(0, 3, (48,), generator=generator)
+    flatbin_dataset.dataloaderToFlatbin([(images, labels)], ["0.png", "cls"], path, handlers={'cls': 'stoi'})
+    label_handler = train_utility.LabelHandler(3, slice(1, 2))
+    label_handler.setPreeval(lambda labels: torch.nn.functional.one_hot(labels, num_classes=3))
+    torch.manual_seed(0)
+    initial = DropoutNet()
+    # Augmentation must also pick up where it stopped
+    augmenter = BatchAugmenter(shift=2, hflip=0.5, brightness=0.1, contrast=0.2, seed=5)
+
+    def train(net, optimizer, start_epoch=0, start_cursor=None, progress_fn=None):
+        dataset = flatbin_dataset.FlatbinDataset(path, ["0.png", "cls"], shuffle_block=4, shuffle_pool=2,
+                                                 uint8_images=True)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=num_workers,
+                                             collate_fn=functools.partial(prefetch_utility.collateFrames, 1),
+                                             generator=torch.Generator())
+        for epoch in range(start_epoch, 2):
+            dataset.set_epoch(epoch)
+            loader.generator.manual_seed(epoch)
+            augmenter.set_epoch(epoch)
+            cursor = None
+            if start_cursor is not None and epoch == start_epoch:
+                dataset.set_skip(start_cursor)
+                cursor = start_cursor
+            train_utility.trainEpoch(net, optimizer, None, label_handler, ConfusionMatrix(3), loader,
+                                     vector_range=slice(2, 2), train_frames=1, normalize_images=False,
+                                     loss_fn=torch.nn.CrossEntropyLoss(), nn_postprocess=lambda x: x,
+                                     skip_metadata=True, device="cpu", start_cursor=cursor,
+                                     progress_fn=functools.partial(progress_fn, epoch) if progress_fn else None,
+                                     augment=augmenter)
+
+    torch.manual_seed(1)
+    expected = copy.deepcopy(initial)
+    train(expected, torch.optim.SGD(expected.parameters(), lr=0.1, momentum=0.9))
+
+    class Interrupted(Exception):
+        pass
+
+    saved = {}
+
+    def stopAtBatch(epoch, batches, cursor):
+        # Stop at a multiple of the number of workers, see --checkpoint_batches
+        if 1 == epoch and 4 == batches:
+            saved.update(net=copy.deepcopy(net.state_dict()), optim=copy.deepcopy(optimizer.state_dict()),
+                         rng=torch.get_rng_state(), cursor=dict(cursor))
+            raise Interrupted()
+
+    torch.manual_seed(1)
+    net = copy.deepcopy(initial)
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    with pytest.raises(Interrupted):
+        train(net, optimizer, progress_fn=stopAtBatch)
+    assert sum(saved["cursor"].values()) == 16
+    assert len(saved["cursor"]) == max(1, num_workers)
+
+    # Resume in a fresh model and optimizer
+    net = DropoutNet()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+    net.load_state_dict(saved["net"])
+    optimizer.load_state_dict(saved["optim"])
+    torch.set_rng_state(saved["rng"])
+    train(net, optimizer, start_epoch=1, start_cursor=saved["cursor"])
+    for param, expected_param in zip(net.parameters(), expected.parameters()):
+        torch.testing.assert_close(param, expected_param, rtol=0, atol=0)
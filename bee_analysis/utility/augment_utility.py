@@ -0,0 +1,152 @@
+#! /usr/bin/python3
+"""
+Utility classes for augmenting training batches after they are decoded.
+
+Augmentation during sampling (the crop_noise and scale of video_utility.VideoSampler) is fixed in
+the dataset, so every change of policy means sampling the videos again. A BatchAugmenter instead
+changes the [batch, frames * channels, height, width] image tensor of each training step on the
+training device. Shifts, flips, and frame dropout are one gather of the uint8 images, and
+brightness and contrast jitter are two elementwise operations on the float images, so augmenting
+costs little next to the forward pass.
+
+The random parameters of each sample are a hash of the seed, the epoch, and a key that identifies
+the sample (see train_utility.sampleKeys), so they do not depend on the batch size or on where the
+sample is in its batch, and a run that resumes part way through an epoch repeats them.
+"""
+import numpy
+import torch
+
+# Constants of the splitmix64 generator, as signed 64 bit integers since torch has no uint64 arithmetic
+_GOLDEN_GAMMA = -7046029254386353131
+_MIX_1 = -4658895280553007687
+_MIX_2 = -7723592293110705685
+
+
+def _shiftRight(values, bits):
+    """Logical right shift of int64 values."""
+    return (values >> bits) & ((1 << (64 - bits)) - 1)
+
+
+def hashUniforms(keys, count, seed=0):
+    """Return [len(keys), count] floats in [0, 1) that depend only on the seed and each key.
+
+    Arguments:
+        keys (torch.tensor): int64 key of each sample.
+        count         (int): Number of values for each key.
+        seed          (int): Seed mixed into every value, such as a hash of the run seed and epoch.
+    """
+    # Wrapping int64 arithmetic is the same as uint64 arithmetic in two's complement
+    state = keys.to(torch.int64).view(-1, 1) * count + torch.arange(1, count + 1, dtype=torch.int64)
+    state = state * _GOLDEN_GAMMA + seed
+    state = (state ^ _shiftRight(state, 30)) * _MIX_1
+    state = (state ^ _shiftRight(state, 27)) * _MIX_2
+    state = state ^ _shiftRight(state, 31)
+    # The top 53 bits fill the mantissa of a double
+    return _shiftRight(state, 11).to(torch.float64) / float(1 << 53)
+
+
+class BatchAugmenter:
+    """Randomly shift, flip, drop frames of, and jitter the images of each sample in a batch.
+
+    The images keep their size: shifted images repeat their edge pixels, and a dropped frame is
+    replaced by the frame before it. The first frame is never dropped.
+    """
+
+    def __init__(self, shift=0, hflip=0.0, vflip=0.0, brightness=0.0, contrast=0.0, frame_dropout=0.0, seed=0):
+        """
+        Arguments:
+            shift           (int): Largest offset, in pixels, in either dimension.
+            hflip         (float): Probability of flipping a sample left to right.
+            vflip         (float): Probability of flipping a sample top to bottom.
+            brightness    (float): Largest change of brightness, added to images from 0 to 1.
+            contrast      (float): Largest relative change of contrast around the mean of a sample.
+            frame_dropout (float): Probability of replacing each frame after the first with the one before it.
+            seed            (int): Seed of the random parameters.
+        """
+        self.shift = shift
+        self.hflip = hflip
+        self.vflip = vflip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.frame_dropout = frame_dropout
+        self.seed = seed
+        self.epoch = 0
+
+    @property
+    def enabled(self):
+        """True if any augmentation is turned on."""
+        return any([self.shift, self.hflip, self.vflip, self.brightness, self.contrast, self.frame_dropout])
+
+    def set_epoch(self, epoch):
+        """Draw different parameters in every epoch."""
+        self.epoch = epoch
+
+    def _gatherIndices(self, uniforms, train_frames, channels, height, width):
+        """Return the source channel, row, and column of every output pixel, broadcastable against the batch."""
+        batch_size = uniforms.size(0)
+
+        def axisIndices(length, flip_probability, flip_uniforms, shift_uniforms):
+            positions = torch.arange(length).expand(batch_size, -1)
+            if 0 < flip_probability:
+                flips = flip_uniforms.view(-1, 1) < flip_probability
+                positions = torch.where(flips, length - 1 - positions, positions)
+            if 0 < self.shift:
+                offsets = (shift_uniforms * (2 * self.shift + 1)).floor().to(torch.int64).view(-1, 1) - self.shift
+                positions = (positions + offsets).clamp(0, length - 1)
+            return positions
+
+        rows = axisIndices(height, self.vflip, uniforms[:, 0], uniforms[:, 1])
+        cols = axisIndices(width, self.hflip, uniforms[:, 2], uniforms[:, 3])
+        frames = torch.arange(train_frames).expand(batch_size, -1)
+        if 0 < self.frame_dropout and 1 < train_frames:
+            kept = uniforms[:, 6:6 + train_frames] >= self.frame_dropout
+            kept[:, 0] = True
+            # Each frame comes from the latest kept frame at or before it
+            frames = torch.where(kept, frames, 0).cummax(dim=1).values
+        sources = (frames.unsqueeze(-1) * channels + torch.arange(channels)).view(batch_size, -1)
+        return sources[:, :, None, None], rows[:, None, :, None], cols[:, None, None, :]
+
+    def __call__(self, images, train_frames, sample_keys):
+        """Return an augmented copy of a batch of images.
+
+        Arguments:
+            images      (torch.tensor): [batch, frames * channels, height, width] images, uint8 or float
+                                        from 0 to 1.
+            train_frames         (int): Number of frames in each sample.
+            sample_keys (torch.tensor): int64 key of each sample, which seeds its random parameters.
+        Returns:
+            torch.tensor: The augmented images, converted to floats from 0 to 1 if brightness or
+                contrast is jittered and otherwise of the same type.
+        """
+        if not self.enabled:
+            return images
+        batch_size, total_channels, height, width = images.shape
+        # Flips and shifts of each axis, brightness, contrast, and then one value for each frame
+        uniforms = hashUniforms(torch.as_tensor(sample_keys).cpu(), 6 + train_frames,
+                                int(numpy.random.SeedSequence([self.seed, self.epoch]).generate_state(
+                                    1, dtype=numpy.uint64)[0].astype(numpy.int64)))
+        if any([self.shift, self.hflip, self.vflip, self.frame_dropout]):
+            sources, rows, cols = self._gatherIndices(uniforms, train_frames, total_channels // train_frames,
+                                                      height, width)
+            if "cuda" == images.device.type:
+                # A single indexing kernel rather than three launches per sample
+                samples = torch.arange(batch_size)[:, None, None, None]
+                index = [indices.to(images.device, non_blocking=True) for indices in (samples, sources, rows, cols)]
+                images = images[index[0], index[1], index[2], index[3]]
+            else:
+                # On the cpu selecting whole channels, rows, and columns is several times faster
+                images = torch.stack([
+                    images[sample].index_select(0, sources[sample].flatten()).index_select(
+                        1, rows[sample].flatten()).index_select(2, cols[sample].flatten())
+                    for sample in range(batch_size)])
+        if 0 < self.brightness or 0 < self.contrast:
+            if not images.is_floating_point():
+                images = images.to(dtype=torch.float32).div_(255.0)
+            brightness = self.brightness * (2 * uniforms[:, 4] - 1).view(-1, 1, 1, 1).float()
+            contrast = 1.0 + self.contrast * (2 * uniforms[:, 5] - 1).view(-1, 1, 1, 1).float()
+            contrast = contrast.to(images.device, non_blocking=True)
+            brightness = brightness.to(images.device, non_blocking=True)
+            # (images - mean) * contrast + mean + brightness as a single multiply and add
+            offsets = images.mean(dim=(1, 2, 3), keepdim=True).mul_(1.0 - contrast).add_(brightness)
+            images = torch.addcmul(offsets, images, contrast).clamp_(0.0, 1.0)
+        return images
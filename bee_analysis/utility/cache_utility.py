@@ -0,0 +1,205 @@
+#! /usr/bin/python3
+"""
+Utility functions and classes for keeping a decoded dataset in memory between epochs.
+
+The first epoch reads and decodes the dataset as usual while a CacheBuilder copies every batch into
+one uint8 image tensor and a tensor (or list) for each of the other entries. Later epochs read
+slices of those tensors through a DecodedCache instead of decoding again. The tensors are moved to
+shared memory, so the dataloader workers read them without their own copies.
+
+Datasets that do not fit in the memory budget are not cached and are read every epoch as before,
+unless the builder was given a scratch directory. Then the images are written to a file there
+instead, which is memory mapped, so reading the cache costs page cache or local disk reads rather
+than decoding.
+"""
+import logging
+import numpy
+import os
+import shutil
+import tempfile
+
+import torch
+
+from utility.prefetch_utility import PackedBatch
+
+
+def memoryBudget(fraction=0.5):
+    """Return the default cache budget in bytes, a fraction of the memory that is free for shared memory."""
+    total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    budget = int(fraction * total)
+    # Shared memory lives in /dev/shm, which can be smaller than the memory, such as in containers
+    if os.path.isdir("/dev/shm"):
+        budget = min(budget, shutil.disk_usage("/dev/shm").free)
+    return budget
+
+
+def keepBatch(batch):
+    """Collate function for a DecodedCache, whose batches are already collated."""
+    return batch
+
+
+class DecodedCache(torch.utils.data.Dataset):
+    """A map style dataset of decoded batches held in memory.
+
+    Batches are read with __getitems__ as PackedBatch slices of the cached tensors, so use keepBatch
+    as the collate_fn of the DataLoader.
+    """
+
+    def __init__(self, images, train_frames, entries, squeezed=False):
+        """
+        Arguments:
+            images (torch.tensor): uint8 frames of every sample, [samples, frames * channels, height, width].
+            train_frames    (int): Number of frames in each sample.
+            entries        (list): The other entries of every sample, tensors or lists.
+            squeezed       (bool): True if the frames came without a channel dimension.
+        """
+        self.images = images
+        self.train_frames = train_frames
+        self.entries = entries
+        self.squeezed = squeezed
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def nbytes(self):
+        """Return the memory used by the cached tensors."""
+        return sum(tensor.numel() * tensor.element_size()
+                   for tensor in [self.images] + self.entries if isinstance(tensor, torch.Tensor))
+
+    def __getitems__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long)
+        return PackedBatch(self.images[index], self.train_frames,
+                           [entry[index] if isinstance(entry, torch.Tensor) else [entry[idx] for idx in indices]
+                            for entry in self.entries], self.squeezed)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])
+
+
+class CacheBuilder:
+    """Copy the batches of an epoch so that they can be read from a DecodedCache afterwards.
+
+    Gives up, and frees what it copied, as soon as the batches would need more than max_bytes, or
+    writes the images to a file in spill_dir from then on if that is set.
+    """
+
+    def __init__(self, max_bytes, num_samples=None, spill_dir=None):
+        """
+        Arguments:
+            max_bytes   (int): Memory budget of the cache.
+            num_samples (int): Expected number of samples, to give up before copying anything if the
+                               dataset cannot fit. None if unknown.
+            spill_dir   (str): Directory, preferably on a local disk, for the images of a cache that
+                               does not fit into max_bytes. None to give up instead.
+        """
+        self.max_bytes = max_bytes
+        self.num_samples = num_samples
+        self.spill_dir = spill_dir
+        self.spill_file = None
+        self.nbytes = 0
+        self.samples = 0
+        self.image_chunks = []
+        self.entry_chunks = None
+        self.train_frames = None
+        self.squeezed = False
+        self.failed = False
+
+    def giveUp(self, needed_bytes):
+        """Stop caching and free the copied batches."""
+        logging.warning(f"The dataset needs at least {needed_bytes / 2**20:.1f}MB, more than the cache budget "
+                        f"of {self.max_bytes / 2**20:.1f}MB, so it will be read every epoch.")
+        self.failed = True
+        self.image_chunks = []
+        self.entry_chunks = None
+
+    def spill(self, needed_bytes):
+        """Write the images to a file in spill_dir from now on."""
+        logging.info(f"The dataset needs at least {needed_bytes / 2**20:.1f}MB, more than the cache budget "
+                     f"of {self.max_bytes / 2**20:.1f}MB, so its images are cached in {self.spill_dir}.")
+        self.spill_file = tempfile.NamedTemporaryFile(dir=self.spill_dir, prefix="decoded_cache_", suffix=".bin",
+                                                      delete=False)
+        for chunk in self.image_chunks:
+            self.spill_file.write(chunk.numpy().tobytes())
+        self.image_chunks = []
+
+    def add(self, batch):
+        """Copy a PackedBatch (see prefetch_utility.collateFrames and packFrames) into the cache."""
+        if self.failed:
+            return
+        batch_bytes = sum(tensor.numel() * tensor.element_size() for tensor in batch.tensors())
+        batch_size = batch.images.size(0)
+        if self.spill_file is None:
+            needed_bytes = self.nbytes + batch_bytes
+            if self.entry_chunks is None and self.num_samples is not None:
+                needed_bytes = batch_bytes * self.num_samples // batch_size
+            if self.max_bytes < needed_bytes and self.spill_dir is None:
+                return self.giveUp(needed_bytes)
+            if self.max_bytes < needed_bytes:
+                self.spill(needed_bytes)
+        if self.entry_chunks is None:
+            self.train_frames = batch.train_frames
+            self.squeezed = batch.squeezed
+            self.image_shape = tuple(batch.images.shape[1:])
+            self.entry_chunks = [[] for _ in batch.entries]
+        if self.spill_file is not None:
+            self.spill_file.write(batch.images.to("cpu").contiguous().numpy().tobytes())
+        else:
+            # Batches can be in pinned memory that the dataloader reuses
+            self.image_chunks.append(batch.images.to("cpu", copy=True))
+        for chunks, entry in zip(self.entry_chunks, batch.entries):
+            chunks.append(entry.to("cpu", copy=True) if isinstance(entry, torch.Tensor) else list(entry))
+        self.nbytes += batch_bytes
+        self.samples += batch_size
+
+    def finish(self):
+        """Return the DecodedCache of the copied batches, in shared memory, or None if it did not fit.
+
+        The images of a cache that was spilled to a file are a copy on write memory mapping of it. The
+        file is removed right away and its space is freed once the mapping is closed.
+        """
+        if self.failed or 0 == self.samples:
+            return None
+        if self.spill_file is not None:
+            self.spill_file.close()
+            mapping = numpy.memmap(self.spill_file.name, dtype=numpy.uint8, mode='c',
+                                   shape=(self.samples,) + self.image_shape)
+            os.remove(self.spill_file.name)
+            self.spill_file = None
+            images = torch.from_numpy(mapping)
+        else:
+            images = torch.empty((self.samples,) + self.image_shape, dtype=torch.uint8)
+            images.share_memory_()
+        # Free the chunks while copying so that memory use stays close to the size of the cache
+        offset = 0
+        self.image_chunks.reverse()
+        while self.image_chunks:
+            chunk = self.image_chunks.pop()
+            images[offset:offset + chunk.size(0)] = chunk
+            offset += chunk.size(0)
+        entries = []
+        for chunks in self.entry_chunks:
+            if isinstance(chunks[0], torch.Tensor):
+                entries.append(torch.cat(chunks).share_memory_())
+            else:
+                entries.append([value for chunk in chunks for value in chunk])
+        self.entry_chunks = None
+        cache = DecodedCache(images, self.train_frames, entries, self.squeezed)
+        logging.info(f"Cached {len(cache)} decoded samples in {cache.nbytes() / 2**20:.1f}MB of "
+                     + ("shared memory" if images.is_shared() else "memory mapped disk"))
+        return cache
+
+
+class RecordingLoader:
+    """Iterate through a dataloader while adding each batch to a CacheBuilder."""
+
+    def __init__(self, dataloader, builder):
+        self.dataloader = dataloader
+        self.builder = builder
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            self.builder.add(batch)
+            yield batch
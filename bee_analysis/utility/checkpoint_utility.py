@@ -0,0 +1,273 @@
+#! /usr/bin/python3
+"""
+Utility functions and classes for saving checkpoints without stopping training.
+
+A CheckpointManager copies the checkpoint to host memory, which is quick, and then writes it on a
+background thread while training continues. Files are written to a temporary name and renamed into
+place, so a crash during a write never leaves a truncated checkpoint behind. The manager keeps the
+checkpoints of the last few epochs and the checkpoint with the best metric.
+
+Progress checkpoints (see CheckpointManager.saveProgress) are taken part way through an epoch. They
+also hold the number of samples that each dataloader worker has read, so that training can skip
+those samples and continue as if it had not stopped.
+"""
+import concurrent.futures
+import glob
+import logging
+import os
+import re
+import shutil
+import time
+
+import torch
+
+
+def copyToHost(state):
+    """Return a copy of a checkpoint with every tensor copied to host memory.
+
+    The copy does not change when training continues to update the original tensors.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: copyToHost(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(copyToHost(value) for value in state)
+    return state
+
+
+def epochCheckpointName(outname, epoch):
+    """Return the name of the checkpoint of an epoch, model.checkpoint becomes model_epoch3.checkpoint."""
+    root, ext = os.path.splitext(outname)
+    return f"{root}_epoch{epoch}{ext}"
+
+
+def bestCheckpointName(outname):
+    """Return the name of the checkpoint with the best metric, model.checkpoint becomes model_best.checkpoint."""
+    root, ext = os.path.splitext(outname)
+    return f"{root}_best{ext}"
+
+
+def progressCheckpointName(outname):
+    """Return the name of the mid-epoch checkpoint, model.checkpoint becomes model_progress.checkpoint."""
+    root, ext = os.path.splitext(outname)
+    return f"{root}_progress{ext}"
+
+
+def replaceFile(source, destination):
+    """Atomically replace destination with a hard link to (or a copy of) source."""
+    temp_name = f"{destination}.tmp"
+    if os.path.exists(temp_name):
+        os.remove(temp_name)
+    try:
+        os.link(source, temp_name)
+    except OSError:
+        # Some filesystems do not support hard links
+        shutil.copyfile(source, temp_name)
+    os.replace(temp_name, destination)
+
+
+def writeAtomically(state, path):
+    """Write a checkpoint to a temporary file and rename it into place once it is on disk.
+
+    Returns:
+        int: The size of the file in bytes.
+    """
+    temp_name = f"{path}.tmp"
+    with open(temp_name, "wb") as out_file:
+        torch.save(state, out_file)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(temp_name, path)
+    return os.path.getsize(path)
+
+
+def listEpochCheckpoints(outname):
+    """Return the epochs that have a checkpoint file, see epochCheckpointName, in increasing order."""
+    root, ext = os.path.splitext(outname)
+    pattern = re.compile(re.escape(root) + r"_epoch(\d+)" + re.escape(ext) + "$")
+    matches = [pattern.match(path) for path in glob.glob(glob.escape(root) + "_epoch*")]
+    return sorted(int(match.group(1)) for match in matches if match is not None)
+
+
+def findLatestCheckpoint(outname):
+    """Find the newest checkpoint from training with the given outname that can be loaded.
+
+    Checks the progress checkpoint if it is part way through a later epoch than the newest epoch
+    checkpoint, then the checkpoints of each epoch, newest first, and then outname itself. Progress
+    checkpoints have a "cursor" entry, see CheckpointManager.saveProgress.
+
+    Returns:
+        (str, dict) or (None, None): The path and contents of the checkpoint.
+    """
+    epochs = listEpochCheckpoints(outname)
+    epoch_paths = [epochCheckpointName(outname, epoch) for epoch in reversed(epochs)]
+    progress_path = progressCheckpointName(outname)
+    if os.path.exists(progress_path):
+        try:
+            progress = torch.load(progress_path, map_location="cpu", weights_only=False)
+            # Epoch checkpoints are saved at the end of their epoch
+            if 0 == len(epochs) or epochs[-1] < progress["epoch"]:
+                return progress_path, progress
+        except Exception as error:
+            logging.warning(f"Skipping checkpoint {progress_path} that cannot be loaded: {error}")
+    for path in epoch_paths + [outname]:
+        if not os.path.exists(path):
+            continue
+        try:
+            return path, torch.load(path, map_location="cpu", weights_only=False)
+        except Exception as error:
+            logging.warning(f"Skipping checkpoint {path} that cannot be loaded: {error}")
+    return None, None
+
+
+class CheckpointManager:
+    """Save checkpoints on a background thread, keeping the last few epochs and the best one.
+
+    Every save writes the checkpoint of its epoch (see epochCheckpointName) and points outname at
+    it, so outname is always the newest checkpoint. Only one write is in flight at a time; a save
+    waits for the previous write to finish before copying the next checkpoint to host memory.
+    """
+
+    def __init__(self, outname, keep_last=1, metric_mode="min", async_save=True):
+        """
+        Arguments:
+            outname       (str): Name of the newest checkpoint.
+            keep_last     (int): Number of epoch checkpoints to keep, besides outname and the best.
+            metric_mode   (str): "min" or "max", which metric values are best.
+            async_save   (bool): Write on a background thread. Otherwise save blocks until written.
+        """
+        if metric_mode not in ["min", "max"]:
+            raise ValueError(f"Unknown checkpoint metric mode {metric_mode}")
+        self.outname = outname
+        self.keep_last = keep_last
+        self.metric_mode = metric_mode
+        self.best_metric = None
+        self.saved_epochs = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if async_save else None
+        self.pending = None
+        # Write time metrics
+        self.saves = 0
+        self.snapshot_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+        self.bytes_written = 0
+
+    def isBetter(self, metric):
+        """Return True if the metric beats the best metric so far."""
+        if metric is None or metric != metric:
+            return False
+        if self.best_metric is None:
+            return True
+        return metric < self.best_metric if "min" == self.metric_mode else metric > self.best_metric
+
+    def save(self, state, epoch, metric=None):
+        """Save the checkpoint of an epoch.
+
+        Arguments:
+            state   (dict): The checkpoint, such as state dicts. Tensors may be on any device. The
+                            epoch and metric are added to the saved copy.
+            epoch    (int): The epoch of the checkpoint.
+            metric (float): Metric for the best checkpoint, such as the evaluation loss, or None.
+        """
+        begin = time.perf_counter()
+        self.wait()
+        self.blocked_seconds += time.perf_counter() - begin
+        begin = time.perf_counter()
+        snapshot = copyToHost(state)
+        snapshot["epoch"] = epoch
+        snapshot["metric"] = metric
+        self.snapshot_seconds += time.perf_counter() - begin
+        is_best = self.isBetter(metric)
+        if is_best:
+            self.best_metric = metric
+        if self.executor is None:
+            self._write(snapshot, epoch, is_best)
+        else:
+            self.pending = self.executor.submit(self._write, snapshot, epoch, is_best)
+
+    def saveProgress(self, state, epoch, cursor, num_workers=0, world_size=1):
+        """Save a checkpoint part way through an epoch, replacing the previous one.
+
+        The progress checkpoint is removed once the epoch checkpoint is written. The cursor only
+        means something for the same split of the dataset between readers, so the number of
+        dataloader workers and processes is saved with it.
+
+        Arguments:
+            state      (dict): The checkpoint, see save. It should include the random number generator
+                               states at the end of the last batch.
+            epoch       (int): The epoch in progress.
+            cursor     (dict): Number of samples read by each dataloader worker this epoch.
+            num_workers (int): Dataloader workers of each process.
+            world_size  (int): Number of training processes.
+        """
+        begin = time.perf_counter()
+        self.wait()
+        self.blocked_seconds += time.perf_counter() - begin
+        begin = time.perf_counter()
+        snapshot = copyToHost(state)
+        snapshot["epoch"] = epoch
+        snapshot["cursor"] = dict(cursor)
+        snapshot["readers"] = {"num_workers": num_workers, "world_size": world_size}
+        self.snapshot_seconds += time.perf_counter() - begin
+        if self.executor is None:
+            self._writeProgress(snapshot)
+        else:
+            self.pending = self.executor.submit(self._writeProgress, snapshot)
+
+    def restore(self):
+        """Continue the retention of epoch checkpoints and the best metric of an earlier run."""
+        self.saved_epochs = listEpochCheckpoints(self.outname)
+        best_path = bestCheckpointName(self.outname)
+        if os.path.exists(best_path):
+            self.best_metric = torch.load(best_path, map_location="cpu", weights_only=False).get("metric")
+
+    def _write(self, snapshot, epoch, is_best):
+        """Write a checkpoint and update the newest and best names and the retained files."""
+        begin = time.perf_counter()
+        epoch_path = epochCheckpointName(self.outname, epoch)
+        self.bytes_written += writeAtomically(snapshot, epoch_path)
+        replaceFile(epoch_path, self.outname)
+        if is_best:
+            replaceFile(epoch_path, bestCheckpointName(self.outname))
+        if epoch in self.saved_epochs:
+            self.saved_epochs.remove(epoch)
+        self.saved_epochs.append(epoch)
+        while self.keep_last < len(self.saved_epochs):
+            old_path = epochCheckpointName(self.outname, self.saved_epochs.pop(0))
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        # The finished epoch supersedes its progress checkpoint
+        progress_path = progressCheckpointName(self.outname)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        self.write_seconds += time.perf_counter() - begin
+        self.saves += 1
+        logging.info(f"Saved checkpoint {epoch_path} in {time.perf_counter() - begin:.2f}s")
+
+    def _writeProgress(self, snapshot):
+        """Write a progress checkpoint."""
+        begin = time.perf_counter()
+        self.bytes_written += writeAtomically(snapshot, progressCheckpointName(self.outname))
+        self.write_seconds += time.perf_counter() - begin
+        self.saves += 1
+
+    def wait(self):
+        """Wait for the pending write to finish. Errors from the write are raised here."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        """Finish writing and stop the background thread."""
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def summary(self):
+        """Return a description of the time spent on checkpoints."""
+        megabytes = self.bytes_written / 2**20
+        rate = megabytes / self.write_seconds if 0 < self.write_seconds else 0.0
+        return (f"Wrote {self.saves} checkpoints ({megabytes:.1f}MB) in {self.write_seconds:.2f}s "
+                f"({rate:.1f}MB/s), training spent {self.snapshot_seconds:.2f}s copying them to host "
+                f"memory and {self.blocked_seconds:.2f}s waiting for earlier writes")
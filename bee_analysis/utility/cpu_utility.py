@@ -0,0 +1,65 @@
+#! /usr/bin/python3
+"""
+Utility functions for training and evaluating efficiently, especially on the cpu.
+
+These cover the settings that matter most without a GPU: the number of threads, bfloat16 autocast
+on processors with native bfloat16 support (AVX512-BF16 or AMX), the channels last memory format
+that the oneDNN convolutions prefer, torch.compile, and folding BatchNorm layers into the
+convolutions before them for evaluation.
+"""
+import copy
+import logging
+
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def configureThreads(num_threads=None, num_interop_threads=None):
+    """Set the number of threads used inside of operations and to run operations in parallel.
+
+    Must be called before any parallel work. None keeps the torch default, which is one thread per
+    physical core for intra-op parallelism. Dataloader workers and distributed training processes
+    share the cores, so each process should get fewer threads when there are several.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    logging.info(f"Using {torch.get_num_threads()} threads and {torch.get_num_interop_threads()} "
+                 "inter-op threads")
+
+
+def bf16Supported(device):
+    """Return True if the device computes in bfloat16 natively.
+
+    Autocast to bfloat16 works on any cpu, but without hardware support it is slower than float32.
+    """
+    device = torch.device(device)
+    if "cuda" == device.type:
+        return torch.cuda.is_bf16_supported()
+    if "cpu" == device.type:
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    return False
+
+
+def fuseConvBatchNorm(net):
+    """Return a copy of the network for evaluation with each BatchNorm folded into the convolution before it.
+
+    Only a Conv2d followed directly by a BatchNorm2d in the same nn.Sequential is fused; the
+    BatchNorm is replaced by an identity. Evaluation then runs one oneDNN convolution instead of a
+    convolution and a normalization. The copy is in eval mode and must not be trained.
+    """
+    fused = copy.deepcopy(net).eval()
+    fused_count = 0
+    for module in fused.modules():
+        if not isinstance(module, torch.nn.Sequential):
+            continue
+        for idx in range(len(module) - 1):
+            conv, norm = module[idx], module[idx + 1]
+            if (isinstance(conv, torch.nn.Conv2d) and isinstance(norm, torch.nn.BatchNorm2d)
+                    and norm.track_running_stats):
+                module[idx] = fuse_conv_bn_eval(conv, norm)
+                module[idx + 1] = torch.nn.Identity()
+                fused_count += 1
+    logging.debug(f"Fused {fused_count} BatchNorm layers into convolutions")
+    return fused
@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+"""
+Utility functions for choosing DataLoader settings by measuring them.
+
+The best number of workers and prefetch depth depend on the cores of the node, the storage, and the
+dataset format, so tuneLoader briefly reads batches with each combination from a small grid and keeps
+the fastest. Results are cached per host and dataset format (see loaderCachePath) so that later runs
+on the same node start right away.
+"""
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+
+import torch
+
+from utility.prefetch_utility import batchTensors
+
+
+def workerCount(value):
+    """Parse a number of dataloader workers for argparse, or "auto" to measure them with tuneLoader."""
+    if "auto" == value:
+        return value
+    return int(value)
+
+
+def availableCores():
+    """Return the number of cores that this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def loaderCachePath():
+    """Return the file of cached DataLoader settings, $BEE_LOADER_CACHE or under ~/.cache."""
+    return os.environ.get("BEE_LOADER_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bee_analysis", "dataloader_settings.json"))
+
+
+def readLoaderCache(cache_path):
+    """Return the cached settings, an empty dict if there are none or the file cannot be read."""
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def writeLoaderCache(cache_path, cache):
+    """Write the cached settings to a temporary file and rename it into place."""
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    temp_name = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_name, "w") as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(temp_name, cache_path)
+
+
+def candidateSettings(max_workers):
+    """Return the (num_workers, prefetch_factor) pairs to measure.
+
+    Worker counts are 0, the powers of two below max_workers, and max_workers. The prefetch factor
+    only applies with workers.
+    """
+    worker_counts = [0]
+    workers = 1
+    while workers < max_workers:
+        worker_counts.append(workers)
+        workers *= 2
+    if 0 < max_workers:
+        worker_counts.append(max_workers)
+    return [(workers, prefetch) for workers in worker_counts for prefetch in ([None] if 0 == workers else [2, 4])]
+
+
+def measureLoader(dataloader, max_batches=50, max_seconds=3.0, warmup_batches=2):
+    """Return the samples per second read from a DataLoader.
+
+    The first warmup_batches, which include starting the workers, are not timed. Reading stops after
+    max_batches or max_seconds.
+    """
+    samples = 0
+    begin = None
+    for batch_num, batch in enumerate(dataloader):
+        if batch_num == warmup_batches:
+            begin = time.perf_counter()
+        elif begin is not None:
+            samples += batchTensors(batch)[0].size(0)
+            if max_batches <= batch_num or max_seconds < time.perf_counter() - begin:
+                break
+    if begin is None or 0 == samples:
+        return 0.0
+    return samples / (time.perf_counter() - begin)
+
+
+def tuneLoader(dataset, dataset_format, device, max_workers=None, max_seconds=3.0, cache_path=None,
+               **loader_args):
+    """Measure DataLoader settings for a dataset and return the fastest, or the cached choice.
+
+    Persistent workers keep their copy of the dataset between epochs, so they are only used for
+    datasets without set_epoch. Memory is only pinned for cuda devices.
+
+    Arguments:
+        dataset          (Dataset): Dataset to read from. Reading it must not change it.
+        dataset_format       (str): Cache key for the kind of dataset, such as "flatbin-mmap".
+        device      (torch.device): Device that the batches are for.
+        max_workers          (int): Most workers to try, by default the available cores.
+        max_seconds        (float): Time to measure each setting.
+        cache_path           (str): Cache file, see loaderCachePath.
+        loader_args               : Other DataLoader arguments, such as batch_size and collate_fn.
+    Returns:
+        dict: num_workers, prefetch_factor, persistent_workers, and pin_memory for the DataLoader.
+    """
+    cache_path = cache_path or loaderCachePath()
+    key = f"{socket.gethostname()}/{dataset_format}"
+    cache = readLoaderCache(cache_path)
+    if key in cache:
+        settings = cache[key]
+        logging.info(f"Using cached dataloader settings for {key}: {settings['num_workers']} workers, "
+                     f"prefetch factor {settings['prefetch_factor']}")
+    else:
+        if max_workers is None:
+            max_workers = availableCores()
+        results = []
+        for num_workers, prefetch_factor in candidateSettings(max_workers):
+            dataloader = torch.utils.data.DataLoader(dataset, num_workers=num_workers,
+                                                     prefetch_factor=prefetch_factor, **loader_args)
+            samples_per_second = measureLoader(dataloader, max_seconds=max_seconds)
+            logging.info(f"{num_workers} workers with prefetch factor {prefetch_factor} read "
+                         f"{samples_per_second:.1f} samples/s")
+            results.append((samples_per_second, num_workers, prefetch_factor))
+        best_rate = max(result[0] for result in results)
+        # Within 5% of the best, fewer workers leave more cores and memory for training
+        candidates = [result for result in results if 0.95 * best_rate <= result[0]]
+        _, num_workers, prefetch_factor = min(candidates, key=lambda result: (result[1], result[2] or 0))
+        settings = {"num_workers": num_workers, "prefetch_factor": prefetch_factor,
+                    "samples_per_second": best_rate, "date": datetime.date.today().isoformat()}
+        # Another process may have tuned a different format in the meantime
+        cache = readLoaderCache(cache_path)
+        cache[key] = settings
+        writeLoaderCache(cache_path, cache)
+        logging.info(f"Chose {num_workers} dataloader workers with prefetch factor {prefetch_factor} for {key}")
+    return {
+        "num_workers": settings["num_workers"],
+        "prefetch_factor": settings["prefetch_factor"],
+        "persistent_workers": 0 < settings["num_workers"] and not hasattr(dataset, "set_epoch"),
+        "pin_memory": "cuda" == torch.device(device).type,
+    }
@@ -3,13 +3,19 @@
 """
 Utility functions for dataloading with webdatasets.
 """
+import functools
+import io
 import torch
 import webdataset as wds
 import numpy
 
+from PIL import Image
+
 from torch import tensor, Tensor
 
-from utility.flatbin_dataset import FlatbinDataset, InterleavedFlatbinDatasets
+from utility.eval_utility import BatchedOnlineStatistics
+from utility.flatbin_dataset import (checkFlatbin, combineSummaries, FlatbinDataset, FlatbinMapDataset,
+        InterleavedFlatbinDatasets, readSidecar)
 
 
 def decodeUTF8ListOrNumber(encoded_str):
@@ -70,28 +76,218 @@ def extractVectors(dl_tuple, vector_range):
         return torch.cat(tensors, 1)
 
 
-def makeDataset(data_path, decode_strs, img_format=None, shuffle=False, shardshuffle=False):
-    """Return a dataloader for either a webdataset or a flat binary file."""
-    if (isinstance(data_path, str) and data_path.endswith(".tar")) or data_path[0].endswith(".tar"):
-        # Check the size of the labels
+def decodePNG(key, data, img_format="L", as_uint8=False):
+    """Webdataset decoder for png entries, see makeDataset.
+
+    Images are returned in channels x height x width order, like those from flat binary files. They
+    are uint8 if as_uint8 is set, otherwise floats from 0 to 1.
+
+    Arguments:
+        key        (str): Name of the entry.
+        data     (bytes): The encoded entry.
+        img_format (str): "L" for luminance or "RGB".
+    Returns:
+        torch.tensor or None: The image, or None for other entries, which are left to the other decoders.
+    """
+    if not key.endswith(".png"):
+        return None
+    with Image.open(io.BytesIO(data)) as img:
+        image = torch.from_numpy(numpy.array(img.convert(img_format)))
+    image = image.unsqueeze(0) if 2 == image.dim() else image.permute(2, 0, 1)
+    return image if as_uint8 else image.to(torch.float) / 255.0
+
+
+def isWebdataset(data_path):
+    """Return True if the path (or the first of a list of paths) is a webdataset tar file."""
+    return (isinstance(data_path, str) and data_path.endswith(".tar")) or data_path[0].endswith(".tar")
+
+
+def selectEntries(names, sample):
+    """Keep only the named entries (and the webdataset keys) of a webdataset sample."""
+    return {key: value for key, value in sample.items() if key in names or key.startswith("__")}
+
+
+def addSourceIndex(urls, sample):
+    """Add the index of the shard that a webdataset sample came from as its "__source__" entry."""
+    sample["__source__"] = urls.index(sample["__url__"])
+    return sample
+
+
+def makeDataset(data_path, decode_strs, img_format=None, shuffle=False, shardshuffle=False, use_mmap=False,
+        map_style=False, shuffle_block=None, shuffle_pool=8, seed=0, weights=None, uint8_images=False,
+        batch_size=None, source_index=False, sample_index=False):
+    """Return a dataloader for either a webdataset or a flat binary file.
+
+    Set use_mmap to memory map flat binary files rather than reading them. Set map_style to read flat
+    binary files by sample index, so that they can be shuffled and used with samplers. Webdatasets
+    are always iterable.
+    Set shuffle_block to read flat binary files in blocks of that many samples in a random order,
+    shuffling the samples of shuffle_pool blocks at a time. Call set_epoch to change the order.
+    Weights set the relative chance of reading the next sample from each of several flat binary
+    files.
+    Set uint8_images to return images as uint8 rather than float, which train_utility.prepareImages
+    converts on the training device.
+    Webdataset shards are split between nodes and dataloader workers, shuffle is the size of the
+    sample shuffle buffer, and only the entries in decode_strs are decoded. Set batch_size to batch
+    webdataset samples inside of the dataloader workers; the DataLoader must then have batch_size=None.
+    Set source_index to add the index of the file in data_path that each sample came from to the end
+    of the sample. Set sample_index to add the index of each sample in a map style dataset instead,
+    which a map style dataset without sample_index can use to read the sample again.
+    """
+    if source_index and map_style:
+        raise ValueError("Map style datasets cannot return the source index of their samples")
+    if sample_index and not map_style:
+        raise ValueError("Only map style datasets can return the index of their samples")
+    if isWebdataset(data_path):
+        wanted = set(decode_strs)
+        dataset = (
+            wds.WebDataset(data_path, shardshuffle=shardshuffle, nodesplitter=wds.split_by_node,
+                           workersplitter=wds.split_by_worker)
+            # Drop unused entries before they are buffered or decoded
+            .map(functools.partial(selectEntries, wanted))
+        )
         if shuffle:
-            dataset = (
-                wds.WebDataset(data_path, shardshuffle=shardshuffle)
-                .decode("l")
-                .to_tuple(*decode_strs)
-            )
-        else:
-            dataset = (
-                wds.WebDataset(data_path, shardshuffle=shardshuffle)
-                .decode("l")
-                .to_tuple(*decode_strs)
-                .shuffle(shuffle)
-            )
+            # Shuffle the encoded samples, which are much smaller than decoded ones
+            dataset = dataset.shuffle(shuffle)
+        tuple_strs = list(decode_strs)
+        if source_index:
+            dataset = dataset.map(functools.partial(addSourceIndex,
+                                                    [data_path] if isinstance(data_path, str) else list(data_path)))
+            tuple_strs.append("__source__")
+        dataset = (
+            dataset
+            .decode(functools.partial(decodePNG, img_format=img_format or "L", as_uint8=uint8_images))
+            .to_tuple(*tuple_strs)
+        )
+        if batch_size is not None:
+            dataset = dataset.batched(batch_size)
         return dataset
-    elif isinstance(data_path, list):
-        return InterleavedFlatbinDatasets(data_path, decode_strs, img_format)
+    elif map_style:
+        return FlatbinMapDataset(data_path, decode_strs, img_format, use_mmap=use_mmap,
+                uint8_images=uint8_images, sample_index=sample_index)
+    elif isinstance(data_path, list) or source_index:
+        return InterleavedFlatbinDatasets(data_path, decode_strs, img_format, use_mmap=use_mmap,
+                shuffle_block=shuffle_block, shuffle_pool=shuffle_pool, seed=seed, weights=weights,
+                uint8_images=uint8_images, source_index=source_index)
     else:
-        return FlatbinDataset(data_path, decode_strs, img_format)
+        return FlatbinDataset(data_path, decode_strs, img_format, use_mmap=use_mmap,
+                shuffle_block=shuffle_block, shuffle_pool=shuffle_pool, seed=seed,
+                uint8_images=uint8_images)
+
+
+def checkDatasetFiles(data_path):
+    """Check that every flat binary file in the dataset is complete, see flatbin_dataset.checkFlatbin.
+
+    Webdatasets are not checked. Raises a ValueError for the first bad file.
+    """
+    paths = [data_path] if isinstance(data_path, str) else data_path
+    for path in paths:
+        if not path.endswith(".tar"):
+            checkFlatbin(path)
+
+
+def readDatasetSummary(data_path):
+    """Read the summary sidecars written with the dataset files, see flatbin_dataset.summarizeValues.
+
+    Returns:
+        dict or None: The summary of all of the files, or None if any file lacks an up to date sidecar.
+    """
+    paths = [data_path] if isinstance(data_path, str) else data_path
+    summaries = [readSidecar(path) for path in paths]
+    if not summaries or None in summaries:
+        return None
+    return combineSummaries(summaries)
+
+
+def getLabelStatistics(data_path, names):
+    """Return the means and variances of the given entries from the dataset summary.
+
+    Arguments:
+        data_path (str or list[str]): Path to the dataset file(s).
+        names            (list[str]): Names of the entries.
+    Returns:
+        (torch.tensor, torch.tensor) or None: Concatenated means and population variances, or None
+                                              if the summary does not have them.
+    """
+    summary = readDatasetSummary(data_path)
+    if summary is None or not all(name in summary["statistics"] for name in names):
+        return None
+    means = [value for name in names for value in summary["statistics"][name]["mean"]]
+    variances = [value for name in names for value in summary["statistics"][name]["variance"]]
+    return torch.tensor(means, dtype=torch.float64), torch.tensor(variances, dtype=torch.float64)
+
+
+def readVectorColumns(data_path, names):
+    """Read the given fixed-width entries of every sample without reading any images.
+
+    Only flat binary files support this. Version 2 files store the entries as columns, so this only
+    reads a small section at the end of the file.
+
+    Arguments:
+        data_path (str or list[str]): Path to flat binary file(s).
+        names            (list[str]): Names of the entries to read.
+    Returns:
+        torch.tensor or None: A (samples, elements) tensor, or None for webdatasets.
+    """
+    dataset = makeDataset(data_path, names)
+    if not isinstance(dataset, (FlatbinDataset, InterleavedFlatbinDatasets)):
+        return None
+    columns = [torch.from_numpy(numpy.asarray(dataset.readColumn(name))) for name in names]
+    columns = [column.unsqueeze(1) if 1 == column.dim() else column for column in columns]
+    return torch.cat(columns, 1)
+
+
+def computeVectorStatistics(data_path, names, size, batch_size=1024, num_workers=0):
+    """Compute the means and variances of the given entries by reading through the dataset.
+
+    Only the named entries are decoded, never the images. Webdataset samples are batched inside of
+    the dataloader workers. Each process of distributed training only reads its own share of the
+    dataset, so merge the results with distributed_utility.reduceStats.
+
+    Arguments:
+        data_path (str or list[str]): Path to the dataset file(s).
+        names            (list[str]): Names of the entries.
+        size                   (int): Total number of elements in the entries.
+        batch_size             (int): Number of samples read at a time.
+        num_workers            (int): Number of dataloader workers.
+    Returns:
+        BatchedOnlineStatistics: Statistics of each element of the concatenated entries.
+    """
+    stats = BatchedOnlineStatistics(size)
+    if isWebdataset(data_path):
+        dataset = makeDataset(data_path, names, batch_size=batch_size)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    else:
+        dataset = makeDataset(data_path, names)
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    for batch in dataloader:
+        stats.sample(extractVectors(batch, slice(0, len(names))))
+    return stats
+
+
+def getClassHistogram(data_path, label_name="cls", columns_only=False):
+    """Count the samples of each class, without reading any images.
+
+    Arguments:
+        data_path (str or list[str]): Path to flat binary file(s).
+        label_name             (str): Name of the class entry.
+        columns_only          (bool): Return None unless every file stores the class as a column,
+                                      so that the count never requires a scan through the samples.
+    Returns:
+        numpy.ndarray or None: Count of each class value, or None for webdatasets without a summary.
+    """
+    summary = readDatasetSummary(data_path)
+    if summary is not None and label_name in summary["class_histograms"]:
+        return numpy.array(summary["class_histograms"][label_name])
+    if columns_only:
+        dataset = makeDataset(data_path, [label_name])
+        datasets = getattr(dataset, "datasets", [dataset])
+        if not all(label_name in getattr(ds, "columns", {}) for ds in datasets):
+            return None
+    labels = readVectorColumns(data_path, [label_name])
+    if labels is None:
+        return None
+    return numpy.bincount(labels[:, 0].numpy().astype(numpy.int64))
 
 
 def getUnflatVectorSize(data_path, decode_strs, vector_range):
@@ -103,6 +299,11 @@ def getUnflatVectorSize(data_path, decode_strs, vector_range):
     Returns:
         label_sizes  (list[int]): The sizes of labels in the dataset.
     """
+    # The summary sidecars of the dataset files answer this without reading any samples
+    summary = readDatasetSummary(data_path)
+    names = decode_strs[vector_range]
+    if summary is not None and all(name in summary["vector_sizes"] for name in names):
+        return [summary["vector_sizes"][name] for name in names]
     dataset = makeDataset(data_path, decode_strs)
     if isinstance(dataset, FlatbinDataset):
         return [dataset.getDataSize(index) for index in range(vector_range.start, vector_range.stop)]
@@ -123,6 +324,11 @@ def getVectorSize(data_path, decode_strs, vector_range):
     Returns:
         label_size  (int): The size of labels in the dataset.
     """
+    # The summary sidecars of the dataset files answer this without reading any samples
+    summary = readDatasetSummary(data_path)
+    names = decode_strs[vector_range]
+    if summary is not None and all(name in summary["vector_sizes"] for name in names):
+        return sum(summary["vector_sizes"][name] for name in names)
     dataset = makeDataset(data_path, decode_strs)
     if isinstance(dataset, FlatbinDataset):
         return sum([dataset.getDataSize(index) for index in range(vector_range.start, vector_range.stop)])
@@ -145,6 +351,10 @@ def getImageSize(data_path, decode_strs, img_format=None):
     Returns:
         image_size  (int): The size of images in the dataset.
     """
+    # The summary sidecars of the dataset files answer this without reading any samples
+    summary = readDatasetSummary(data_path)
+    if summary is not None and summary["image_shape"] is not None:
+        return torch.Size(summary["image_shape"])
     # We are assuming that the image name is in the first entry of decode strs.
     # This function is a bit hacky
     dataset = makeDataset(data_path, decode_strs, img_format)
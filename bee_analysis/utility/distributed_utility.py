@@ -0,0 +1,95 @@
+#! /usr/bin/python3
+"""
+Utility functions for data parallel training with torch.distributed.
+
+Training runs one process per device. Each process reads its own part of the dataset (see
+flatbin_dataset.readerShard and webdataset.split_by_node) and DistributedDataParallel averages the
+gradients. Statistics are merged across the processes and only the first process (rank 0) logs,
+saves checkpoints, and makes plots.
+"""
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def initDistributed(use_cuda=None):
+    """Join the process group described by the environment.
+
+    torchrun sets RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, and MASTER_PORT. When started with srun
+    the slurm task variables are used instead, with the node that launched the job as the master.
+    The nccl backend is used with cuda devices and gloo on the cpu.
+
+    Arguments:
+        use_cuda (bool): Train on the GPUs, defaults to True when cuda is available.
+
+    Returns:
+        (int, int, int): The rank, the world size, and the rank within this node.
+    """
+    if "RANK" not in os.environ and "SLURM_PROCID" in os.environ:
+        os.environ["RANK"] = os.environ["SLURM_PROCID"]
+        os.environ["WORLD_SIZE"] = os.environ["SLURM_NTASKS"]
+        os.environ["LOCAL_RANK"] = os.environ.get("SLURM_LOCALID", "0")
+        os.environ.setdefault("MASTER_ADDR", os.environ.get("SLURM_LAUNCH_NODE_IPADDR", "127.0.0.1"))
+        os.environ.setdefault("MASTER_PORT", "29500")
+    rank = int(os.environ.get("RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if 1 < world_size and not dist.is_initialized():
+        if use_cuda is None:
+            use_cuda = torch.cuda.is_available()
+        if use_cuda:
+            torch.cuda.set_device(local_rank)
+            dist.init_process_group("nccl")
+        else:
+            dist.init_process_group("gloo")
+    return rank, world_size, local_rank
+
+
+def isDistributed():
+    """Return True if this process is part of a process group."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def isMainProcess():
+    """Return True unless this is a process other than rank 0 of a process group."""
+    return not isDistributed() or 0 == dist.get_rank()
+
+
+def worldSize():
+    """Return the number of training processes."""
+    return dist.get_world_size() if isDistributed() else 1
+
+
+def reduceStats(stats):
+    """Merge the ConfusionMatrix or RegressionResults of every process into stats.
+
+    Every process must call this. Returns stats, which then holds the results of all processes.
+    """
+    if not isDistributed():
+        return stats
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, stats)
+    for rank, other in enumerate(gathered):
+        if rank != dist.get_rank():
+            stats.merge(other)
+    return stats
+
+
+def reduceMean(total, count):
+    """Return the mean of values summed into total over count samples, across every process.
+
+    Every process must call this.
+    """
+    if isDistributed():
+        device = "cuda" if "nccl" == dist.get_backend() else "cpu"
+        values = torch.tensor([float(total), float(count)], dtype=torch.float64, device=device)
+        dist.all_reduce(values)
+        total, count = values.tolist()
+    return total / count if 0 < count else float("nan")
+
+
+def cleanupDistributed():
+    """Leave the process group, if this process is in one."""
+    if isDistributed():
+        dist.destroy_process_group()
@@ -2,7 +2,6 @@
 """
 Utility functions and classes for evaluating model performance.
 """
-import heapq
 import math
 import os
 
@@ -42,6 +41,22 @@ class OnlineStatistics:
     def max(self):
         return self._max
 
+    def merge(self, other):
+        """Add the population of another OnlineStatistics to this one.
+
+        Uses the parallel variant of the algorithm (Chan et al.):
+        https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+        """
+        if 0 == other._population:
+            return
+        if other._max is not None and (self._max is None or math.fabs(self._max) < math.fabs(other._max)):
+            self._max = other._max
+        population = self._population + other._population
+        mean_diff = other._mean - self._mean
+        self._m2 += other._m2 + mean_diff**2 * self._population * other._population / population
+        self._mean += mean_diff * other._population / population
+        self._population = population
+
     def sample(self, value):
         """Add the given value to the population.
 
@@ -64,6 +79,79 @@ class OnlineStatistics:
         self._m2 += mean_diff * new_mean_diff
 
 
+class BatchedOnlineStatistics:
+    """Calculator that tracks the running mean and variance of every element of a vector.
+
+    Gives the same results as one OnlineStatistics per element, but adds a whole batch at a time.
+    The moments of each batch are computed with tensor operations and merged into the running
+    moments with the parallel algorithm (Chan et al.):
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+
+    def __init__(self, size):
+        """Initialize the variables.
+
+        Arguments:
+            size (int): The number of elements in each vector.
+        """
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self._population = torch.zeros(self.size, dtype=torch.int64)
+        self._mean = torch.zeros(self.size, dtype=torch.float64)
+        self._m2 = torch.zeros(self.size, dtype=torch.float64)
+        self._max = torch.zeros(self.size, dtype=torch.float64)
+
+    def population(self):
+        return self._population
+
+    def mean(self):
+        return self._mean
+
+    def variance(self):
+        """Return the population variance of each element, nan for elements without any values."""
+        return torch.where(0 < self._population, self._m2 / self._population.clamp(min=1),
+                           torch.tensor(float("nan"), dtype=torch.float64))
+
+    def max(self):
+        """Return the value with the largest magnitude of each element."""
+        return self._max
+
+    def _mergeMoments(self, population, mean, m2, max_values):
+        """Merge the moments of another population of values into these."""
+        total = self._population + population
+        mean_diff = mean - self._mean
+        weight = population / total.clamp(min=1)
+        self._m2 += m2 + mean_diff**2 * self._population * weight
+        self._mean += mean_diff * weight
+        new_max = (0 < population) & ((0 == self._population) | (self._max.abs() < max_values.abs()))
+        self._max = torch.where(new_max, max_values, self._max)
+        self._population = total
+
+    def merge(self, other):
+        """Add the population of another BatchedOnlineStatistics to this one."""
+        self._mergeMoments(other._population, other._mean, other._m2, other._max)
+
+    def sample(self, values):
+        """Add a batch of vectors to the population. Nan values are ignored.
+
+        Arguments:
+            values (torch.tensor): A (batch, size) tensor, or a (batch,) tensor when size is 1.
+        """
+        values = values.detach().to("cpu", torch.float64).reshape(-1, self.size)
+        valid = ~values.isnan()
+        if not valid.all():
+            print("Ignoring nan values in BatchedOnlineStatistics.")
+        population = valid.sum(dim=0)
+        zeros = torch.zeros_like(values)
+        mean = torch.where(valid, values, zeros).sum(dim=0) / population.clamp(min=1)
+        m2 = torch.where(valid, values - mean, zeros).pow(2).sum(dim=0)
+        magnitudes = torch.where(valid, values.abs(), torch.full_like(values, -1.0))
+        max_values = values.gather(0, magnitudes.argmax(dim=0, keepdim=True))[0]
+        self._mergeMoments(population, mean, m2, max_values)
+
+
 class RegressionResults:
     """A data structure to track regression results during training."""
 
@@ -135,6 +223,14 @@ class RegressionResults:
                 for row, stat in enumerate(self.label_statistics):
                     stat.sample(labels[batch][row].item())
 
+    def merge(self, other):
+        """Add the results of another RegressionResults, such as from another training process."""
+        for stat, other_stat in zip(self.prediction_statistics, other.prediction_statistics):
+            stat.merge(other_stat)
+        self.prediction_overall.merge(other.prediction_overall)
+        for stat, other_stat in zip(self.label_statistics, other.label_statistics):
+            stat.merge(other_stat)
+
     def makeResults(self):
         """Generate human readable results.
         Returns:
@@ -209,6 +305,20 @@ class ConfusionMatrix:
                     else:
                         self.true_negatives[cidx] += 1
 
+    def merge(self, other):
+        """Add the counts of another ConfusionMatrix, such as from another training process."""
+        for row, other_row in zip(self.cmatrix, other.cmatrix):
+            for column, count in enumerate(other_row):
+                row[column] += count
+        for counts, other_counts in [(self.true_positives, other.true_positives),
+                                     (self.false_positives, other.false_positives),
+                                     (self.true_negatives, other.true_negatives),
+                                     (self.false_negatives, other.false_negatives)]:
+            for idx, count in enumerate(other_counts):
+                counts[idx] += count
+        self.prediction_count += other.prediction_count
+        self.correct_count += other.correct_count
+
     def accuracy(self, epsilon=1e-20):
         """Return the accuracy of predictions in this ConfusionMatrix.
 
@@ -265,47 +375,31 @@ class ConfusionMatrix:
         return results
 
 
-# Need a special comparison function that won't attempt to do something that tensors do not
-# support. Used if args.save_top_n or args.save_worst_n are used.
-class MaxNode:
-    """ """
-
-    def __init__(self, score, label, prediction, image, metadata, mask):
-        self.score = score
-        self.label = label
-        self.prediction = prediction
-        self.image = image
-        self.metadata = metadata
-        self.mask = mask
-
-    def __lt__(self, other):
-        return self.score < other.score
-
+class ExampleNode:
+    """An example kept by WorstExamples. Used if args.save_top_n or args.save_worst_n are used.
 
-# Turns the heapq from a max heap into a min heap by using greater than in the less than operator.
-class MinNode:
-    """ """
+    The image is None until it is read again with the sample index, unless the example came without
+    an index.
+    """
 
-    def __init__(self, score, label, prediction, image, metadata, mask):
+    def __init__(self, score, label, prediction, image, metadata, mask, index=None):
         self.score = score
         self.label = label
         self.prediction = prediction
         self.image = image
         self.metadata = metadata
         self.mask = mask
-
-    def __lt__(self, other):
-        return self.score > other.score
+        self.index = index
 
 
 def saveWorstN(worstn, worstn_path, classname, vis_func=None):
     """Saves samples from the priority queue worstn into the given path.
 
     Arguments:
-        worstn (List[MaxNode or MinNode]): List of nodes with data to save.
-        worstn_path                 (str): Path to save outputs.
-        classname                   (str): Classname for these images.
-        vis_func               (function): Extra processing to display the label and DNN output on the image.
+        worstn (List[ExampleNode]): List of nodes with data to save.
+        worstn_path          (str): Path to save outputs.
+        classname            (str): Classname for these images.
+        vis_func        (function): Extra processing to display the label and DNN output on the image.
     """
     for i, node in enumerate(worstn):
         img = transforms.ToPILImage()(node.image).convert("L")
@@ -337,14 +431,22 @@ def saveWorstN(worstn, worstn_path, classname, vis_func=None):
 
 
 class WorstExamples:
-    """Class to store the worst (or best) examples during training or validation."""
+    """Class to store the worst (or best) examples during training or validation.
+
+    Whole batches are tested at once: torch.topk selects the examples of each class that beat the
+    ones kept so far. Only the score, label, prediction, metadata, and sample index of the kept
+    examples are stored, and their images are read again from the reader when they are saved.
+    Examples without a sample index keep a copy of their image instead, which is bounded by the
+    number of examples to save.
+    """
 
     def __init__(self,
                  path,
                  class_names,
                  num_to_save,
                  worst_mode=True,
-                 vis_func=None):
+                 vis_func=None,
+                 reader=None):
         """
 
         Arguments:
@@ -353,6 +455,8 @@ class WorstExamples:
             num_to_save   (int):
             worst_mode   (bool): True to save the worst examples, false to save the best.
             vis_func (function): Extra processing to display the label and DNN output on the image.
+            reader    (Dataset): Random access dataset whose samples begin with the image of the
+                                 example, such as a FlatbinMapDataset. Used with sample indices.
         """
         self.worstn_path = path
         # Create the directory if it does not exist
@@ -360,72 +464,70 @@ class WorstExamples:
             os.mkdir(self.worstn_path)
         except FileExistsError:
             pass
-        # Save worst examples for each of the classes.
+        # Save worst examples for each of the classes, along with a tensor of their scores.
         self.worstn = [[] for i in range(len(class_names))]
+        self.scores = [torch.zeros(0, dtype=torch.float64) for i in range(len(class_names))]
         self.n = num_to_save
         self.class_names = class_names
-        if worst_mode:
-            self.test = self.greater_than_test
-        else:
-            self.test = self.less_than_test
-
+        self.worst_mode = worst_mode
         self.vis_func = vis_func
+        self.reader = reader
 
-    def less_than_test(self, label_position, label_value, nn_output, image,
-                       metadata):
-        """Test and possibly insert a new example.
-
-        Arguments:
-            label_position (int): Desired model class output
-            label_value  (float): Desired value for this label
-            nn_output    (float): Model output for this class
-            image       (tensor): Image for this example
-            metadata      (dict): Metadata for this example
-        """
-        # Insert into an empty heap or replace the largest value in the minheap and heapify. The
-        # greatest value is in the first position.
-        error = abs(label_value[label_position] - nn_output[label_position])
-
-        # If there are empty slots then just insert.
-        if len(self.worstn[label_position]) < self.n:
-            heapq.heappush(
-                self.worstn[label_position],
-                MinNode(error, label_value, nn_output, image, metadata, None),
-            )
-        # Otherwise check to see if this should be inserted
-        elif error < self.worstn[label_position][0].score:
-            heapq.heapreplace(
-                self.worstn[label_position],
-                MinNode(error, label_value, nn_output, image, metadata, None),
-            )
-
-    def greater_than_test(self, label_position, label_value, nn_output, image,
-                          metadata):
-        """Test and possibly insert a new example.
+    def testBatch(self, labels, outputs, images, metadata, indices=None):
+        """Test a batch of examples and keep any that are worse (or better) than the kept ones.
 
         Arguments:
-            label_position (int): Desired model class output
-            label_value  (float): Desired value for this label
-            nn_output    (float): Model output for this class
-            image       (tensor): Image for this example
-            metadata      (dict): Metadata for this example
+            labels   (tensor): Desired model outputs, (batch, classes)
+            outputs  (tensor): Model outputs, (batch, classes)
+            images   (tensor): The image of each example, only copied if indices is None
+            metadata  ([str]): Metadata for each example
+            indices  (tensor): Index of each example in the reader, or None
         """
-        # Insert into an empty heap or replace the smallest value in the maxheap and heapify. The
-        # greatest value is in the first position.
-        error = abs(label_value[label_position] - nn_output[label_position])
-
-        # If there are empty slots then just insert.
-        if len(self.worstn[label_position]) < self.n:
-            heapq.heappush(
-                self.worstn[label_position],
-                MaxNode(error, label_value, nn_output, image, metadata, None),
-            )
-        # Otherwise check to see if this should be inserted
-        elif error > self.worstn[label_position][0].score:
-            heapq.heapreplace(
-                self.worstn[label_position],
-                MaxNode(error, label_value, nn_output, image, metadata, None),
-            )
+        # The best and worst comparisons use absolute values of the error of each output
+        errors = (labels.detach().double() - outputs.detach().double()).abs().cpu()
+        labels_list = outputs_list = None
+        for label_position in range(min(errors.size(1), len(self.worstn))):
+            kept = self.scores[label_position]
+            candidates = torch.cat((kept, errors[:, label_position]))
+            count = min(self.n, candidates.size(0))
+            _, selected = torch.topk(candidates, count, largest=self.worst_mode, sorted=False)
+            new_rows = (selected[len(kept) <= selected] - len(kept)).tolist()
+            if 0 == len(new_rows):
+                continue
+            kept_positions = selected[selected < len(kept)]
+            # Move the rest of the batch off of the device only once some example is kept
+            if labels_list is None:
+                labels_list = labels.tolist()
+                outputs_list = outputs.tolist()
+                if indices is not None:
+                    indices = torch.as_tensor(indices).tolist()
+            nodes = [self.worstn[label_position][position] for position in kept_positions.tolist()]
+            for row in new_rows:
+                # Clone the image so that the rest of the batch is not kept with it
+                image = images[row].cpu().clone() if indices is None else None
+                nodes.append(ExampleNode(errors[row, label_position].item(), labels_list[row],
+                                         outputs_list[row], image, metadata[row], None,
+                                         None if indices is None else indices[row]))
+            self.worstn[label_position] = nodes
+            self.scores[label_position] = torch.cat((kept[kept_positions], errors[new_rows, label_position]))
+
+    def fetchImages(self):
+        """Read the images of the kept examples from the reader, in a single pass."""
+        nodes = [node for class_nodes in self.worstn for node in class_nodes
+                 if node.image is None and node.index is not None]
+        if 0 == len(nodes):
+            return
+        if self.reader is None:
+            raise ValueError("WorstExamples needs a reader to read examples by their sample index")
+        indices = sorted(set(node.index for node in nodes))
+        if hasattr(self.reader, "__getitems__"):
+            samples = self.reader.__getitems__(indices)
+        else:
+            samples = [self.reader[index] for index in indices]
+        # Flat binary datasets return numpy arrays, which the DataLoader would have collated
+        images = {index: torch.as_tensor(sample[0]) for index, sample in zip(indices, samples)}
+        for node in nodes:
+            node.image = images[node.index]
 
     def save(self, epoch=None):
         """Save worst examples for an epoch.
@@ -443,9 +545,10 @@ class WorstExamples:
             os.mkdir(worstn_path_epoch)
         except FileExistsError:
             pass
+        self.fetchImages()
         for i, classname in enumerate(self.class_names):
             saveWorstN(
-                worstn=self.worstn[i],
+                worstn=sorted(self.worstn[i], key=lambda node: node.score, reverse=self.worst_mode),
                 worstn_path=worstn_path_epoch,
                 classname=classname,
                 vis_func=self.vis_func,
@@ -6,11 +6,15 @@ Dataset that loads flatbinary files.
 
 import io
 import functools
+import itertools
+import json
+import math
+import multiprocessing
 import numpy
 import os
-import random
 import struct
 import torch
+import zlib
 
 from PIL import Image
 
@@ -34,23 +38,28 @@ def getPatchDatatypes():
 # The read and write handling functions.
 # These are used when decoding or writing a flat binary file.
 
-def img_handler(binfile, img_format=None):
-    img_len = int.from_bytes(binfile.read(4), byteorder='big')
-    bin_data = binfile.read(img_len)
-    with io.BytesIO(bin_data) as img_stream:
-        img = Image.open(img_stream)
-        img.load()
-        # Decode the image according to the requested format or return the format as written
-        # NOTE Only handling RGB and grayscale (L) images currently.
-        if (img_format is None and img.mode == "RGB") or img_format == "RGB":
-            img_data = numpy.array(img.convert("RGB")).astype(numpy.float32) / 255.0
-        elif (img_format is None and img.mode == "L") or img_format == "L":
-            img_data = numpy.array(img.convert("L")).astype(numpy.float32) / 255.0
+def _decode_img(img_stream, img_format=None, as_uint8=False):
+    """Decode an image from a stream into an array in channels x height x width order.
+
+    The array holds floats from 0 to 1, or the stored uint8 values if as_uint8 is set. Keeping uint8
+    values moves a quarter of the bytes between processes and to the training device, where
+    train_utility.prepareImages converts them.
+    """
+    img = Image.open(img_stream)
+    img.load()
+    # Decode the image according to the requested format or return the format as written
+    # NOTE Only handling RGB and grayscale (L) images currently.
+    if (img_format is None and img.mode == "RGB") or img_format == "RGB":
+        img_data = numpy.array(img.convert("RGB"))
+    elif (img_format is None and img.mode == "L") or img_format == "L":
+        img_data = numpy.array(img.convert("L"))
+    else:
+        if img_format is None:
+            raise RuntimeError("Unhandled image format: {}".format(img.mode))
         else:
-            if img_format is None:
-                raise RuntimeError("Unhandled image format: {}".format(img.mode))
-            else:
-                raise RuntimeError("Unhandled image format: {}".format(img_format))
+            raise RuntimeError("Unhandled image format: {}".format(img_format))
+    if not as_uint8:
+        img_data = img_data.astype(numpy.float32) / 255.0
     # The image is in height x width x channels, which we don't want.
     # We also always want to return data with a channel, even with grayscale images
     if 3 == img_data.ndim:
@@ -61,6 +70,12 @@ def img_handler(binfile, img_format=None):
         # If there is only a single channel then numpy drops the dimension.
         return img_data
 
+def img_handler(binfile, img_format=None, as_uint8=False):
+    img_len = int.from_bytes(binfile.read(4), byteorder='big')
+    bin_data = binfile.read(img_len)
+    with io.BytesIO(bin_data) as img_stream:
+        return _decode_img(img_stream, img_format, as_uint8)
+
 # Raw bytes of a compressed png image
 def writeImgData(binfile, data):
     # Write the size and the image bytes
@@ -94,6 +109,41 @@ def writeImgData(binfile, data):
     binfile.write(len(data).to_bytes(length=4, byteorder='big', signed=False))
     binfile.write(data)
 
+def rawImgArray(data):
+    """Convert png bytes, a tensor, or a numpy array into a contiguous uint8 array in CxHxW order."""
+    if isinstance(data, (bytes, bytearray)):
+        with io.BytesIO(data) as img_stream:
+            img = Image.open(img_stream)
+            img.load()
+            data = numpy.array(img)
+        # PIL images are height x width (x channels)
+        if 2 == data.ndim:
+            data = numpy.expand_dims(data, 0)
+        else:
+            data = data.transpose((2, 0, 1))
+    elif isinstance(data, torch.Tensor):
+        data = data.numpy()
+    # Rescale if the data is in the 0-1 range
+    if data.dtype == numpy.float32 or data.dtype == numpy.float64:
+        data = (data * 255).round()
+    if 2 == data.ndim:
+        data = numpy.expand_dims(data, 0)
+    return numpy.ascontiguousarray(data, dtype=numpy.uint8)
+
+def raw_handler(shape, binfile):
+    """Handle an uncompressed uint8 image with the given (channels, height, width) shape."""
+    data = bytearray(shape[0] * shape[1] * shape[2])
+    binfile.readinto(data)
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(shape)
+
+# Uncompressed uint8 image in channels x height x width order
+def writeRawImgData(binfile, data, shape=None):
+    # The size is fixed by the header, so only the pixels are written
+    img_data = rawImgArray(data)
+    if shape is not None and img_data.shape != tuple(shape):
+        raise ValueError(f"Raw image shape {img_data.shape} does not match {tuple(shape)}")
+    binfile.write(img_data.data)
+
 def numpy_handler(binfile):
     """Handle a numpy array with a variable per sample length."""
     data_len = int.from_bytes(binfile.read(4), byteorder='big')
@@ -105,8 +155,13 @@ def numpy_handler(binfile):
 def writeNumpyWithHeader(binfile, data):
     # Write the size and the data bytes
     if not isinstance(data, bytes):
-        # Convert the numpy array to bytes if necessary
-        data = data.tobytes()
+        # Serialize arrays and tensors in the .npy format so that numpy_handler can restore the shape
+        # and dtype. Undecoded webdataset .numpy entries are already in this format.
+        if isinstance(data, torch.Tensor):
+            data = data.numpy()
+        with io.BytesIO() as data_stream:
+            numpy.lib.format.write_array(data_stream, numpy.ascontiguousarray(data), allow_pickle=False)
+            data = data_stream.getvalue()
     binfile.write(len(data).to_bytes(length=4, byteorder='big', signed=False))
     binfile.write(data)
 
@@ -204,6 +259,77 @@ def skip_tensor(data_length, binfile):
         # Handle case where we might be at the end of the file
         pass
 
+def skip_bytes(data_length, binfile):
+    """Skip a fixed-size block of data_length bytes."""
+    binfile.seek(data_length, os.SEEK_CUR)
+
+################################################
+# Handlers for memory mapped reading.
+# Each takes the mapped buffer and the offset of its data and returns the decoded value (or None
+# when skipping) along with the offset of the next entry. Fixed size data is returned as views into
+# the mapping wherever the byte order allows it.
+
+def _read_length(buf, offset):
+    """Read the 4 byte big endian length that precedes variable sized data."""
+    return int.from_bytes(buf[offset:offset+4].tobytes(), byteorder='big')
+
+def img_view_handler(buf, offset, img_format=None, as_uint8=False):
+    img_len = _read_length(buf, offset)
+    start = offset + 4
+    with io.BytesIO(buf[start:start+img_len]) as img_stream:
+        img_data = _decode_img(img_stream, img_format, as_uint8)
+    return img_data, start + img_len
+
+def numpy_view_handler(buf, offset):
+    """Return a numpy array in the .npy format as a tensor view into the mapping."""
+    data_len = _read_length(buf, offset)
+    start = offset + 4
+    # The .npy header is small, so only that part is copied to parse it.
+    with io.BytesIO(buf[start:start+min(data_len, 4096)]) as header_stream:
+        if numpy.lib.format.read_magic(header_stream) == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(header_stream)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(header_stream)
+        header_len = header_stream.tell()
+    count = int(numpy.prod(shape))
+    view = numpy.frombuffer(buf, dtype=dtype, count=count, offset=start+header_len)
+    view = view.reshape(shape, order='F' if fortran_order else 'C')
+    if not dtype.isnative:
+        # Torch cannot hold non-native byte orders, so this is the one case that requires a copy.
+        view = view.astype(dtype.newbyteorder('='))
+    return torch.from_numpy(view), start + data_len
+
+def array_view_handler_type(typechar, nmemb, buf, offset):
+    """Decode nmemb big endian values, returning the same types as array_handler_type."""
+    values = numpy.frombuffer(buf, dtype=f'>{typechar}4', count=nmemb, offset=offset)
+    if nmemb > 1:
+        return tuple(values.tolist()), offset + 4*nmemb
+    else:
+        return values[0].item(), offset + 4*nmemb
+
+def tensor_view_handler(data_length, buf, offset):
+    """Return a fixed-length float tensor as a view into the mapping."""
+    view = numpy.frombuffer(buf, dtype=numpy.float32, count=data_length, offset=offset)
+    return torch.from_numpy(view), offset + data_length*4
+
+def raw_view_handler(shape, buf, offset):
+    """Return an uncompressed uint8 image as a view into the buffer."""
+    length = shape[0] * shape[1] * shape[2]
+    view = numpy.frombuffer(buf, dtype=numpy.uint8, count=length, offset=offset)
+    return torch.from_numpy(view.reshape(shape)), offset + length
+
+def skip_image_view(buf, offset):
+    """Skip the data section of an image or other variable-length block."""
+    return None, offset + 4 + _read_length(buf, offset)
+
+def skip_tensor_view(data_length, buf, offset):
+    """Skip a section of a fixed-size block of data."""
+    return None, offset + data_length*4
+
+def skip_bytes_view(data_length, buf, offset):
+    """Skip a fixed-size block of data_length bytes."""
+    return None, offset + data_length
+
 ################################################
 # The header reading and writing functions.
 
@@ -255,7 +381,264 @@ def read_header(binfile):
             break # Stop reading if file ends unexpectedly
     return metadata
 
-def dataloaderToFlatbin(dataloader, entries, output, metadata={}, handlers={}):
+################################################
+# The footer reading and writing functions.
+# Sections that are only known once all samples are written (such as the columns of a version 2
+# file) are placed after the samples. The footer at the very end of the file locates them. It holds
+# the name, offset, and length of each section followed by the footer length and a magic string.
+# Files without a footer have no such sections.
+
+footer_magic = b"FLATBINF"
+
+def write_footer(binfile, sections):
+    """Write a footer with the given {name: (offset, length)} sections at the current position."""
+    footer_buf = io.BytesIO()
+    for name, (offset, length) in sections.items():
+        name_bytes = name.encode('utf-8')
+        footer_buf.write(len(name_bytes).to_bytes(length=4, byteorder='big', signed=False))
+        footer_buf.write(name_bytes)
+        footer_buf.write(struct.pack(">QQ", offset, length))
+    footer_content = footer_buf.getvalue()
+    binfile.write(footer_content)
+    binfile.write(len(footer_content).to_bytes(length=4, byteorder='big', signed=False))
+    binfile.write(footer_magic)
+
+def read_footer(binfile):
+    """Read the footer sections, as written by write_footer. Returns {} if there is no footer."""
+    binfile.seek(0, os.SEEK_END)
+    file_size = binfile.tell()
+    if file_size < 12:
+        return {}
+    binfile.seek(file_size - 12)
+    footer_len = int.from_bytes(binfile.read(4), byteorder='big')
+    if binfile.read(8) != footer_magic or footer_len > file_size - 12:
+        return {}
+    binfile.seek(file_size - 12 - footer_len)
+    footer_content = binfile.read(footer_len)
+    sections = {}
+    position = 0
+    while position < footer_len:
+        name_len = int.from_bytes(footer_content[position:position+4], byteorder='big')
+        position += 4
+        name = footer_content[position:position+name_len].decode('utf-8')
+        position += name_len
+        sections[name] = struct.unpack(">QQ", footer_content[position:position+16])
+        position += 16
+    return sections
+
+################################################
+# Columns of version 2 files.
+# Version 2 files store fixed-width entries (labels, vectors, and integer metadata) as little endian
+# columns in the "columns" footer section instead of inside every sample. The columns of a dataset
+# are a few kilobytes that can be read without touching the image data.
+# Each column is written as its name, a type character ('i' or 'f'), the number of elements per
+# sample, the byte length of the data, and then the data.
+
+def write_columns(binfile, columns):
+    """Write the {name: (typechar, nmemb, numpy array)} columns at the current position."""
+    for name, (typechar, nmemb, data) in columns.items():
+        name_bytes = name.encode('utf-8')
+        data = numpy.ascontiguousarray(data, dtype=f'<{typechar}4')
+        binfile.write(len(name_bytes).to_bytes(length=4, byteorder='big', signed=False))
+        binfile.write(name_bytes)
+        binfile.write(typechar.encode('utf-8'))
+        binfile.write(nmemb.to_bytes(length=4, byteorder='big', signed=False))
+        binfile.write(data.nbytes.to_bytes(length=8, byteorder='big', signed=False))
+        binfile.write(data.data)
+
+def read_columns(section):
+    """Read the columns from the bytes of the columns section.
+
+    Returns:
+        {str: numpy.ndarray}: Arrays of shape (samples,) or (samples, elements) for each column.
+    """
+    columns = {}
+    position = 0
+    while position < len(section):
+        name_len = int.from_bytes(section[position:position+4], byteorder='big')
+        position += 4
+        name = bytes(section[position:position+name_len]).decode('utf-8')
+        position += name_len
+        typechar = bytes(section[position:position+1]).decode('utf-8')
+        nmemb = int.from_bytes(section[position+1:position+5], byteorder='big')
+        data_len = int.from_bytes(section[position+5:position+13], byteorder='big')
+        position += 13
+        column = numpy.frombuffer(section, dtype=f'<{typechar}4', count=data_len // 4, offset=position)
+        columns[name] = column if 1 == nmemb else column.reshape(-1, nmemb)
+        position += data_len
+    return columns
+
+################################################
+# Block compression.
+# When a flatbin is written with compression the sample records are grouped into blocks of
+# block_samples records. Each block is written as its uncompressed and compressed lengths followed by
+# the compressed bytes. The codec and block size are stored in the header metadata.
+
+compression_codes = {None: 0, 'zlib': 1, 'lz4': 2, 'zstd': 3}
+
+def compressBlock(codec, data):
+    """Compress a block of records with the given codec."""
+    match codec:
+        case 'zlib':
+            import zlib
+            return zlib.compress(data, 1)
+        case 'lz4':
+            import lz4.frame
+            return lz4.frame.compress(data)
+        case 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor().compress(data)
+        case _:
+            raise ValueError(f"Unsupported compression: {codec}")
+
+def decompressBlock(codec_code, data, data_len):
+    """Decompress a block of records that was compressed with the codec of the given code."""
+    match codec_code:
+        case 1:
+            import zlib
+            return zlib.decompress(data)
+        case 2:
+            import lz4.frame
+            return lz4.frame.decompress(data)
+        case 3:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=data_len)
+        case _:
+            raise ValueError(f"Unsupported compression code: {codec_code}")
+
+
+class FlatbinWriter:
+    """Write the header and the sample records of a flatbin file.
+
+    Each sample is passed to writeRecord as the bytes of all of its row entries. In version 2 files
+    the fixed-width entries are passed separately and are stored as columns after the samples.
+    The footer holds the offsets of the samples (or of the compressed blocks) for random access and
+    a CRC32 checksum of every block, see verifyFlatbin.
+    """
+
+    def __init__(self, output, entries, metadata={}, compression=None, block_samples=64, columns={}):
+        """
+        Arguments:
+            output            (str): Name of the output flatbin file.
+            entries ([(str, int)]): Name and header size of each entry. The size is 0 for variable
+                                    sized entries.
+            metadata ({str:(float|int)}): Metadata information about the dataset.
+            compression       (str): None, 'zlib', 'lz4', or 'zstd'.
+            block_samples     (int): Number of samples in each compressed block.
+            columns ({str:(str, int)}): Type character ('i' or 'f') and element count of the entries
+                                        to store as columns. A version 2 file is written if any
+                                        columns are given.
+        """
+        if compression not in compression_codes:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.compression = compression
+        self.block_samples = block_samples
+        self.sample_count = 0
+        self.block = bytearray()
+        self.block_count = 0
+        self.columns = dict(columns)
+        # File offsets of each sample, or of each block when compressing, for random access
+        self.offsets = []
+        # CRC32 of every block_samples samples, or of every compressed block
+        self.checksums = []
+        self.checksum = 0
+        self.checksum_count = 0
+        # Column values are accumulated as big endian bytes, as written by the entry writers
+        self.column_data = {name: bytearray() for name in self.columns}
+
+        self.binfile = open(output, "wb")
+        # Leave a placeholder for the sample count and then write the number of entries
+        self.binfile.write((0).to_bytes(length=4, byteorder='big', signed=False))
+        self.binfile.write(len(entries).to_bytes(length=4, byteorder='big', signed=False))
+        # The data format section of the header
+        for name, size in entries:
+            name_bytes = name.encode('utf-8')
+            self.binfile.write(len(name_bytes).to_bytes(length=4, byteorder='big', signed=False))
+            self.binfile.write(name_bytes)
+            self.binfile.write(size.to_bytes(length=4, byteorder='big', signed=False))
+
+        metadata = dict(metadata)
+        if compression is not None:
+            metadata['block_compression'] = compression_codes[compression]
+            metadata['block_samples'] = block_samples
+        if self.columns:
+            metadata['flatbin_version'] = 2
+        write_header(self.binfile, metadata)
+
+    def writeRecord(self, record, column_values={}):
+        """Write the bytes of a single sample.
+
+        Arguments:
+            record               (bytes): The row entries of the sample.
+            column_values ({str: bytes}): Big endian bytes of the sample's column entries.
+        """
+        self.sample_count += 1
+        for name, value in column_values.items():
+            self.column_data[name] += value
+        if self.compression is None:
+            self.offsets.append(self.binfile.tell())
+            self.binfile.write(record)
+            self.checksum = zlib.crc32(record, self.checksum)
+            self.checksum_count += 1
+            if self.checksum_count == self.block_samples:
+                self._finishChecksum()
+        else:
+            self.block += record
+            self.block_count += 1
+            if self.block_count == self.block_samples:
+                self._writeBlock()
+
+    def _writeBlock(self):
+        if 0 == self.block_count:
+            return
+        payload = compressBlock(self.compression, bytes(self.block))
+        self.offsets.append(self.binfile.tell())
+        block_header = (len(self.block).to_bytes(length=4, byteorder='big', signed=False) +
+                len(payload).to_bytes(length=4, byteorder='big', signed=False))
+        self.binfile.write(block_header)
+        self.binfile.write(payload)
+        self.checksums.append(zlib.crc32(payload, zlib.crc32(block_header)))
+        self.block = bytearray()
+        self.block_count = 0
+
+    def _finishChecksum(self):
+        self.checksums.append(self.checksum)
+        self.checksum = 0
+        self.checksum_count = 0
+
+    def close(self):
+        """Finish any partial block, write the columns and footer, and write the sample count."""
+        self._writeBlock()
+        if 0 < self.checksum_count:
+            self._finishChecksum()
+        # The final offset marks the end of the last sample or block
+        self.offsets.append(self.binfile.tell())
+        sections = {'offsets': (self.binfile.tell(), 8 * len(self.offsets))}
+        self.binfile.write(numpy.array(self.offsets, dtype='<u8').tobytes())
+        # The checksums section begins with the number of samples in each checksum
+        sections['checksums'] = (self.binfile.tell(), 4 + 4 * len(self.checksums))
+        self.binfile.write(self.block_samples.to_bytes(length=4, byteorder='big', signed=False))
+        self.binfile.write(numpy.array(self.checksums, dtype='<u4').tobytes())
+        if self.columns:
+            columns_offset = self.binfile.tell()
+            write_columns(self.binfile, {
+                name: (typechar, nmemb, numpy.frombuffer(self.column_data[name], dtype=f'>{typechar}4'))
+                for name, (typechar, nmemb) in self.columns.items()})
+            sections['columns'] = (columns_offset, self.binfile.tell() - columns_offset)
+        write_footer(self.binfile, sections)
+        self.binfile.seek(0)
+        self.binfile.write(self.sample_count.to_bytes(length=4, byteorder='big', signed=False))
+        self.binfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def dataloaderToFlatbin(dataloader, entries, output, metadata={}, handlers={}, compression=None,
+        block_samples=64, layout_version=1):
     """
     Arguments:
         dataloader: An iterable dataloader
@@ -263,118 +646,424 @@ def dataloaderToFlatbin(dataloader, entries, output, metadata={}, handlers={}):
         output (str): Name of the output flatbin file.
         metadata ({str:(float|int)}): Metadata information about the dataset.
         handlers ({str:str}): Handle a filetype, e.g. {'cls': 'int'}
+        compression (str): Compress blocks of samples with 'zlib', 'lz4', or 'zstd'. None to disable.
+        block_samples (int): Number of samples in each compressed block.
+        layout_version (int): 1 to store every entry in the samples, 2 to store fixed-width entries as
+                              columns after the samples.
     """
     if not entries:
         raise ValueError("'entries' list cannot be empty.")
 
-    binfile = open(output, "wb")
-    # Leave a placeholder for the sample count and number of entries
-    binfile.write((0).to_bytes(length=4, byteorder='big', signed=False))
-    binfile.write(len(entries).to_bytes(length=4, byteorder='big', signed=False))
+    def unbatch(batch):
+        """Split a batch into samples."""
+        # Determine batch size. Assumes all items in batch are lists or tensors of same length.
+        if isinstance(batch[0], (torch.Tensor, list, tuple)):
+            batch_size = len(batch[0])
+        else: # Should not happen with a standard DataLoader
+             batch_size = 1
+             batch = [[item] for item in batch] # Wrap items to make it iterable
+        for i in range(batch_size):
+            yield [item[i] for item in batch]
+
+    batches = iter(dataloader)
+    first_batch = next(batches, None)
+    raw_shape = None
 
-    # --- Write the data format section of the header ---
-    datawriters = []
-    for name in entries:
-        # Write name
-        name_bytes = name.encode('utf-8')
-        binfile.write(len(name_bytes).to_bytes(length=4, byteorder='big', signed=False))
-        binfile.write(name_bytes)
+    # Each sample is written into this buffer and then passed to the FlatbinWriter
+    record = io.BytesIO()
 
+    # --- Determine the data format section of the header ---
+    datawriters = []
+    entry_sizes = []
+    # Fixed-width entries of version 2 files are written into their own buffers
+    column_types = {}
+    column_buffers = {}
+    for idx, name in enumerate(entries):
         # Determine the correct writer function
         handle_str = handlers.get(name.split('.')[-1])
 
-        is_variable_size = False
+        size = 0
+        typechar = None
         if name.endswith(".png") or handle_str == "png":
-            datawriters.append(functools.partial(writeImgData, binfile))
-            is_variable_size = True
+            writer_fn = writeImgData
+        elif name.endswith(".raw") or handle_str == "raw":
+            # Raw images are a fixed size, taken from the first sample.
+            if raw_shape is None and first_batch is not None:
+                raw_shape = rawImgArray(next(unbatch(first_batch))[idx]).shape
+            writer_fn = functools.partial(writeRawImgData, shape=raw_shape)
+            size = 0 if raw_shape is None else int(numpy.prod(raw_shape))
         elif name.endswith(".numpy") or handle_str == "numpy":
-            datawriters.append(functools.partial(writeNumpyWithHeader, binfile))
-            is_variable_size = True
+            writer_fn = writeNumpyWithHeader
         elif name.endswith(".txt") or handle_str == "txt":
             # RAW binary dump of metadata.txt
-            from flatbin_dataset import writeBinaryData
-            datawriters.append(functools.partial(writeBinaryData, binfile))
-            is_variable_size = True
+            writer_fn = writeBinaryData
         elif name.endswith(".int") or handle_str == "int":
-            datawriters.append(functools.partial(writeIntData, binfile))
-            binfile.write((1).to_bytes(length=4, byteorder='big', signed=False)) # Size = 1 element
+            writer_fn, size, typechar = writeIntData, 1, 'i'
         elif name.endswith(".float") or handle_str == "float":
-            datawriters.append(functools.partial(writeFloatData, binfile))
-            binfile.write((1).to_bytes(length=4, byteorder='big', signed=False)) # Size = 1 element
+            writer_fn, size, typechar = writeFloatData, 1, 'f'
         elif handle_str == "stoi":
-            datawriters.append(functools.partial(writeStoIData, binfile))
-            binfile.write((1).to_bytes(length=4, byteorder='big', signed=False)) # Size = 1 element
+            writer_fn, size, typechar = writeStoIData, 1, 'i'
         elif handle_str == "flexint":
-            datawriters.append(functools.partial(writeFlexIntData, binfile))
-            binfile.write((1).to_bytes(length=4, byteorder='big', signed=False)) # Size = 1 element
+            writer_fn, size, typechar = writeFlexIntData, 1, 'i'
         else:
             raise ValueError(f"Unsupported entry type for '{name}'. Please specify a handler.")
-        
-        if is_variable_size:
-            # For variable size data, write 0 as size placeholder. Not strictly needed for reading
-            # but good for consistency.
-            binfile.write((0).to_bytes(length=4, byteorder='big', signed=False))
-    
-    write_header(binfile, metadata)
+        if 2 == layout_version and typechar is not None:
+            column_types[name] = (typechar, size)
+            column_buffers[name] = io.BytesIO()
+            datawriters.append(functools.partial(writer_fn, column_buffers[name]))
+        else:
+            datawriters.append(functools.partial(writer_fn, record))
+        # For variable size data the size is 0. It is not needed for reading but keeps the header
+        # format consistent.
+        entry_sizes.append(size)
+
+    if raw_shape is not None:
+        metadata = dict(metadata)
+        metadata['raw_channels'], metadata['raw_height'], metadata['raw_width'] = raw_shape
+
+    writer = FlatbinWriter(output, list(zip(entries, entry_sizes)), metadata, compression, block_samples,
+            columns=column_types)
 
     # --- Write the data samples ---
-    sample_count = 0
-    for batch in dataloader:
-        # Determine batch size. Assumes all items in batch are lists or tensors of same length.
-        if isinstance(batch[0], (torch.Tensor, list, tuple)):
-            batch_size = len(batch[0])
-        else: # Should not happen with a standard DataLoader
-             batch_size = 1
-             batch = [[item] for item in batch] # Wrap items to make it iterable
+    if first_batch is not None:
+        for batch in itertools.chain([first_batch], batches):
+            for sample in unbatch(batch):
+                for buffer in [record] + list(column_buffers.values()):
+                    buffer.seek(0)
+                    buffer.truncate()
+                # Write the actual sample data using the prepared writers
+                for idx, datum in enumerate(sample):
+                    datawriters[idx](datum)
+                writer.writeRecord(record.getvalue(),
+                        {name: buffer.getvalue() for name, buffer in column_buffers.items()})
 
-        # Unzip the batch into per-sample lists
-        for i in range(batch_size):
-            sample = [item[i] for item in batch]
-            sample_count += 1
-
-            # Write the actual sample data using the prepared writers
-            for idx, datum in enumerate(sample):
-                datawriters[idx](datum)
-
-    # Go back to the beginning to write the final sample count
-    binfile.seek(0)
-    binfile.write(sample_count.to_bytes(length=4, byteorder='big', signed=False))
-    binfile.close()
-    print(f"Wrote {sample_count} samples to {output}")
+    writer.close()
+    writeSidecar(output, summarizeFlatbin(output))
+    print(f"Wrote {writer.sample_count} samples to {output}")
     
-class InterleavedFlatbinDatasets(torch.utils.data.IterableDataset):
-    def __init__(self, binpath, desired_data, img_format=None):
-        if not isinstance(binpath, list):
-            binpath = [binpath]
-        self.datasets = [FlatbinDataset(path, desired_data, img_format) for path in binpath]
-        
-        # Create a read order for the different datasets, interleaving them
-        if not self.datasets or all(len(ds) == 0 for ds in self.datasets):
-            self.interleave_order = []
-            return
+################################################
+# Checking files for truncation and corruption.
 
-        # Filter out empty datasets before calculating sizes
-        valid_datasets = [ds for ds in self.datasets if len(ds) > 0]
-        if not valid_datasets:
-            self.interleave_order = []
-            return
+def checkFlatbin(binpath):
+    """Check that a flatbin file is complete by reading only its header and footer.
 
-        least_dataset_size = min(len(ds) for ds in valid_datasets)
-        # Heuristic to avoid overdoing the interleave order
-        interleave_block_size = max(100, least_dataset_size)
+    This takes milliseconds, so it can run before training starts. Raises a ValueError describing the
+    first problem found.
 
-        self.interleave_order = []
-        for d_idx, dataset in enumerate(self.datasets):
-            if len(dataset) > 0:
-                # Calculate how many blocks of size 'interleave_block_size' this dataset contributes
-                num_blocks = max(1, len(dataset) // interleave_block_size)
-                self.interleave_order.extend([d_idx] * num_blocks)
-        
-        # If the number of items is too small we lose out on some randomness. Enforce a minimum size.
-        if self.interleave_order and 10 > len(self.interleave_order):
-            self.interleave_order = self.interleave_order * (10 // len(self.interleave_order) + 1)
+    Returns:
+        bool: False if the file predates sample offsets in the footer, so that the end of the samples
+              could not be checked.
+    """
+    file_size = os.path.getsize(binpath)
+    with open(binpath, "rb") as binfile:
+        if file_size < 8:
+            raise ValueError(f"{binpath} is too short to hold a flatbin header")
+        total_samples = int.from_bytes(binfile.read(4), byteorder='big')
+        entries_per_sample = int.from_bytes(binfile.read(4), byteorder='big')
+        for _ in range(entries_per_sample):
+            name_len = int.from_bytes(binfile.read(4), byteorder='big')
+            if name_len > 1024 or binfile.tell() + name_len + 4 > file_size:
+                raise ValueError(f"{binpath} has a damaged header")
+            binfile.seek(name_len + 4, os.SEEK_CUR)
+        try:
+            patch_info = read_header(binfile)
+        except (UnicodeDecodeError, struct.error) as error:
+            raise ValueError(f"{binpath} has a damaged metadata header: {error}")
+        data_offset = binfile.tell()
+        if data_offset > file_size:
+            raise ValueError(f"{binpath} ends inside of its header")
+
+        sections = read_footer(binfile)
+        if not sections:
+            # The sample count is written last, so an unfinished file still has a count of 0
+            if 0 == total_samples and data_offset < file_size:
+                raise ValueError(f"{binpath} was not completely written (its sample count is 0)")
+            return False
+        footer_begin = min(offset for offset, _ in sections.values())
+        for name, (offset, length) in sections.items():
+            if offset + length > file_size:
+                raise ValueError(f"{binpath} is truncated, its {name} section is incomplete")
+        if 'offsets' not in sections:
+            # Early version 2 files only have columns in their footer
+            return False
+        offsets_begin, offsets_length = sections['offsets']
+        block_samples = patch_info.get('block_samples')
+        expected = total_samples if not patch_info.get('block_compression') else math.ceil(
+                total_samples / block_samples)
+        if offsets_length != 8 * (expected + 1):
+            raise ValueError(f"{binpath} has {offsets_length // 8 - 1} sample offsets for {expected} "
+                             "samples or blocks")
+        binfile.seek(offsets_begin)
+        first_offset = int.from_bytes(binfile.read(8), byteorder='little')
+        binfile.seek(offsets_begin + offsets_length - 8)
+        last_offset = int.from_bytes(binfile.read(8), byteorder='little')
+        if first_offset != data_offset or last_offset != footer_begin:
+            raise ValueError(f"{binpath} has samples from {first_offset} to {last_offset} but they should be "
+                             f"from {data_offset} to {footer_begin}")
+    return True
+
+
+def _checkBlocks(binpath, blocks):
+    """Return the first of the (block index, begin, end, crc) blocks that fails its checksum, or None."""
+    with open(binpath, "rb") as binfile:
+        for block_idx, begin, end, crc in blocks:
+            binfile.seek(begin)
+            if zlib.crc32(binfile.read(end - begin)) != crc:
+                return block_idx
+    return None
+
+
+def verifyFlatbin(binpath, processes=None, chunk_blocks=64):
+    """Read a whole flatbin file and check every block against its checksum.
+
+    The blocks are checked in parallel. Files without checksums are checked by following the size
+    fields of every sample instead.
+
+    Arguments:
+        binpath       (str): Path to the flatbin file.
+        processes     (int): Number of processes, defaults to the number of CPUs.
+        chunk_blocks  (int): Number of consecutive blocks checked by each task.
+    Returns:
+        int or None: The index of the first sample of the first bad block, or None if the file is good.
+    """
+    checkFlatbin(binpath)
+    dataset = FlatbinDataset(binpath, [])
+    if 0 == dataset.total_samples:
+        return None
+    with open(binpath, "rb") as binfile:
+        sections = read_footer(binfile)
+        if 'checksums' not in sections:
+            return _verifySizes(dataset)
+        offset, length = sections['checksums']
+        binfile.seek(offset)
+        checksum_samples = int.from_bytes(binfile.read(4), byteorder='big')
+        checksums = numpy.frombuffer(binfile.read(length - 4), dtype='<u4')
+    offsets = dataset.readOffsets()
+    # The offsets are per sample in uncompressed files and per block in compressed ones
+    stride = checksum_samples if 0 == dataset.block_compression else 1
+    blocks = [(block_idx, int(offsets[block_idx * stride]),
+               int(offsets[min((block_idx + 1) * stride, len(offsets) - 1)]), int(crc))
+              for block_idx, crc in enumerate(checksums)]
+    chunks = [blocks[begin:begin + chunk_blocks] for begin in range(0, len(blocks), chunk_blocks)]
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for bad_block in pool.starmap(_checkBlocks, [(binpath, chunk) for chunk in chunks]):
+            if bad_block is not None:
+                return bad_block * checksum_samples
+    return None
+
+
+def _verifySizes(dataset):
+    """Follow the size fields of every sample, returning the first that runs past the end of the file."""
+    mapping = numpy.memmap(dataset.binpath, dtype=numpy.uint8, mode='r')
+    offset = dataset.data_offset
+    if 0 != dataset.block_compression:
+        for block_idx in range(math.ceil(dataset.total_samples / dataset.block_samples)):
+            if offset + 8 > mapping.size:
+                return block_idx * dataset.block_samples
+            try:
+                _, offset = dataset._decompressAt(mapping, offset)
+            except Exception:
+                return block_idx * dataset.block_samples
+        return None
+    for sample_idx in range(dataset.total_samples):
+        offset = dataset._skipRecord(mapping, offset)
+        if offset > mapping.size:
+            return sample_idx
+    return None
+
+
+################################################
+# Dataset summary sidecars.
+# Dataset writers put a small json file next to each dataset file (e.g. dataset.bin.json) that holds
+# the sample count, the image shape, the sizes of the fixed-width entries, and the class histograms,
+# means, and variances of those entries. Training reads the sidecar instead of probing the dataset.
+# The size of the dataset file is stored as well so that the sidecar of a replaced file is ignored.
+
+# Integer entries with only values in [0, max_histogram_classes) get a class histogram
+max_histogram_classes = 4096
+
+
+def sidecarPath(data_path):
+    """Return the path of the summary sidecar of a dataset file."""
+    return data_path + ".json"
+
+
+def summarizeValues(sample_count, image_shape, values):
+    """Build the summary of a dataset.
+
+    Arguments:
+        sample_count (int): Number of samples in the dataset.
+        image_shape ([int]): Channels, height, and width of the stored images, or None.
+        values ({str: array}): Every value of each fixed-width entry, with shape (samples,) or
+                               (samples, elements).
+    Returns:
+        dict: The summary, which writeSidecar saves.
+    """
+    summary = {
+        "sample_count": int(sample_count),
+        "image_shape": None if image_shape is None else [int(dim) for dim in image_shape],
+        "vector_sizes": {},
+        "class_histograms": {},
+        "statistics": {},
+    }
+    for name, column in values.items():
+        column = numpy.asarray(column)
+        if 1 == column.ndim:
+            column = column[:, None]
+        summary["vector_sizes"][name] = int(column.shape[1])
+        if 0 == len(column):
+            continue
+        as_float = column.astype(numpy.float64)
+        summary["statistics"][name] = {"mean": as_float.mean(axis=0).tolist(),
+                                       "variance": as_float.var(axis=0).tolist()}
+        if (column.dtype.kind in 'iu' and 1 == column.shape[1] and 0 <= column.min()
+                and column.max() < max_histogram_classes):
+            summary["class_histograms"][name] = numpy.bincount(column[:, 0]).tolist()
+    return summary
+
+
+def combineSummaries(summaries):
+    """Combine the summaries of several dataset files into the summary of all of them.
+
+    Entries that are not in every summary, or that differ in size, are left out. The image shape is
+    None unless every file has the same shape.
+    """
+    combined = json.loads(json.dumps(summaries[0]))
+    combined.pop("data_size", None)
+    for summary in summaries[1:]:
+        first_count, second_count = combined["sample_count"], summary["sample_count"]
+        total = first_count + second_count
+        combined["sample_count"] = total
+        if combined["image_shape"] != summary["image_shape"]:
+            combined["image_shape"] = None
+        combined["vector_sizes"] = {name: size for name, size in combined["vector_sizes"].items()
+                                    if summary["vector_sizes"].get(name) == size}
+        histograms = {}
+        for name, counts in combined["class_histograms"].items():
+            if name in summary["class_histograms"]:
+                other = summary["class_histograms"][name]
+                length = max(len(counts), len(other))
+                histograms[name] = (numpy.pad(counts, (0, length - len(counts))) +
+                                    numpy.pad(other, (0, length - len(other)))).astype(int).tolist()
+        combined["class_histograms"] = histograms
+        statistics = {}
+        for name in combined["vector_sizes"]:
+            first, second = combined["statistics"].get(name), summary["statistics"].get(name)
+            if first is None or second is None:
+                # An empty file has no statistics, so the other file's are the combined statistics
+                if (first or second) is not None and 0 == min(first_count, second_count):
+                    statistics[name] = first or second
+                continue
+            # Merge the means and variances of the two populations (Chan et al.)
+            first_mean, second_mean = numpy.array(first["mean"]), numpy.array(second["mean"])
+            delta = second_mean - first_mean
+            m2 = (numpy.array(first["variance"]) * first_count + numpy.array(second["variance"]) * second_count
+                  + delta**2 * first_count * second_count / total)
+            statistics[name] = {"mean": (first_mean + delta * second_count / total).tolist(),
+                                "variance": (m2 / total).tolist()}
+        combined["statistics"] = statistics
+    return combined
+
+
+def writeSidecar(data_path, summary):
+    """Write the summary sidecar of a dataset file that has been completely written."""
+    summary = dict(summary, data_size=os.path.getsize(data_path))
+    with open(sidecarPath(data_path), "w") as sidecar:
+        json.dump(summary, sidecar, indent=1)
 
-        random.shuffle(self.interleave_order)
+
+def readSidecar(data_path):
+    """Return the summary of a dataset file, or None if it has no sidecar or the file has changed."""
+    try:
+        with open(sidecarPath(data_path), "r") as sidecar:
+            summary = json.load(sidecar)
+    except (OSError, ValueError):
+        return None
+    if summary.get("data_size") != os.path.getsize(data_path):
+        return None
+    return summary
+
+
+def summarizeFlatbin(binpath):
+    """Summarize a flatbin file, see summarizeValues.
+
+    Fixed-width entries are read as columns, without decoding images. Only the first image is decoded
+    to find the image shape.
+    """
+    dataset = FlatbinDataset(binpath, [])
+    names = [name for name in dataset.header_names
+             if name in dataset.columns or name.endswith((".int", ".float")) or name == "cls"]
+    image_names = [name for name in dataset.header_names if name.endswith((".png", ".raw"))]
+    image_shape = None
+    if image_names and 0 < len(dataset):
+        image = next(iter(FlatbinDataset(binpath, image_names[:1], uint8_images=True)))[0]
+        image_shape = numpy.asarray(image).shape
+    return summarizeValues(len(dataset), image_shape,
+                           {name: numpy.asarray(dataset.readColumn(name)) for name in names})
+
+
+def readerShard():
+    """Return the number of readers of an iterable dataset and the index of this one.
+
+    Every dataloader worker of every distributed training process is a separate reader, so each
+    sample is read once per epoch across all of the training processes.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info else (1, 0)
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return (num_workers * torch.distributed.get_world_size(),
+                torch.distributed.get_rank() * num_workers + worker_id)
+    return num_workers, worker_id
+
+
+def readerSkip(skip_samples, reader_id):
+    """Return the number of samples that a reader skips, see set_skip of the iterable datasets."""
+    if skip_samples is None:
+        return 0
+    return int(skip_samples.get(reader_id, 0)) if isinstance(skip_samples, dict) else int(skip_samples[reader_id])
+
+
+class InterleavedFlatbinDatasets(torch.utils.data.IterableDataset):
+    """Mix the samples of several flatbin files.
+
+    Each dataloader worker (of each distributed training process, see readerShard) reads its own
+    share of the samples: whole files when there are more files than workers and ranges of files
+    otherwise. A worker never opens a file that it does not read
+    from and closes each file as soon as its part of the file is finished. The samples of the
+    worker's files are mixed at random, and the assignment and mixing change with set_epoch.
+    """
+
+    def __init__(self, binpath, desired_data, img_format=None, use_mmap=False, shuffle_block=None,
+            shuffle_pool=8, seed=0, weights=None, uint8_images=False, source_index=False):
+        """
+        Arguments:
+            binpath          ([str]): Paths to the flatbin files.
+            desired_data     ([str]): Names of the entries to return from each sample.
+            img_format         (str): Image format ("RGB" or "L") or None to keep the stored format.
+            use_mmap          (bool): Memory map the files, see FlatbinDataset.
+            shuffle_block      (int): Block shuffle the samples of each file, see FlatbinDataset.
+            shuffle_pool       (int): Number of blocks whose samples are shuffled together.
+            seed               (int): Seed for the file order and the mixing.
+            weights        ([float]): Relative chance of drawing the next sample from each file. By
+                                      default files are drawn in proportion to their remaining
+                                      samples, which spreads every file evenly through the epoch.
+                                      A file stops being drawn from once it is finished.
+            uint8_images      (bool): Return png images as uint8 instead of float, see FlatbinDataset.
+            source_index      (bool): Add the index of the file that each sample came from to the
+                                      end of the sample, e.g. to tell cross validation folds apart.
+        """
+        if not isinstance(binpath, list):
+            binpath = [binpath]
+        # Each file gets its own seed so that the files are not shuffled in the same order
+        self.datasets = [FlatbinDataset(path, desired_data, img_format, use_mmap, shuffle_block, shuffle_pool,
+            seed + file_idx, uint8_images) for file_idx, path in enumerate(binpath)]
+        if weights is not None and len(weights) != len(self.datasets):
+            raise ValueError(f"Got {len(weights)} weights for {len(self.datasets)} files")
+        self.weights = weights
+        self.seed = seed
+        self.source_index = source_index
+        self.epoch = 0
+        self.skip_samples = None
 
     def getPatchInfo(self):
         return self.datasets[0].patch_info if self.datasets else None
@@ -388,38 +1077,153 @@ class InterleavedFlatbinDatasets(torch.utils.data.IterableDataset):
         except (ValueError, IndexError):
             return None
 
+    def set_epoch(self, epoch):
+        """Set the epoch, which changes the files read by each worker and the order of the samples.
+
+        Also clears any samples to skip from set_skip.
+        """
+        self.epoch = epoch
+        self.skip_samples = None
+        for dataset in self.datasets:
+            dataset.set_epoch(epoch)
+
+    def set_skip(self, skip_samples):
+        """Skip the samples of this epoch that each reader already read, to resume part way through it.
+
+        The skipped samples are passed over without decoding them, and files whose part is entirely
+        skipped are never opened. The order of the remaining samples is the same as without skipping.
+
+        Arguments:
+            skip_samples (dict or list): Number of samples to skip for each reader (see readerShard).
+        """
+        self.skip_samples = skip_samples
+
+    def readColumn(self, name):
+        """Return every value of a fixed-width entry from all of the files, in file order."""
+        return numpy.concatenate([dataset.readColumn(name) for dataset in self.datasets])
+
     def __len__(self):
         return sum(len(dataset) for dataset in self.datasets)
 
+    def workerRanges(self, num_workers):
+        """Split the samples between the workers.
+
+        The files are put in a random order for the epoch and the concatenated samples are cut into
+        num_workers nearly equal parts. Cuts inside of compressed files are moved to block boundaries.
+
+        Returns:
+            [[(int, int, int)]]: The (file index, begin, end) sample ranges of each worker.
+        """
+        order = numpy.random.default_rng([self.seed, self.epoch]).permutation(len(self.datasets))
+        sizes = [len(self.datasets[file_idx]) for file_idx in order]
+        starts = numpy.cumsum([0] + sizes)
+        total = int(starts[-1])
+
+        cuts = []
+        for worker in range(num_workers + 1):
+            cut = worker * total // num_workers
+            position = int(numpy.searchsorted(starts, cut, side='right')) - 1
+            if position < len(order):
+                dataset = self.datasets[order[position]]
+                if 0 != dataset.block_compression:
+                    local = cut - int(starts[position])
+                    cut = int(starts[position]) + local - local % dataset.block_samples
+            cuts.append(max(cut, cuts[-1]) if cuts else cut)
+
+        ranges = []
+        for begin, end in zip(cuts, cuts[1:]):
+            worker_ranges = []
+            for position, file_idx in enumerate(order):
+                file_begin, file_end = int(starts[position]), int(starts[position + 1])
+                if begin < file_end and file_begin < end:
+                    worker_ranges.append((int(file_idx), max(begin, file_begin) - file_begin,
+                        min(end, file_end) - file_begin))
+            ranges.append(worker_ranges)
+        return ranges
+
     def __iter__(self):
-        if not self.interleave_order: return
-        
-        iters = [iter(ds) for ds in self.datasets]
-        finished = [False] * len(self.datasets)
-        
-        while not all(finished):
-            interleave_cycle_finished = True
-            for source_idx in self.interleave_order:
-                if not finished[source_idx]:
-                    try:
-                        yield next(iters[source_idx])
-                        interleave_cycle_finished = False
-                    except StopIteration:
-                        finished[source_idx] = True
-            
-            # If an entire pass through the interleave order yielded nothing, we are done
-            if interleave_cycle_finished:
-                break
+        num_readers, reader_id = readerShard()
+        rng = numpy.random.default_rng([self.seed, self.epoch, reader_id])
+        skip = readerSkip(self.skip_samples, reader_id)
 
+        # Each source is [iterator, remaining samples, weight, file index, begin, end, skipped samples]
+        # Iterators are only created for the first sample that is not skipped
+        sources = []
+        for file_idx, begin, end in self.workerRanges(num_readers)[reader_id]:
+            weight = None if self.weights is None else self.weights[file_idx]
+            if weight != 0:
+                sources.append([None, end - begin, weight, file_idx, begin, end, 0])
+
+        while sources:
+            if self.weights is None:
+                chances = numpy.array([source[1] for source in sources], dtype=numpy.float64)
+            else:
+                chances = numpy.array([source[2] for source in sources], dtype=numpy.float64)
+            source_idx = int(rng.choice(len(sources), p=chances / chances.sum()))
+            source = sources[source_idx]
+            source[1] -= 1
+            if 0 < skip:
+                # The draws are the same as when reading, but the sample is skipped in its file
+                skip -= 1
+                source[6] += 1
+                if 0 == source[1]:
+                    sources.pop(source_idx)
+                continue
+            if source[0] is None:
+                source[0] = self.datasets[source[3]].iterRange(source[4], source[5], skip=source[6])
+            sample = next(source[0])
+            if self.source_index:
+                sample = tuple(sample) + (source[3],)
+            if 0 == source[1]:
+                # Release the file as soon as its last sample is read
+                source[0].close()
+                sources.pop(source_idx)
+            yield sample
+
+
+# Number of samples in each read when reading sequentially through a range of samples
+sequential_read_samples = 64
 
 class FlatbinDataset(torch.utils.data.IterableDataset):
-    def __init__(self, binpath, desired_data, img_format=None):
+    def __init__(self, binpath, desired_data, img_format=None, use_mmap=False, shuffle_block=None,
+            shuffle_pool=8, seed=0, uint8_images=False):
+        """
+        Arguments:
+            binpath          (str): Path to the flatbin file.
+            desired_data   ([str]): Names of the entries to return from each sample. A request for
+                                    "<name>.png" is also satisfied by a raw "<name>.raw" entry.
+            img_format       (str): Image format ("RGB" or "L") or None to keep the stored format.
+            use_mmap        (bool): Memory map the file instead of reading it. Fixed size data is
+                                    returned as views into the mapping and the pages are shared
+                                    between all processes reading the file.
+            shuffle_block    (int): If set, read blocks of this many consecutive samples in a
+                                    random order, with a single read per block. Compressed files
+                                    round this to a whole number of compressed blocks.
+            shuffle_pool     (int): Number of blocks whose samples are shuffled together.
+            seed             (int): Seed of the block order. The order also changes with set_epoch.
+            uint8_images    (bool): Return png images as uint8 values rather than floats from 0 to
+                                    1, as raw images always are.
+        """
         if isinstance(binpath, list):
             # If a list is provided, just use the first one.
             self.binpath = binpath[0]
         else:
             self.binpath = binpath
         self.img_format = img_format
+        self.uint8_images = uint8_images
+        self.use_mmap = use_mmap
+        self.shuffle_block = shuffle_block
+        self.shuffle_pool = shuffle_pool
+        self.seed = seed
+        self.epoch = 0
+        self.skip_samples = None
+        # The mapping is opened lazily in each process that iterates through the data.
+        self._mapping = None
+        self.block_compression = 0
+        self.block_samples = None
+        self.columns = {}
+        self.column_outputs = []
+        self.offsets = None
         
         with open(self.binpath, "rb") as binfile:
             # Read total samples, and if zero, initialize as an empty dataset
@@ -432,13 +1236,19 @@ class FlatbinDataset(torch.utils.data.IterableDataset):
                 self.entries_per_sample = 0
                 self.header_names, self.data_handlers, self.data_indices, self.data_sizes = [], [], [], []
                 self.skip_fns, self.patch_info, self.data_offset = [], {}, 0
+                self.view_handlers, self.view_skip_fns, self.row_indices = [], [], []
+                self.header_sizes = []
                 return
 
             self.entries_per_sample = int.from_bytes(binfile.read(4), byteorder='big')
             self.desired_data = desired_data
             self.header_names, self.data_handlers, self.data_indices, self.data_sizes = [], [], [], []
+            self.view_handlers = []
+            # The output index of each entry stored in the samples (rather than in a column)
+            self.row_indices = []
             
             # Read the data format section of the header
+            header_lengths = []
             for _ in range(self.entries_per_sample):
                 name_len = int.from_bytes(binfile.read(4), byteorder='big')
                 #assert name_len <= 1024, "Header name length seems unreasonably large."
@@ -449,52 +1259,130 @@ class FlatbinDataset(torch.utils.data.IterableDataset):
                     raise ValueError(f"Header name length {name_len} seems unreasonably large in {self.binpath}")
                 name = binfile.read(name_len).decode('utf-8')
                 self.header_names.append(name)
+                # All non-image/numpy types have a fixed data length written in the header.
+                # dataloaderToFlatbin writes a placeholder length for variable sized data as well,
+                # so it must be consumed.
+                header_lengths.append(int.from_bytes(binfile.read(4), byteorder='big'))
 
-                # All non-image/numpy types have a fixed data length written in the header
-                is_variable_size = name.endswith((".png", ".numpy"))
-                data_length = int.from_bytes(binfile.read(4), byteorder='big') if not is_variable_size else None
-                
-                if name not in self.desired_data:
-                    self.data_indices.append(None)
-                    # For data we don't want, the handler IS the skip function
-                    if is_variable_size:
-                        self.data_handlers.append(skip_image)
-                    else:
-                        self.data_handlers.append(functools.partial(skip_tensor, data_length))
-                else:
-                    idx = self.desired_data.index(name)
-                    self.data_indices.append(idx)
-                    
-                    if name.endswith(".png"):
-                        self.data_handlers.append(functools.partial(img_handler, img_format=self.img_format))
-                    elif name.endswith(".numpy"):
-                        self.data_handlers.append(numpy_handler)
-                    elif name.endswith(".float"):
-                        self.data_handlers.append(functools.partial(array_handler_float, data_length))
-                    elif name.endswith(".int") or name.endswith("cls"):
-                        self.data_handlers.append(functools.partial(array_handler_int, data_length))
-                    else: # Fallback for other fixed-size tensor-like data
-                        self.data_handlers.append(functools.partial(tensor_handler, data_length))
-                
+            # The header sizes are kept for copying the format of this file
+            self.header_sizes = header_lengths
+
+            # The metadata follows the data format section. It holds the shape of raw images.
+            self.patch_info = read_header(binfile)
+            self.data_offset = binfile.tell()
+
+            # Fixed-width entries of version 2 files are stored as columns after the samples
+            if 2 == self.patch_info.get('flatbin_version', 1):
+                columns_offset, columns_length = read_footer(binfile)['columns']
+                binfile.seek(columns_offset)
+                self.columns = read_columns(bytearray(binfile.read(columns_length)))
+
+        self.block_compression = self.patch_info.get('block_compression', 0)
+        self.block_samples = self.patch_info.get('block_samples', None)
+        raw_shape = (self.patch_info.get('raw_channels'), self.patch_info.get('raw_height'),
+                self.patch_info.get('raw_width'))
+
+        skip_fns_list = []
+        view_skip_fns_list = []
+        for name, header_length in zip(self.header_names, header_lengths):
+            is_variable_size = name.endswith((".png", ".numpy"))
+            data_length = None if is_variable_size else header_length
+
+            if name in self.columns:
+                # Columns are not part of the samples, so there is nothing to read or skip
+                idx = self.desired_data.index(name) if name in self.desired_data else None
+                self.data_indices.append(idx)
                 self.data_sizes.append(data_length)
+                if idx is not None:
+                    self.column_outputs.append((idx, self.columns[name]))
+                continue
 
-            # Build functions to skip an entire sample efficiently
+            # Build functions to skip each entry.
             # This is separate from handlers because a worker might need to skip data that it *would* normally read
-            skip_fns_list = []
-            for name, size in zip(self.header_names, self.data_sizes):
-                 if name.endswith((".png", ".numpy")):
-                     skip_fns_list.append(skip_image)
-                 else:
-                     skip_fns_list.append(functools.partial(skip_tensor, size))
-            self.skip_fns = skip_fns_list
+            if is_variable_size:
+                skip_fns_list.append(skip_image)
+                view_skip_fns_list.append(skip_image_view)
+            elif name.endswith(".raw"):
+                skip_fns_list.append(functools.partial(skip_bytes, data_length))
+                view_skip_fns_list.append(functools.partial(skip_bytes_view, data_length))
+            else:
+                skip_fns_list.append(functools.partial(skip_tensor, data_length))
+                view_skip_fns_list.append(functools.partial(skip_tensor_view, data_length))
 
+            # Raw images can stand in for png images of the same name
+            desired_name = name
+            if name.endswith(".raw") and name not in self.desired_data:
+                desired_name = name[:-len(".raw")] + ".png"
 
-            self.patch_info = read_header(binfile)
-            self.data_offset = binfile.tell()
+            if desired_name not in self.desired_data:
+                self.data_indices.append(None)
+                self.row_indices.append(None)
+                # For data we don't want, the handler IS the skip function
+                self.data_handlers.append(skip_fns_list[-1])
+                self.view_handlers.append(view_skip_fns_list[-1])
+            else:
+                idx = self.desired_data.index(desired_name)
+                self.data_indices.append(idx)
+                self.row_indices.append(idx)
+                
+                if name.endswith(".png"):
+                    self.data_handlers.append(functools.partial(img_handler, img_format=self.img_format,
+                        as_uint8=self.uint8_images))
+                    self.view_handlers.append(functools.partial(img_view_handler, img_format=self.img_format,
+                        as_uint8=self.uint8_images))
+                elif name.endswith(".raw"):
+                    self.data_handlers.append(functools.partial(raw_handler, raw_shape))
+                    self.view_handlers.append(functools.partial(raw_view_handler, raw_shape))
+                elif name.endswith(".numpy"):
+                    self.data_handlers.append(numpy_handler)
+                    self.view_handlers.append(numpy_view_handler)
+                elif name.endswith(".float"):
+                    self.data_handlers.append(functools.partial(array_handler_float, data_length))
+                    self.view_handlers.append(functools.partial(array_view_handler_type, 'f', data_length))
+                elif name.endswith(".int") or name.endswith("cls"):
+                    self.data_handlers.append(functools.partial(array_handler_int, data_length))
+                    self.view_handlers.append(functools.partial(array_view_handler_type, 'i', data_length))
+                else: # Fallback for other fixed-size tensor-like data
+                    self.data_handlers.append(functools.partial(tensor_handler, data_length))
+                    self.view_handlers.append(functools.partial(tensor_view_handler, data_length))
+
+            # The size of a raw image is its shape
+            self.data_sizes.append(raw_shape if name.endswith(".raw") else data_length)
+        self.skip_fns = skip_fns_list
+        self.view_skip_fns = view_skip_fns_list
+        # Block shuffling reads each block with a single read from these offsets
+        if shuffle_block:
+            self.offsets = self.readOffsets()
+
+    def __getstate__(self):
+        # Never send a mapping to worker processes. Each one creates its own, which shares the same
+        # pages in the page cache.
+        state = self.__dict__.copy()
+        state['_mapping'] = None
+        return state
 
     def getPatchInfo(self):
         return self.patch_info
 
+    def set_epoch(self, epoch):
+        """Set the epoch, which changes the order of the samples when shuffle_block is set.
+
+        Also clears any samples to skip from set_skip.
+        """
+        self.epoch = epoch
+        self.skip_samples = None
+
+    def set_skip(self, skip_samples):
+        """Skip the samples of this epoch that each reader already read, to resume part way through it.
+
+        The skipped samples are passed over without decoding them. The order of the remaining samples
+        is the same as without skipping.
+
+        Arguments:
+            skip_samples (dict or list): Number of samples to skip for each reader (see readerShard).
+        """
+        self.skip_samples = skip_samples
+
     def getDataSize(self, out_index):
         """Get the size of the data at the given index. Does not work for images."""
         try:
@@ -503,43 +1391,356 @@ class FlatbinDataset(torch.utils.data.IterableDataset):
         except (ValueError, IndexError):
             return None
 
+    def readColumn(self, name):
+        """Return every value of a fixed-width entry without decoding any images.
+
+        Version 2 files hold the values in a column. Other files are scanned, only reading the size
+        fields of the other entries.
+
+        Returns:
+            numpy.ndarray: Array of shape (samples,) or (samples, elements).
+        """
+        if name in self.columns:
+            return self.columns[name]
+        if 0 == self.total_samples:
+            return numpy.zeros(0)
+        column_reader = FlatbinDataset(self.binpath, [name], use_mmap=(0 == self.block_compression))
+        return numpy.array([sample[0] for sample in column_reader])
+
+    def readOffsets(self):
+        """Return the file offsets of the samples, or of the blocks of a compressed file.
+
+        The offsets are read from the footer when the file has one. Otherwise the size fields of
+        every sample (or block) are read to find them.
+
+        Returns:
+            numpy.ndarray: uint64 offsets with a final entry for the end of the last sample or block.
+        """
+        if 0 == self.total_samples:
+            return numpy.array([self.data_offset], dtype=numpy.uint64)
+        with open(self.binpath, "rb") as binfile:
+            sections = read_footer(binfile)
+            if 'offsets' in sections:
+                offset, length = sections['offsets']
+                binfile.seek(offset)
+                return numpy.frombuffer(binfile.read(length), dtype='<u8').astype(numpy.uint64)
+            offsets = [self.data_offset]
+            if 0 != self.block_compression:
+                binfile.seek(self.data_offset)
+                for _ in range(math.ceil(self.total_samples / self.block_samples)):
+                    binfile.seek(4, os.SEEK_CUR)
+                    payload_len = int.from_bytes(binfile.read(4), byteorder='big')
+                    offsets.append(binfile.seek(payload_len, os.SEEK_CUR))
+                return numpy.array(offsets, dtype=numpy.uint64)
+        mapping = numpy.memmap(self.binpath, dtype=numpy.uint8, mode='r')
+        for _ in range(self.total_samples):
+            offsets.append(self._skipRecord(mapping, offsets[-1]))
+        return numpy.array(offsets, dtype=numpy.uint64)
+
+    def getMapping(self):
+        """Return a copy-on-write memory map of the file, creating it on the first call."""
+        if self._mapping is None:
+            # Copy-on-write keeps the arrays writable, which torch.from_numpy expects, without
+            # writing anything back to the file.
+            self._mapping = numpy.memmap(self.binpath, dtype=numpy.uint8, mode='c')
+        return self._mapping
+
     def __len__(self):
         return self.total_samples
 
+    def _workerInterval(self):
+        """Return the read interval and offset for this dataloader worker."""
+        return readerShard()
+
     def __iter__(self):
         if self.total_samples == 0:
             return
+        if self.shuffle_block:
+            yield from self._iterShuffled()
+            return
+        if 0 != self.block_compression:
+            yield from self._iterBlocks()
+            return
+        if self.use_mmap:
+            yield from self._iterMapped()
+            return
         with open(self.binpath, "rb") as binfile:
             binfile.seek(self.data_offset, os.SEEK_SET)
-            worker_info = torch.utils.data.get_worker_info()
-            # Determine interval and offset for multi-worker loading
-            if worker_info and worker_info.num_workers > 1:
-                read_interval = worker_info.num_workers
-                read_offset = worker_info.id
-            else:
-                read_interval = 1
-                read_offset = 0
+            read_interval, read_offset = self._workerInterval()
+            skip = readerSkip(self.skip_samples, read_offset)
             # *** LOGIC FIX 3: Combined into a single if/else structure for worker logic ***
             for i in range(self.total_samples):
                 current_offset = i % read_interval
-                # This sample is for this worker to READ
-                if current_offset == read_offset:
+                # This sample is for this worker to READ, unless it was read before resuming
+                if current_offset == read_offset and 0 < skip:
+                    skip -= 1
+                    for skip_fn in self.skip_fns:
+                        skip_fn(binfile)
+                elif current_offset == read_offset:
                     # Pre-allocate list with None
                     return_data = [None] * len(self.desired_data)
                     for handler_idx, handler in enumerate(self.data_handlers):
                         # The index in the output list where data should be placed
-                        output_idx = self.data_indices[handler_idx] 
+                        output_idx = self.row_indices[handler_idx] 
                         # Read the data if it is desired, otherwise the handler itself is a skip function
                         data_or_none = handler(binfile)
                         if output_idx is not None:
                             # Place the read data in the correct output slot
                             return_data[output_idx] = data_or_none
+                    self._addColumns(return_data, i)
                     yield return_data
                 # This sample is for another worker, so this worker must SKIP
                 else:
                     for skip_fn in self.skip_fns:
                         skip_fn(binfile)
-                        
+
+    def _readRecord(self, buf, offset, sample_idx):
+        """Decode the sample at the offset in buf. Returns the sample and the next offset."""
+        return_data = [None] * len(self.desired_data)
+        for handler_idx, handler in enumerate(self.view_handlers):
+            output_idx = self.row_indices[handler_idx]
+            data_or_none, offset = handler(buf, offset)
+            if output_idx is not None:
+                return_data[output_idx] = data_or_none
+        self._addColumns(return_data, sample_idx)
+        return return_data, offset
+
+    def _addColumns(self, return_data, sample_idx):
+        """Fill in the desired column entries of a sample, with the same types as the row handlers."""
+        for output_idx, column in self.column_outputs:
+            value = column[sample_idx]
+            return_data[output_idx] = value.item() if 0 == value.ndim else tuple(value.tolist())
+
+    def _skipRecord(self, buf, offset):
+        """Return the offset of the sample after the one at the offset in buf."""
+        # Skipping only reads the size fields of variable length data
+        for skip_fn in self.view_skip_fns:
+            _, offset = skip_fn(buf, offset)
+        return offset
+
+    def _iterMapped(self):
+        """Iterate through the samples in the memory mapped file."""
+        mapping = self.getMapping()
+        offset = self.data_offset
+        read_interval, read_offset = self._workerInterval()
+        skip = readerSkip(self.skip_samples, read_offset)
+        for i in range(self.total_samples):
+            if i % read_interval == read_offset and 0 == skip:
+                sample, offset = self._readRecord(mapping, offset, i)
+                yield sample
+            else:
+                if i % read_interval == read_offset:
+                    skip -= 1
+                offset = self._skipRecord(mapping, offset)
+
+    def _iterBlocks(self):
+        """Iterate through the samples of a file with compressed blocks.
+
+        Whole blocks are assigned to each dataloader worker so that no block is decompressed twice.
+        """
+        read_interval, read_offset = self._workerInterval()
+        skip = readerSkip(self.skip_samples, read_offset)
+        num_blocks = math.ceil(self.total_samples / self.block_samples)
+        with open(self.binpath, "rb") as binfile:
+            binfile.seek(self.data_offset, os.SEEK_SET)
+            for block_idx in range(num_blocks):
+                data_len = int.from_bytes(binfile.read(4), byteorder='big')
+                payload_len = int.from_bytes(binfile.read(4), byteorder='big')
+                block_count = min(self.block_samples, self.total_samples - block_idx * self.block_samples)
+                if block_idx % read_interval != read_offset or block_count <= skip:
+                    # Blocks that were read before resuming are not decompressed
+                    if block_idx % read_interval == read_offset:
+                        skip -= block_count
+                    binfile.seek(payload_len, os.SEEK_CUR)
+                    continue
+                block = decompressBlock(self.block_compression, binfile.read(payload_len), data_len)
+                # Copy into a writable buffer so that the returned views are writable tensors
+                block = numpy.frombuffer(bytearray(block), dtype=numpy.uint8)
+                offset = 0
+                for block_sample in range(block_count):
+                    if 0 < skip:
+                        skip -= 1
+                        offset = self._skipRecord(block, offset)
+                        continue
+                    sample, offset = self._readRecord(block, offset,
+                            block_idx * self.block_samples + block_sample)
+                    yield sample
+
+    def _readSpan(self, binfile, begin, end):
+        """Return bytes [begin, end) of the file as a writable uint8 array.
+
+        The open binfile is read unless the file is memory mapped, in which case the bytes are a
+        view into the mapping.
+        """
+        if self.use_mmap:
+            return self.getMapping()[begin:end]
+        buf = bytearray(end - begin)
+        binfile.seek(begin)
+        binfile.readinto(buf)
+        return numpy.frombuffer(buf, dtype=numpy.uint8)
+
+    def _decompressAt(self, buf, position):
+        """Decompress the block at the position in buf. Returns the block and the next position."""
+        data_len = int.from_bytes(buf[position:position+4].tobytes(), byteorder='big')
+        payload_len = int.from_bytes(buf[position+4:position+8].tobytes(), byteorder='big')
+        payload = buf[position+8:position+8+payload_len].tobytes()
+        block = decompressBlock(self.block_compression, payload, data_len)
+        # Copy into a writable buffer so that the returned views are writable tensors
+        return numpy.frombuffer(bytearray(block), dtype=numpy.uint8), position + 8 + payload_len
+
+    def _readUnits(self, begin=0, end=None, unit_samples=None):
+        """Return the (first sample, end sample) of the blocks of samples in [begin, end).
+
+        Block boundaries are multiples of unit_samples, which defaults to shuffle_block. Compressed
+        files always read whole compressed blocks, so their boundaries are also block boundaries.
+        """
+        end = self.total_samples if end is None else end
+        unit_samples = unit_samples or self.shuffle_block
+        if 0 != self.block_compression:
+            unit_samples = self.block_samples * max(1, round(unit_samples / self.block_samples))
+        boundaries = [begin] + list(range((begin // unit_samples + 1) * unit_samples, end, unit_samples)) + [end]
+        return [(unit_begin, unit_end) for unit_begin, unit_end in zip(boundaries, boundaries[1:])
+                if unit_begin < unit_end]
+
+    def _unitRecords(self, binfile, begin, end):
+        """Read the samples [begin, end) with one read, without decoding them.
+
+        Returns:
+            [(array, int, int)]: The buffer holding each sample, its offset, and the sample index.
+        """
+        if 0 == self.block_compression:
+            span_begin = int(self.offsets[begin])
+            buf = self._readSpan(binfile, span_begin, int(self.offsets[end]))
+            return [(buf, int(self.offsets[sample_idx]) - span_begin, sample_idx)
+                    for sample_idx in range(begin, end)]
+        records = []
+        first_block = begin // self.block_samples
+        end_block = math.ceil(end / self.block_samples)
+        buf = self._readSpan(binfile, int(self.offsets[first_block]), int(self.offsets[end_block]))
+        position = 0
+        sample_idx = first_block * self.block_samples
+        for _ in range(first_block, end_block):
+            block, position = self._decompressAt(buf, position)
+            offset = 0
+            for _ in range(min(self.block_samples, end - sample_idx)):
+                # A range can begin part way through a block
+                if begin <= sample_idx:
+                    records.append((block, offset, sample_idx))
+                offset = self._skipRecord(block, offset)
+                sample_idx += 1
+        return records
+
+    def _iterUnits(self, units, rng=None, skip=0):
+        """Read the (begin, end) units in order.
+
+        If rng is given the samples are instead drawn at random from a pool of shuffle_pool units, as
+        each new unit replaces the samples drawn. Samples are decoded as they are returned, so the
+        first skip samples are passed over without decoding them. Without an rng, whole units that
+        are skipped are not even read.
+        """
+        pool_size = self.shuffle_pool * (self.shuffle_block or 1)
+        pool = []
+
+        def drawRecord():
+            # Swap a random sample to the end so that removing it is constant time
+            idx = int(rng.integers(len(pool)))
+            pool[idx], pool[-1] = pool[-1], pool[idx]
+            return pool.pop()
+
+        with open(self.binpath, "rb") as binfile:
+            for unit in units:
+                if rng is None:
+                    if unit[1] - unit[0] <= skip:
+                        skip -= unit[1] - unit[0]
+                        continue
+                    for record in self._unitRecords(binfile, unit[0] + skip, unit[1]):
+                        yield self._readRecord(*record)[0]
+                    skip = 0
+                    continue
+                pool.extend(self._unitRecords(binfile, *unit))
+                while len(pool) >= pool_size:
+                    record = drawRecord()
+                    if 0 < skip:
+                        skip -= 1
+                    else:
+                        yield self._readRecord(*record)[0]
+        while pool:
+            record = drawRecord()
+            if 0 < skip:
+                skip -= 1
+            else:
+                yield self._readRecord(*record)[0]
+
+    def _iterShuffled(self):
+        """Iterate through blocks of samples in a random order, shuffling the samples of a pool of blocks.
+
+        Every worker permutes the blocks in the same way and takes every n'th block.
+        """
+        read_interval, read_offset = self._workerInterval()
+        units = self._readUnits()
+        order = numpy.random.default_rng([self.seed, self.epoch]).permutation(len(units))
+        rng = numpy.random.default_rng([self.seed, self.epoch, read_offset + 1])
+        yield from self._iterUnits([units[unit_idx] for unit_idx in order[read_offset::read_interval]], rng,
+                                   readerSkip(self.skip_samples, read_offset))
+
+    def rawRecords(self, indices=None):
+        """Yield the stored bytes of samples without decoding them.
+
+        Column entries of version 2 files are not part of the records, see readColumn.
+
+        Arguments:
+            indices ([int]): Increasing sample indices, or None for every sample.
+        Yields:
+            (int, bytes): The sample index and its record.
+        """
+        if self.offsets is None:
+            self.offsets = self.readOffsets()
+        indices = range(self.total_samples) if indices is None else indices
+        with open(self.binpath, "rb") as binfile:
+            if 0 == self.block_compression:
+                # Runs of consecutive samples are read together
+                runs = itertools.groupby(enumerate(indices), key=lambda item: item[1] - item[0])
+                for _, run in runs:
+                    run = [sample_idx for _, sample_idx in run]
+                    for chunk_begin in range(0, len(run), sequential_read_samples):
+                        chunk = run[chunk_begin:chunk_begin + sequential_read_samples]
+                        span_begin = int(self.offsets[chunk[0]])
+                        buf = self._readSpan(binfile, span_begin, int(self.offsets[chunk[-1] + 1]))
+                        for sample_idx in chunk:
+                            yield sample_idx, buf[int(self.offsets[sample_idx]) - span_begin:
+                                    int(self.offsets[sample_idx + 1]) - span_begin].tobytes()
+                return
+            loaded_block, block, block_offsets = None, None, None
+            for sample_idx in indices:
+                block_idx = sample_idx // self.block_samples
+                if block_idx != loaded_block:
+                    raw = self._readSpan(binfile, int(self.offsets[block_idx]), int(self.offsets[block_idx + 1]))
+                    block, _ = self._decompressAt(raw, 0)
+                    block_count = min(self.block_samples, self.total_samples - block_idx * self.block_samples)
+                    block_offsets = [0]
+                    for _ in range(block_count):
+                        block_offsets.append(self._skipRecord(block, block_offsets[-1]))
+                    loaded_block = block_idx
+                position = sample_idx % self.block_samples
+                yield sample_idx, block[block_offsets[position]:block_offsets[position + 1]].tobytes()
+
+    def iterRange(self, begin, end, skip=0):
+        """Iterate through samples [begin, end) in this process, without splitting them between workers.
+
+        The samples are read sequentially in large reads, or block shuffled if shuffle_block is set.
+        The first skip samples are passed over without decoding them. The file is closed as soon as
+        the range is finished.
+        """
+        if self.offsets is None:
+            self.offsets = self.readOffsets()
+        if not self.shuffle_block:
+            yield from self._iterUnits(self._readUnits(begin, end, sequential_read_samples), skip=skip)
+            return
+        units = self._readUnits(begin, end)
+        order = numpy.random.default_rng([self.seed, self.epoch, begin]).permutation(len(units))
+        rng = numpy.random.default_rng([self.seed, self.epoch, begin, end])
+        yield from self._iterUnits([units[unit_idx] for unit_idx in order], rng, skip)
+
 #def __next__(self):
     #    if self.completed == self.total_samples:
     #        raise StopIteration
@@ -562,4 +1763,149 @@ class FlatbinDataset(torch.utils.data.IterableDataset):
     #            handler(self.binfile)
 
     #    self.completed += 1
-    #    return self.return_data
\ No newline at end of file
+    #    return self.return_data
+
+
+class FlatbinMapDataset(torch.utils.data.Dataset):
+    """Random access to the samples of one or more flatbin files.
+
+    Samples are located with the sample (or block) offsets of each file, so any sampler can be used,
+    including DistributedSampler. Batches fetched through __getitems__ are read in file order and
+    neighbouring samples are read together.
+    """
+
+    def __init__(self, binpath, desired_data, img_format=None, use_mmap=False, coalesce_bytes=1 << 16,
+            uint8_images=False, sample_index=False):
+        """
+        Arguments:
+            binpath    (str or [str]): Path(s) to the flatbin files. Indices run through the files in order.
+            desired_data      ([str]): Names of the entries to return from each sample.
+            img_format          (str): Image format ("RGB" or "L") or None to keep the stored format.
+            use_mmap           (bool): Read samples from a memory mapping instead of the file.
+            coalesce_bytes      (int): Samples of a batch that are separated by at most this many
+                                       bytes are read with a single read.
+            uint8_images       (bool): Return png images as uint8, see FlatbinDataset.
+            sample_index       (bool): Add the index of each sample to the end of the sample, so
+                                       that it can be read again later.
+        """
+        if not isinstance(binpath, list):
+            binpath = [binpath]
+        self.datasets = [FlatbinDataset(path, desired_data, img_format, use_mmap, uint8_images=uint8_images)
+                         for path in binpath]
+        self.offsets = [dataset.readOffsets() for dataset in self.datasets]
+        # The index of the first sample of each file, followed by the total
+        self.file_starts = numpy.cumsum([0] + [len(dataset) for dataset in self.datasets])
+        self.coalesce_bytes = coalesce_bytes
+        self.sample_index = sample_index
+        # Open files and the last decompressed block, which belong to a single process
+        self._handles = {}
+        self._handles_pid = None
+        self._block_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        state['_handles_pid'] = None
+        state['_block_cache'] = None
+        return state
+
+    def getPatchInfo(self):
+        return self.datasets[0].patch_info if self.datasets else None
+
+    def getDataSize(self, out_index):
+        """Get the size of the data at the given index. Does not work for images."""
+        return self.datasets[0].getDataSize(out_index) if self.datasets else None
+
+    def readColumn(self, name):
+        """Return every value of a fixed-width entry from all of the files, in index order."""
+        return numpy.concatenate([dataset.readColumn(name) for dataset in self.datasets])
+
+    def __len__(self):
+        return int(self.file_starts[-1])
+
+    def _getHandle(self, file_idx):
+        """Return this process's handle to the file, opening it on first use."""
+        # Forked dataloader workers must not share file positions with the parent
+        if self._handles_pid != os.getpid():
+            self._handles = {}
+            self._block_cache = None
+            self._handles_pid = os.getpid()
+        if file_idx not in self._handles:
+            self._handles[file_idx] = open(self.datasets[file_idx].binpath, "rb")
+        return self._handles[file_idx]
+
+    def _readBytes(self, file_idx, begin, end):
+        """Return bytes [begin, end) of the file as a writable uint8 array."""
+        dataset = self.datasets[file_idx]
+        return dataset._readSpan(None if dataset.use_mmap else self._getHandle(file_idx), begin, end)
+
+    def _locate(self, index):
+        """Return the file index and the index of the sample within that file."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Sample index {index} is out of range for {len(self)} samples")
+        file_idx = int(numpy.searchsorted(self.file_starts, index, side='right')) - 1
+        return file_idx, index - int(self.file_starts[file_idx])
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        """Read the samples of a batch with a single sweep through each file.
+
+        Returns the samples in the order of indices.
+        """
+        locations = sorted((self._locate(index), position) for position, index in enumerate(indices))
+        samples = [None] * len(indices)
+        for file_idx, group in itertools.groupby(locations, key=lambda location: location[0][0]):
+            requests = [(sample_idx, position) for (_, sample_idx), position in group]
+            if 0 != self.datasets[file_idx].block_compression:
+                self._readFromBlocks(file_idx, requests, samples)
+            else:
+                self._readSpans(file_idx, requests, samples)
+        if self.sample_index:
+            samples = [tuple(sample) + (index,) for sample, index in zip(samples, indices)]
+        return samples
+
+    def _readSpans(self, file_idx, requests, samples):
+        """Read the (sample index, output position) requests, sorted by sample index, into samples."""
+        dataset = self.datasets[file_idx]
+        offsets = self.offsets[file_idx]
+        span = []
+        for request_idx, (sample_idx, position) in enumerate(requests):
+            span.append((sample_idx, position))
+            span_end = int(offsets[sample_idx + 1])
+            # Keep extending the span while the next sample is close to the end of this one
+            if (request_idx + 1 < len(requests) and
+                    int(offsets[requests[request_idx + 1][0]]) - span_end <= self.coalesce_bytes):
+                continue
+            span_begin = int(offsets[span[0][0]])
+            buf = self._readBytes(file_idx, span_begin, span_end)
+            for span_sample, span_position in span:
+                samples[span_position] = dataset._readRecord(
+                        buf, int(offsets[span_sample]) - span_begin, span_sample)[0]
+            span = []
+
+    def _readFromBlocks(self, file_idx, requests, samples):
+        """Read requests from a compressed file, decompressing each needed block once."""
+        dataset = self.datasets[file_idx]
+        for sample_idx, position in requests:
+            block_idx = sample_idx // dataset.block_samples
+            if self._block_cache is None or self._block_cache[0:2] != (file_idx, block_idx):
+                self._block_cache = (file_idx, block_idx) + self._loadBlock(file_idx, block_idx)
+            _, _, block, block_offsets = self._block_cache
+            samples[position] = dataset._readRecord(
+                    block, block_offsets[sample_idx % dataset.block_samples], sample_idx)[0]
+
+    def _loadBlock(self, file_idx, block_idx):
+        """Decompress a block. Returns the block and the offset of each of its samples."""
+        dataset = self.datasets[file_idx]
+        offsets = self.offsets[file_idx]
+        raw = self._readBytes(file_idx, int(offsets[block_idx]), int(offsets[block_idx + 1]))
+        block, _ = dataset._decompressAt(raw, 0)
+        block_count = min(dataset.block_samples, len(dataset) - block_idx * dataset.block_samples)
+        block_offsets = [0]
+        for _ in range(block_count - 1):
+            block_offsets.append(dataset._skipRecord(block, block_offsets[-1]))
+        return block, block_offsets
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Concatenate, subset, split, verify, and summarize flat .bin files without decoding them.
+
+Sample records are copied as raw bytes, so changing which samples are in a dataset costs a single
+sequential copy instead of converting the tar files again. Compressed blocks are decompressed (and
+compressed again if --compression is given) but images are never decoded.
+
+Examples:
+> python3 utility/flatbin_tool.py concat fold0.bin fold1.bin fold2.bin --output train.bin
+> python3 utility/flatbin_tool.py subset train.bin --output no_class_2.bin --exclude_classes 2
+> python3 utility/flatbin_tool.py subset train.bin --output early.bin --where "frame_int < 1000"
+> python3 utility/flatbin_tool.py split train.bin --outputs val.bin rest.bin --counts 500 --seed 1
+> python3 utility/flatbin_tool.py verify *.bin
+> python3 utility/flatbin_tool.py summarize *.bin
+"""
+
+import argparse
+import logging
+import numpy
+import os
+import sys
+
+logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from flatbin_dataset import (checkFlatbin, FlatbinDataset, FlatbinWriter, summarizeFlatbin, verifyFlatbin,
+        writeSidecar)
+
+# Metadata that the FlatbinWriter sets itself
+writer_metadata = ("block_compression", "block_samples", "flatbin_version")
+
+
+def openInputs(paths):
+    """Open the input files and check that they have the same format.
+
+    Returns:
+        [FlatbinDataset]: Datasets that read every entry of the files.
+    """
+    datasets = []
+    for path in paths:
+        names = FlatbinDataset(path, []).header_names
+        datasets.append(FlatbinDataset(path, names))
+    first = datasets[0]
+    for dataset in datasets[1:]:
+        if (dataset.header_names != first.header_names or dataset.header_sizes != first.header_sizes
+                or sorted(dataset.columns) != sorted(first.columns)):
+            raise ValueError(f"{dataset.binpath} does not have the same entries as {first.binpath}")
+        for key in ("raw_channels", "raw_height", "raw_width"):
+            if dataset.patch_info.get(key) != first.patch_info.get(key):
+                raise ValueError(f"{dataset.binpath} has a different {key} than {first.binpath}")
+    return datasets
+
+
+def copySamples(selections, output, compression=None, block_samples=64):
+    """Write the selected samples into a new file.
+
+    Arguments:
+        selections ([(FlatbinDataset, [int])]): Files and the increasing sample indices to copy
+                                                from each. None copies every sample.
+        output (str): Output path.
+        compression (str): None, 'zlib', 'lz4', or 'zstd'.
+        block_samples (int): Number of samples in each compressed block.
+    Returns:
+        int: The number of samples written.
+    """
+    first = selections[0][0]
+    entries = list(zip(first.header_names, first.header_sizes))
+    metadata = {key: value for key, value in first.patch_info.items() if key not in writer_metadata}
+    columns = {name: ('f' if column.dtype.kind == 'f' else 'i', 1 if 1 == column.ndim else column.shape[1])
+               for name, column in first.columns.items()}
+    with FlatbinWriter(output, entries, metadata, compression, block_samples, columns) as writer:
+        for dataset, indices in selections:
+            # Column values are passed to the writer as big endian bytes, like the entry writers make
+            big_endian = {name: column.astype(column.dtype.newbyteorder('>'))
+                          for name, column in dataset.columns.items()}
+            for sample_idx, record in dataset.rawRecords(indices):
+                # Slicing keeps the byte order, which indexing a single value would not
+                writer.writeRecord(record, {name: column[sample_idx:sample_idx + 1].tobytes()
+                                            for name, column in big_endian.items()})
+    writeSidecar(output, summarizeFlatbin(output))
+    logging.info(f"Wrote {writer.sample_count} samples to {output}")
+    return writer.sample_count
+
+
+def columnVariables(dataset):
+    """Return the fixed-width entries of a dataset as arrays, named so that they can be used in expressions."""
+    variables = {}
+    for name in dataset.header_names:
+        if name in dataset.columns or name.endswith((".int", ".float")) or name == "cls":
+            variables[''.join(c if c.isalnum() else '_' for c in name)] = numpy.asarray(dataset.readColumn(name))
+    return variables
+
+
+def selectIndices(dataset, indices=None, classes=None, exclude_classes=None, label="cls", where=None):
+    """Return the increasing indices of the samples that match all of the given selections.
+
+    Arguments:
+        indices  ([int]): Sample indices to keep.
+        classes  ([int]): Label values to keep.
+        exclude_classes ([int]): Label values to drop.
+        label      (str): Entry with the class label.
+        where      (str): A numpy expression over the fixed-width entries that is True for the
+                          samples to keep. Characters other than letters and numbers in entry names
+                          become underscores, e.g. "(cls != 2) & (frame_int > 100)".
+    """
+    keep = numpy.ones(len(dataset), dtype=bool)
+    if indices is not None:
+        chosen = numpy.zeros(len(dataset), dtype=bool)
+        chosen[numpy.asarray(indices, dtype=numpy.int64)] = True
+        keep &= chosen
+    if classes is not None or exclude_classes is not None:
+        labels = numpy.asarray(dataset.readColumn(label)).reshape(len(dataset), -1)[:, 0]
+        if classes is not None:
+            keep &= numpy.isin(labels, classes)
+        if exclude_classes is not None:
+            keep &= ~numpy.isin(labels, exclude_classes)
+    if where is not None:
+        keep &= numpy.asarray(eval(where, {"numpy": numpy}, columnVariables(dataset)), dtype=bool)
+    return numpy.flatnonzero(keep).tolist()
+
+
+def parseIndices(index_strs):
+    """Parse a list of indices and python style begin:end ranges."""
+    indices = []
+    for index_str in index_strs:
+        if ':' in index_str:
+            begin, end = index_str.split(':')
+            indices.extend(range(int(begin), int(end)))
+        else:
+            indices.append(int(index_str))
+    return indices
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concatenate, subset, split, verify, or summarize flat .bin files.")
+    parser.add_argument("--compression", default="none", choices=["none", "zlib", "lz4", "zstd"],
+                        help="Compression of the output files")
+    parser.add_argument("--block_samples", type=int, default=64,
+                        help="Number of samples in each compressed block of the output files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    concat = commands.add_parser("concat", help="Concatenate files with the same entries")
+    concat.add_argument("inputs", nargs="+", help="Input .bin files")
+    concat.add_argument("--output", required=True, help="Output .bin file")
+
+    subset = commands.add_parser("subset", help="Copy the selected samples of the input files")
+    subset.add_argument("inputs", nargs="+", help="Input .bin files")
+    subset.add_argument("--output", required=True, help="Output .bin file")
+    subset.add_argument("--indices", nargs="+", default=None,
+                        help="Sample indices or begin:end ranges to keep, counted through all inputs")
+    subset.add_argument("--classes", nargs="+", type=int, default=None, help="Label values to keep")
+    subset.add_argument("--exclude_classes", nargs="+", type=int, default=None, help="Label values to drop")
+    subset.add_argument("--label", default="cls", help="Entry with the class label")
+    subset.add_argument("--where", default=None,
+                        help="Numpy expression over the fixed-width entries, e.g. \"(cls != 2) & (frame_int > 100)\"")
+
+    split = commands.add_parser("split", help="Split the samples of the input files into several files")
+    split.add_argument("inputs", nargs="+", help="Input .bin files")
+    split.add_argument("--outputs", nargs="+", required=True, help="Output .bin files")
+    split.add_argument("--counts", nargs="+", type=int, required=True,
+                       help="Number of samples in each output. The last output gets the remaining "
+                            "samples if one fewer count than outputs is given.")
+    split.add_argument("--seed", type=int, default=None,
+                       help="Assign samples to the outputs at random with this seed instead of in order")
+
+    verify = commands.add_parser("verify", help="Check files for truncation and damaged samples")
+    verify.add_argument("inputs", nargs="+", help="Input .bin files")
+    verify.add_argument("--quick", action="store_true", default=False,
+                        help="Only check the header and footer of each file")
+    verify.add_argument("--processes", type=int, default=None,
+                        help="Number of processes checking blocks, defaults to the number of CPUs")
+
+    summarize = commands.add_parser("summarize",
+                                    help="Write the summary sidecar (file.bin.json) that training reads "
+                                         "instead of probing the dataset, e.g. for files written before sidecars")
+    summarize.add_argument("inputs", nargs="+", help="Input .bin files")
+
+    args = parser.parse_args()
+    compression = None if args.compression == "none" else args.compression
+
+    if args.command == "verify":
+        failures = 0
+        for path in args.inputs:
+            try:
+                if args.quick:
+                    checkFlatbin(path)
+                    bad_sample = None
+                else:
+                    bad_sample = verifyFlatbin(path, args.processes)
+            except ValueError as error:
+                logging.error(str(error))
+                failures += 1
+                continue
+            if bad_sample is not None:
+                logging.error(f"{path} is damaged, starting in the block with sample {bad_sample}")
+                failures += 1
+            else:
+                logging.info(f"{path} is good")
+        sys.exit(1 if failures else 0)
+
+    if args.command == "summarize":
+        for path in args.inputs:
+            writeSidecar(path, summarizeFlatbin(path))
+            logging.info(f"Wrote the summary of {path}")
+        sys.exit(0)
+
+    datasets = openInputs(args.inputs)
+
+    if args.command == "concat":
+        copySamples([(dataset, None) for dataset in datasets], args.output, compression, args.block_samples)
+    elif args.command == "subset":
+        # Indices count through all of the inputs
+        global_indices = None if args.indices is None else numpy.asarray(parseIndices(args.indices))
+        selections = []
+        first_index = 0
+        for dataset in datasets:
+            local = None
+            if global_indices is not None:
+                in_file = global_indices[(first_index <= global_indices) & (global_indices < first_index + len(dataset))]
+                local = (in_file - first_index).tolist()
+            selections.append((dataset, selectIndices(dataset, local, args.classes, args.exclude_classes,
+                                                      args.label, args.where)))
+            first_index += len(dataset)
+        copySamples(selections, args.output, compression, args.block_samples)
+    else:
+        total = sum(len(dataset) for dataset in datasets)
+        counts = list(args.counts)
+        if len(counts) == len(args.outputs) - 1:
+            counts.append(total - sum(counts))
+        if len(counts) != len(args.outputs) or sum(counts) > total or min(counts) < 0:
+            parser.error(f"Counts {counts} do not fit {len(args.outputs)} outputs and {total} samples")
+        order = numpy.arange(total)
+        if args.seed is not None:
+            order = numpy.random.default_rng(args.seed).permutation(total)
+        starts = numpy.cumsum([0] + [len(dataset) for dataset in datasets])
+        first = 0
+        for output, count in zip(args.outputs, counts):
+            # Samples are copied in file order, whatever order they were chosen in
+            chosen = numpy.sort(order[first:first + count])
+            first += count
+            selections = []
+            for file_idx, dataset in enumerate(datasets):
+                in_file = chosen[(starts[file_idx] <= chosen) & (chosen < starts[file_idx + 1])]
+                selections.append((dataset, (in_file - starts[file_idx]).tolist()))
+            copySamples(selections, output, compression, args.block_samples)
@@ -11,53 +11,57 @@ from models.resnext import (ResNext18, ResNext34, ResNext50)
 from models.convnext import (ConvNextExtraTiny, ConvNextTiny, ConvNextSmall, ConvNextBase)
 
 
-def createModel2(model_type, other_args):
-    """Create a model of the given type. Returns None on failure."""
+def createModel2(model_type, other_args, device="cuda"):
+    """Create a model of the given type on the device. Returns None on failure."""
     net = None
     if 'alexnet' == model_type:
-        net = AlexLikeNet(**other_args).cuda()
+        net = AlexLikeNet(**other_args).to(device)
     elif 'resnet18' == model_type:
-        net = ResNet18(**other_args).cuda()
+        net = ResNet18(**other_args).to(device)
     elif 'resnet34' == model_type:
-        net = ResNet34(**other_args).cuda()
+        net = ResNet34(**other_args).to(device)
     elif 'bennet' == model_type:
-        net = BenNet(**other_args).cuda()
+        net = BenNet(**other_args).to(device)
     elif 'compactingbennet' == model_type:
-        net = CompactingBenNet(**other_args).cuda()
+        net = CompactingBenNet(**other_args).to(device)
     elif 'dragonfly' == model_type:
-        net = DFNet(**other_args).cuda()
+        net = DFNet(**other_args).to(device)
     return net
 
 
 def createModel(model_type, in_channels, frame_height, frame_width, output_size,
-        other_args=[]):
-    """Create a model of the given type. Returns None on failure."""
+        other_args={}, device="cuda"):
+    """Create a model of the given type on the device. Returns None on failure."""
     net = None
     if 'alexnet' == model_type:
         net = AlexLikeNet(in_dimensions=(in_channels, frame_height, frame_width),
-                out_classes=output_size, **other_args).cuda()
+                out_classes=output_size, **other_args).to(device)
     elif 'resnet18' == model_type:
-        net = ResNet18(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).cuda()
+        net = ResNet18(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).to(device)
     elif 'resnet34' == model_type:
-        net = ResNet34(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).cuda()
+        net = ResNet34(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).to(device)
     elif 'bennet' == model_type:
-        net = BenNet(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).cuda()
+        net = BenNet(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).to(device)
+    elif 'compactingbennet' == model_type:
+        net = CompactingBenNet(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).to(device)
+    elif 'dragonfly' == model_type:
+        net = DFNet(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, **other_args).to(device)
     elif 'resnext50' == model_type:
-        net = ResNext50(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, expanded_linear=True).cuda()
+        net = ResNext50(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, expanded_linear=True).to(device)
     elif 'resnext34' == model_type:
         net = ResNext34(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, expanded_linear=False,
-                use_dropout=False).cuda()
+                use_dropout=False).to(device)
     elif 'resnext18' == model_type:
         net = ResNext18(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size, expanded_linear=True,
-                use_dropout=False).cuda()
+                use_dropout=False).to(device)
     elif 'convnextxt' == model_type:
-        net = ConvNextExtraTiny(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).cuda()
+        net = ConvNextExtraTiny(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).to(device)
     elif 'convnextt' == model_type:
-        net = ConvNextTiny(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).cuda()
+        net = ConvNextTiny(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).to(device)
     elif 'convnexts' == model_type:
-        net = ConvNextSmall(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).cuda()
+        net = ConvNextSmall(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).to(device)
     elif 'convnextb' == model_type:
-        net = ConvNextBase(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).cuda()
+        net = ConvNextBase(in_dimensions=(in_channels, frame_height, frame_width), out_classes=output_size).to(device)
     return net
 
 
@@ -67,15 +71,30 @@ def restoreModel(resume_from, net):
     net.load_state_dict(state_dict=checkpoint["model_dict"], strict=True)
 
 
-def restoreModelAndState(resume_from, net, optimizer):
-    """Restore model and optimizer states and RNGs"""
-    checkpoint = torch.load(resume_from)
+def restoreModelAndState(resume_from, net, optimizer, lr_scheduler=None):
+    """Restore model, optimizer, and learning rate scheduler states and RNGs.
+
+    Arguments:
+        resume_from (str or dict): Path to the checkpoint, or its already loaded contents.
+    Returns:
+        dict: The checkpoint.
+    """
+    if isinstance(resume_from, str):
+        # Checkpoints hold the numpy RNG state, which is not a plain tensor
+        checkpoint = torch.load(resume_from, map_location="cpu", weights_only=False)
+    else:
+        checkpoint = resume_from
     net.load_state_dict(checkpoint["model_dict"])
     optimizer.load_state_dict(checkpoint["optim_dict"])
+    if lr_scheduler is not None and checkpoint.get("lr_scheduler_dict") is not None:
+        lr_scheduler.load_state_dict(checkpoint["lr_scheduler_dict"])
     # Also restore the RNG states
     random.setstate(checkpoint["py_random_state"])
     numpy.random.set_state(checkpoint["np_random_state"])
     torch.set_rng_state(checkpoint["torch_rng_state"])
+    if checkpoint.get("cuda_rng_state") is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint["cuda_rng_state"])
+    return checkpoint
 
 
 def hasNormalizers(resume_from) -> bool:
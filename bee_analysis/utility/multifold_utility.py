@@ -0,0 +1,193 @@
+#! /usr/bin/python3
+"""
+Utility functions for training every cross validation fold in a single process.
+
+With k folds, model i trains on every fold but fold i and is evaluated on fold i. Training the folds
+as separate jobs reads and decodes every sample k - 1 times for training and once more for
+evaluation. Here the k models share a single pass through the union of the folds: each batch is
+decoded and moved to the device once and every model trains on the samples of the batch that are
+in its training set. The samples must carry their fold index as the last entry of the dataloader
+tuple, see the source_index option of dataset_utility.makeDataset.
+
+The models run one after the other on their part of the batch rather than being stacked with
+torch.func.vmap. The models use BatchNorm, whose running statistics cannot be updated inside of
+vmap, and running every model on the whole batch would mix the held out samples into the batch
+statistics of the models that should not see them.
+"""
+import logging
+import os
+
+import torch
+
+from utility.dataset_utility import extractVectors
+from utility.prefetch_utility import BatchPrefetcher
+from utility.profile_utility import disabled_profiler
+from utility.train_utility import (autocastContext, batchImages, prepareImages, sampleKeys, updateWithScaler,
+                                   updateWithoutScaler)
+
+
+def foldCheckpointName(outname, fold):
+    """Return the checkpoint path of a fold's model, e.g. model_fold2.checkpoint for model.checkpoint."""
+    root, ext = os.path.splitext(outname)
+    return f"{root}_fold{fold}{ext}"
+
+
+def foldMasks(folds, num_folds):
+    """Return a [num_folds, batch] mask that is True where a sample is in the training set of a fold's model.
+
+    Arguments:
+        folds (torch.tensor): The fold index of each sample in the batch.
+        num_folds      (int): Number of folds (and models).
+    """
+    return folds.view(1, -1) != torch.arange(num_folds, device=folds.device).view(-1, 1)
+
+
+def foldBatch(dl_tuple, train_frames, normalize_images, label_handler, vector_range, device, augment=None,
+              cursor=None):
+    """Move a batch with fold indices to the device, augmenting its images if augment is given.
+
+    cursor holds the samples that each dataloader worker has read so far this epoch, for the keys
+    of the augmentation (see train_utility.sampleKeys), and is advanced past the batch.
+
+    Returns:
+        (torch.tensor, torch.tensor, torch.tensor, torch.tensor): The images, labels, vector inputs
+            (None if there are none), and fold indices.
+    """
+    net_input = batchImages(dl_tuple, train_frames, device)
+    if augment is not None:
+        worker_id = getattr(dl_tuple, "worker_id", 0)
+        offset = cursor.get(worker_id, 0)
+        cursor[worker_id] = offset + net_input.size(0)
+        net_input = augment(net_input, train_frames, sampleKeys(dl_tuple, offset))
+    net_input = prepareImages(net_input, normalize_images)
+    labels = extractVectors(dl_tuple, label_handler.range()).to(device)
+    # The loss function doesn't like a (batch x 1) tensor
+    if labels.size(-1) == 1:
+        labels = labels.flatten()
+    vector_inputs = None
+    if vector_range.start != vector_range.stop:
+        vector_inputs = extractVectors(dl_tuple, vector_range).to(device)
+    folds = torch.as_tensor(dl_tuple[-1]).to(device)
+    return net_input, labels, vector_inputs, folds
+
+
+def trainFoldsEpoch(nets, optimizers, scalers, label_handler, train_stats, dataloader, vector_range,
+                    train_frames, normalize_images, loss_fn, nn_postprocess, device="cuda", amp_dtype=None,
+                    augment=None, profiler=None):
+    """Train the model of every fold for an epoch with a single pass through the dataloader.
+
+    Arguments:
+        nets      ([torch.nn.Module]): The model of each fold.
+        optimizers    ([torch.optim]): The optimizer of each model.
+        scalers ([GradScaler | None]): Mixed precision scaler of each model, or None.
+        train_stats ([ConfusionMatrix | RegressionResults]): Training statistics of each model.
+        dataloader       (DataLoader): Batches of samples whose last entry is the fold index.
+        Other arguments are the same as train_utility.trainEpoch.
+    Returns:
+        [float]: The mean training loss of each model.
+    """
+    profiler = profiler or disabled_profiler
+    profiler.begin()
+    for net in nets:
+        net.train()
+    loss_totals = torch.zeros(len(nets), device=device)
+    sample_counts = [0] * len(nets)
+    cursor = {}
+    prefetcher = BatchPrefetcher(dataloader, device)
+    for batch_num, dl_tuple in enumerate(prefetcher):
+        if (batch_num % 1000) == 1:
+            logging.info(f"Log: at batch {batch_num}")
+            logging.info(prefetcher.waitSummary())
+        with torch.no_grad(), profiler.phase("copy"):
+            net_input, labels, vector_inputs, folds = foldBatch(dl_tuple, train_frames, normalize_images,
+                                                                label_handler, vector_range, device,
+                                                                augment, cursor)
+            masks = foldMasks(folds, len(nets))
+        for fold, (net, optimizer, scaler) in enumerate(zip(nets, optimizers, scalers)):
+            indices = masks[fold].nonzero().flatten()
+            if 0 == indices.numel():
+                continue
+            fold_labels = labels.index_select(0, indices)
+            fold_vectors = None if vector_inputs is None else vector_inputs.index_select(0, indices)
+            if scaler is not None:
+                out, loss = updateWithScaler(loss_fn, net, net_input.index_select(0, indices), fold_vectors,
+                                             label_handler.preprocess(fold_labels), scaler, optimizer, profiler)
+            else:
+                out, loss = updateWithoutScaler(loss_fn, net, net_input.index_select(0, indices), fold_vectors,
+                                                label_handler.preprocess(fold_labels), optimizer, amp_dtype,
+                                                profiler)
+            with torch.no_grad(), profiler.phase("metrics"):
+                loss_totals[fold] += loss.detach().float() * indices.numel()
+                sample_counts[fold] += indices.numel()
+                train_stats[fold].update(predictions=nn_postprocess(out.detach()),
+                                         labels=label_handler.preeval(fold_labels))
+        profiler.step(labels.size(0))
+    profiler.add("data", prefetcher.wait_seconds)
+    logging.info(prefetcher.waitSummary())
+
+    mean_losses = [total / count if 0 < count else float("nan")
+                   for total, count in zip(loss_totals.tolist(), sample_counts)]
+    for fold, (mean_loss, stats) in enumerate(zip(mean_losses, train_stats)):
+        logging.info(f"Training results for fold {fold}:")
+        logging.info(f"Mean loss: {mean_loss}")
+        logging.info(stats.makeResults())
+    return mean_losses
+
+
+def evalFoldsEpoch(nets, label_handler, eval_stats, eval_dataloader, vector_range, train_frames,
+                   normalize_images, loss_fn, nn_postprocess, outnames, write_to_description=False,
+                   device="cuda", amp_dtype=None, profiler=None):
+    """Evaluate the model of every fold on its held out fold with a single pass through the dataloader.
+
+    Arguments:
+        nets      ([torch.nn.Module]): The model of each fold.
+        eval_stats ([ConfusionMatrix | RegressionResults]): Evaluation statistics of each model.
+        eval_dataloader  (DataLoader): Batches of samples whose last entry is the fold index.
+        outnames              ([str]): Name of each fold's data, for RUN_DESCRIPTION.log.
+        Other arguments are the same as train_utility.evalEpoch.
+    Returns:
+        [float]: The mean evaluation loss of each model.
+    """
+    profiler = profiler or disabled_profiler
+    profiler.begin()
+    for net in nets:
+        net.eval()
+    loss_totals = torch.zeros(len(nets), device=device)
+    sample_counts = [0] * len(nets)
+    prefetcher = BatchPrefetcher(eval_dataloader, device)
+    with torch.no_grad():
+        for dl_tuple in prefetcher:
+            with profiler.phase("copy"):
+                net_input, labels, vector_inputs, folds = foldBatch(dl_tuple, train_frames, normalize_images,
+                                                                    label_handler, vector_range, device)
+            for fold, net in enumerate(nets):
+                indices = (folds == fold).nonzero().flatten()
+                if 0 == indices.numel():
+                    continue
+                fold_labels = labels.index_select(0, indices)
+                fold_vectors = None if vector_inputs is None else vector_inputs.index_select(0, indices)
+                with profiler.phase("forward"), autocastContext(device, amp_dtype):
+                    out = net.forward(net_input.index_select(0, indices), fold_vectors)
+                    loss = loss_fn(out, label_handler.preprocess(fold_labels))
+                with profiler.phase("metrics"):
+                    loss_totals[fold] += loss.float() * indices.numel()
+                    sample_counts[fold] += indices.numel()
+                    eval_stats[fold].update(predictions=nn_postprocess(out),
+                                            labels=label_handler.preeval(fold_labels))
+            profiler.step(labels.size(0))
+        profiler.add("data", prefetcher.wait_seconds)
+
+    mean_losses = [total / count if 0 < count else float("nan")
+                   for total, count in zip(loss_totals.tolist(), sample_counts)]
+    for fold, (mean_loss, stats) in enumerate(zip(mean_losses, eval_stats)):
+        print(f"Evaluation results for fold {fold}:")
+        print(f"Mean loss: {mean_loss}")
+        print(stats.makeResults())
+    if write_to_description:
+        with open("RUN_DESCRIPTION.log", "a") as run_desc:
+            for outname, stats in zip(outnames, eval_stats):
+                run_desc.write(f"\n-- Final Results for Evaluating {outname} --\n")
+                run_desc.write(f"{stats.makeResults()}\n")
+    for net in nets:
+        net.train()
+    return mean_losses
@@ -0,0 +1,171 @@
+#! /usr/bin/python3
+"""
+Utility functions and classes for moving batches to the training device ahead of time.
+
+The dataloader workers pack the frames of each batch into a single contiguous tensor (see
+collateFrames and packFrames) that the DataLoader pins, so a batch is moved to the GPU with one
+asynchronous copy instead of one synchronous copy per frame. BatchPrefetcher issues the copy of the
+next batch on a side stream while the current batch trains and keeps track of how long training
+waits for data. On the cpu it passes batches through without copying them.
+"""
+import time
+
+import torch
+from torch.utils.data import default_collate
+
+
+class PackedBatch:
+    """A batch whose frames are stored in a single [batch, frames * channels, height, width] tensor.
+
+    Indexing works like the tuple from the dataloader: indices below the number of frames return a
+    view of that frame (without a channel dimension if the frames were decoded without one) and
+    later indices return the other entries.
+    """
+
+    def __init__(self, images, train_frames, entries, squeezed=False, worker_id=0):
+        """
+        Arguments:
+            images (torch.tensor): The frames of the batch, concatenated along the channel dimension.
+            train_frames    (int): Number of frames in each sample.
+            entries        (list): The other entries of the batch, such as labels and metadata.
+            squeezed       (bool): True if the frames came without a channel dimension.
+            worker_id       (int): The dataloader worker that read the batch, 0 without workers.
+        """
+        self.images = images
+        self.train_frames = train_frames
+        self.entries = entries
+        self.squeezed = squeezed
+        self.worker_id = worker_id
+
+    def __len__(self):
+        return self.train_frames + len(self.entries)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[idx] for idx in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key < self.train_frames:
+            channels = self.images.size(1) // self.train_frames
+            frame = self.images[:, key * channels:(key + 1) * channels]
+            return frame.squeeze(1) if self.squeezed else frame
+        return self.entries[key - self.train_frames]
+
+    def pin_memory(self):
+        """Called by the DataLoader to put the batch into page locked memory."""
+        return PackedBatch(self.images.pin_memory(), self.train_frames,
+                           [entry.pin_memory() if isinstance(entry, torch.Tensor) else entry
+                            for entry in self.entries], self.squeezed, self.worker_id)
+
+    def to(self, device, non_blocking=False):
+        """Return the batch with its tensors on the device."""
+        return PackedBatch(self.images.to(device, non_blocking=non_blocking), self.train_frames,
+                           [entry.to(device, non_blocking=non_blocking) if isinstance(entry, torch.Tensor) else entry
+                            for entry in self.entries], self.squeezed, self.worker_id)
+
+    def tensors(self):
+        """Return the tensors held by the batch."""
+        return [self.images] + [entry for entry in self.entries if isinstance(entry, torch.Tensor)]
+
+
+def packFrames(train_frames, batch):
+    """Pack the frames of a collated batch into a PackedBatch.
+
+    Use functools.partial(packFrames, train_frames) as the collate_fn of a DataLoader whose dataset
+    already returns batches, such as a webdataset batched in the workers.
+    """
+    frames = batch[:train_frames]
+    squeezed = 3 == frames[0].dim()
+    images = torch.cat([frame.unsqueeze(1) if squeezed else frame for frame in frames], dim=1)
+    # Training counts the samples read by each worker to resume part way through an epoch
+    worker_info = torch.utils.data.get_worker_info()
+    # A DataLoader with a collate_fn does not convert the numpy arrays of webdataset batches itself
+    entries = [torch.utils.data.default_convert(entry) for entry in batch[train_frames:]]
+    return PackedBatch(images, train_frames, entries, squeezed, 0 if worker_info is None else worker_info.id)
+
+
+def collateFrames(train_frames, samples):
+    """Collate samples into a PackedBatch.
+
+    Use functools.partial(collateFrames, train_frames) as the collate_fn of a DataLoader so that the
+    frames are packed in the dataloader workers.
+    """
+    return packFrames(train_frames, default_collate(samples))
+
+
+def batchTensors(batch):
+    """Return the tensors of a batch from a dataloader."""
+    if isinstance(batch, PackedBatch):
+        return batch.tensors()
+    return [entry for entry in batch if isinstance(entry, torch.Tensor)]
+
+
+def batchToDevice(batch, device, non_blocking=False):
+    """Move the tensors of a batch from a dataloader to the device."""
+    if isinstance(batch, PackedBatch):
+        return batch.to(device, non_blocking=non_blocking)
+    return [entry.to(device, non_blocking=non_blocking) if isinstance(entry, torch.Tensor) else entry
+            for entry in batch]
+
+
+class BatchPrefetcher:
+    """Iterate through a dataloader with the next batch already on its way to the device.
+
+    With a cuda device the copy of the next batch is issued on a separate stream before the current
+    batch is returned, so the copy overlaps with training on the current batch. Other devices get the
+    batches unchanged. The time spent waiting for the dataloader is added to wait_seconds.
+    """
+
+    def __init__(self, dataloader, device):
+        """
+        Arguments:
+            dataloader (DataLoader): Source of the batches. Pin its memory for asynchronous copies.
+            device   (torch.device): Training device.
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.wait_seconds = 0.0
+        self.batches = 0
+
+    def nextBatch(self, iterator):
+        """Get the next batch from the dataloader, timing how long that takes."""
+        begin = time.perf_counter()
+        batch = next(iterator, None)
+        self.wait_seconds += time.perf_counter() - begin
+        return batch
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        if "cuda" != self.device.type:
+            batch = self.nextBatch(iterator)
+            while batch is not None:
+                self.batches += 1
+                yield batch
+                batch = self.nextBatch(iterator)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batch = self.nextBatch(iterator)
+        if batch is not None:
+            with torch.cuda.stream(stream):
+                batch = batchToDevice(batch, self.device, non_blocking=True)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            # The memory of tensors made on the side stream must not be reused while the training
+            # stream still uses them
+            for tensor in batchTensors(batch):
+                tensor.record_stream(current_stream)
+            next_batch = self.nextBatch(iterator)
+            if next_batch is not None:
+                with torch.cuda.stream(stream):
+                    next_batch = batchToDevice(next_batch, self.device, non_blocking=True)
+            self.batches += 1
+            yield batch
+            batch = next_batch
+
+    def waitSummary(self):
+        """Return a description of the time spent waiting for data."""
+        per_batch = 1000.0 * self.wait_seconds / max(1, self.batches)
+        return (f"Waited {self.wait_seconds:.2f}s for data over {self.batches} batches "
+                f"({per_batch:.1f}ms per batch)")
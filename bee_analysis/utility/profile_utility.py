@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+"""
+Utility functions and classes for finding where training time goes.
+
+A StepProfiler adds up the wall time of each phase of a training or evaluation step (waiting for
+data, copying and preparing the batch, forward, backward, the optimizer step, metrics, and worst
+example bookkeeping). On a GPU the timers synchronize the device so that the time of asynchronous
+kernels is charged to the phase that launched them, which slows training a little, so profiling is
+opt in. A disabled profiler hands out one shared empty context and costs almost nothing.
+
+The profiler can also record a torch.profiler trace of a window of steps, which can be opened in
+chrome://tracing or Perfetto.
+"""
+import contextlib
+import json
+import logging
+import time
+
+import torch
+
+
+class StepProfiler:
+    """Add up the time spent in each phase of the steps of an epoch and report the throughput."""
+
+    def __init__(self, device="cpu", enabled=True, trace_path=None, trace_steps=None):
+        """
+        Arguments:
+            device   (torch.device): Device that training runs on, synchronized by the timers.
+            enabled          (bool): False to make every call do nothing.
+            trace_path        (str): File for a torch.profiler chrome trace, or None.
+            trace_steps (int, int): First step and number of steps to trace, counted over all epochs.
+        """
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.synchronize = enabled and "cuda" == self.device.type
+        self.null_phase = contextlib.nullcontext()
+        self.trace = None
+        if enabled and trace_path is not None and trace_steps is not None:
+            first, count = trace_steps
+            # One warmup step before the window, when there is one, so that the first traced step
+            # does not include the profiler start up
+            warmup = min(1, first)
+            self.trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=first - warmup, warmup=warmup, active=count, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(trace_path),
+                record_shapes=True,
+            )
+            self.trace.start()
+            logging.info(f"Tracing steps {first} to {first + count - 1} to {trace_path}")
+        self.reports = []
+        self.begin()
+
+    def begin(self):
+        """Start timing a new epoch."""
+        self.phase_seconds = {}
+        self.samples = 0
+        self.steps = 0
+        self.begin_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _timePhase(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            self.add(name, time.perf_counter() - begin)
+
+    def phase(self, name):
+        """Return a context that charges the time spent inside of it to the named phase."""
+        if not self.enabled:
+            return self.null_phase
+        return self._timePhase(name)
+
+    def add(self, name, seconds):
+        """Charge time measured elsewhere, such as the wait for the dataloader, to a phase."""
+        if self.enabled:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+
+    def step(self, samples):
+        """Finish a step of the given number of samples."""
+        if not self.enabled:
+            return
+        self.samples += samples
+        self.steps += 1
+        if self.trace is not None:
+            self.trace.step()
+
+    def report(self, mode, epoch):
+        """Return the throughput and phase times of the epoch and start timing the next one.
+
+        Arguments:
+            mode  (str): What the epoch did, such as "train" or "eval".
+            epoch (int): The epoch.
+        Returns:
+            dict: The report, also kept in reports. None if the profiler is disabled.
+        """
+        if not self.enabled:
+            return None
+        seconds = time.perf_counter() - self.begin_time
+        data_seconds = self.phase_seconds.get("data", 0.0)
+        report = {
+            "mode": mode,
+            "epoch": epoch,
+            "steps": self.steps,
+            "samples": self.samples,
+            "seconds": seconds,
+            "samples_per_second": self.samples / seconds if 0 < seconds else 0.0,
+            "data_stall_percent": 100.0 * data_seconds / seconds if 0 < seconds else 0.0,
+            # Time outside of the timed phases, such as logging and the epoch end
+            "other_seconds": max(0.0, seconds - sum(self.phase_seconds.values())),
+            "phase_seconds": dict(self.phase_seconds),
+        }
+        self.reports.append(report)
+        self.begin()
+        return report
+
+    def save(self, json_path, description_path=None):
+        """Write all of the reports to a json file and add the newest one to the run description."""
+        if not self.enabled or 0 == len(self.reports):
+            return
+        with open(json_path, "w") as json_file:
+            json.dump(self.reports, json_file, indent=2)
+        if description_path is not None:
+            with open(description_path, "a") as run_desc:
+                run_desc.write(f"\n-- Profile: {summarizeReport(self.reports[-1])} --\n")
+
+    def close(self):
+        """Stop the trace, writing it if its window was reached."""
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+
+def summarizeReport(report):
+    """Return a one line description of a StepProfiler report."""
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in
+                       sorted(report["phase_seconds"].items(), key=lambda item: -item[1]))
+    return (f"{report['mode']} epoch {report['epoch']}: {report['samples_per_second']:.1f} samples/s, "
+            f"{report['data_stall_percent']:.1f}% waiting for data, {phases}, "
+            f"other {report['other_seconds']:.2f}s")
+
+
+# Shared by the training functions when they are not given a profiler
+disabled_profiler = StepProfiler(enabled=False)
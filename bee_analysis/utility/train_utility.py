@@ -2,16 +2,33 @@
 """
 Utility functions for PyTorch training
 """
+import contextlib
 import datetime
 import logging
+import math
+import os
 
 import torch
 
 from utility.dataset_utility import extractVectors
+from utility.distributed_utility import isDistributed, isMainProcess, reduceMean, reduceStats
+from utility.prefetch_utility import BatchPrefetcher, PackedBatch
+from utility.profile_utility import disabled_profiler
 
 # Helper function to convert to images
 
 
+def imagesToFloat(images):
+    """Convert a batch of uint8 images into floats in the range 0 to 1.
+
+    Loaders of raw images return uint8 data so that the conversion happens once per batch, after the
+    smaller uint8 tensor has been moved to the training device. Float images are returned unchanged.
+    """
+    if images.is_floating_point():
+        return images
+    return images.to(dtype=torch.float32).div_(255.0)
+
+
 def normalizeImages(images, epsilon=1e-05):
     # normalize per channel, so compute over height and width. This handles images with or without a batch dimension.
     v, m = torch.var_mean(images,
@@ -20,8 +37,63 @@ def normalizeImages(images, epsilon=1e-05):
     return (images - m) / (v + epsilon)
 
 
+def prepareImages(images, normalize=False, epsilon=1e-05):
+    """Convert a batch of images to floats from 0 to 1 and optionally normalize them.
+
+    This runs on whatever device holds the images, so uint8 batches should be moved to the training
+    device first. With normalization the result matches normalizeImages(imagesToFloat(images)), but
+    the scaling of uint8 images is folded into a single in-place subtract and multiply.
+    """
+    if not normalize:
+        return imagesToFloat(images)
+    if images.is_floating_point():
+        return normalizeImages(images, epsilon)
+    images = images.to(dtype=torch.float32)
+    v, m = torch.var_mean(images, dim=(images.dim() - 2, images.dim() - 1), keepdim=True)
+    # With x = 255 * y, (y - mean(y)) / (var(y) + epsilon) = (x - mean(x)) * scale
+    scale = 1.0 / (255.0 * (v / 65025.0 + epsilon))
+    return images.sub_(m).mul_(scale)
+
+
+def batchImages(dl_tuple, train_frames, device):
+    """Move the frames of a batch to the device and stack them into a single image input.
+
+    Decoding only the luminance channel means that the channel dimension is missing, in which case
+    one is added. Batches packed by prefetch_utility.collateFrames already hold a single image
+    tensor. Images are not converted to floats, see prepareImages.
+
+    Arguments:
+        dl_tuple     (tuple): Tuple from the dataloader iterator, starting with the frames.
+        train_frames   (int): Number of frames in each sample.
+        device (torch.device): Training device.
+    Returns:
+        torch.tensor: [batch, channels * train_frames, height, width] images.
+    """
+    if isinstance(dl_tuple, PackedBatch):
+        return dl_tuple.images.to(device)
+    frames = []
+    for i in range(train_frames):
+        if 3 == dl_tuple[i].dim():
+            frames.append(dl_tuple[i].unsqueeze(1).to(device))
+        else:
+            frames.append(dl_tuple[i].to(device))
+    return frames[0] if 1 == train_frames else torch.cat(frames, dim=1)
+
+
+def autocastContext(device, amp_dtype=None):
+    """Return an autocast context for the device, or a context that does nothing if amp_dtype is None.
+
+    Arguments:
+        device (torch.device): Device that the network runs on.
+        amp_dtype (torch.dtype): Lower precision type, e.g. torch.bfloat16 on the cpu.
+    """
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=amp_dtype)
+
+
 def updateWithScaler(loss_fn, net, image_input, vector_input, labels, scaler,
-                     optimizer):
+                     optimizer, profiler=None):
     """Update with scaler used in mixed precision training.
 
     Arguments:
@@ -32,9 +104,12 @@ def updateWithScaler(loss_fn, net, image_input, vector_input, labels, scaler,
         labels         (torch.tensor): Desired network output.
         scaler (torch.cuda.amp.GradScaler): Scaler for automatic mixed precision training.
         optimizer       (torch.optim): Optimizer
+        profiler (StepProfiler): Times the forward, backward, and optimizer phases, or None.
     """
-    optimizer.zero_grad()
-    with torch.cuda.amp.autocast():
+    profiler = profiler or disabled_profiler
+    with profiler.phase("optimizer"):
+        optimizer.zero_grad()
+    with profiler.phase("forward"), torch.cuda.amp.autocast():
         if vector_input is None:
             out = net(image_input.contiguous())
         else:
@@ -42,16 +117,18 @@ def updateWithScaler(loss_fn, net, image_input, vector_input, labels, scaler,
 
         loss = loss_fn(out, labels.half())
 
-    scaler.scale(loss.half()).backward()
-    scaler.step(optimizer)
-    # Important Note: Sometimes the scaler starts off with a value that is too high. This
-    # causes the loss to be NaN and the batch loss is not actually propagated. The scaler
-    # will reduce the scaling factor, but if all of the batches are skipped then the
-    # lr_scheduler should not take a step. More importantly, the batch itself should
-    # actually be repeated, otherwise some batches will be skipped.
-    # TODO Implement batch repeat by checking scaler.get_scale() before and after the update
-    # and repeating if the scale has changed.
-    scaler.update()
+    with profiler.phase("backward"):
+        scaler.scale(loss.half()).backward()
+    with profiler.phase("optimizer"):
+        scaler.step(optimizer)
+        # Important Note: Sometimes the scaler starts off with a value that is too high. This
+        # causes the loss to be NaN and the batch loss is not actually propagated. The scaler
+        # will reduce the scaling factor, but if all of the batches are skipped then the
+        # lr_scheduler should not take a step. More importantly, the batch itself should
+        # actually be repeated, otherwise some batches will be skipped.
+        # TODO Implement batch repeat by checking scaler.get_scale() before and after the update
+        # and repeating if the scale has changed.
+        scaler.update()
 
     return out, loss
 
@@ -82,7 +159,7 @@ def updateWithoutScalerOriginal(loss_fn, net, image_input, vector_input,
 
 
 def updateWithoutScaler(loss_fn, net, image_input, vector_input, labels,
-                        optimizer):
+                        optimizer, amp_dtype=None, profiler=None):
     """Update without any scaling from mixed precision training.
 
     Arguments:
@@ -92,13 +169,19 @@ def updateWithoutScaler(loss_fn, net, image_input, vector_input, labels,
         vector_input (torch.tensor): Vector (1D) input to the network.
         labels       (torch.tensor): Desired network output.
         optimizer     (torch.optim): Optimizer
+        amp_dtype     (torch.dtype): Autocast the forward pass to this type, such as torch.bfloat16,
+                                     which does not need gradient scaling. None for float32.
+        profiler (StepProfiler): Times the forward, backward, and optimizer phases, or None.
     """
-    optimizer.zero_grad()
-    if vector_input is None:
-        out = net(image_input.contiguous())
-    else:
-        out = net(image_input.contiguous(), vector_input.contiguous())
-    loss = loss_fn(out, labels)
+    profiler = profiler or disabled_profiler
+    with profiler.phase("optimizer"):
+        optimizer.zero_grad()
+    with profiler.phase("forward"), autocastContext(image_input.device, amp_dtype):
+        if vector_input is None:
+            out = net(image_input.contiguous())
+        else:
+            out = net(image_input.contiguous(), vector_input.contiguous())
+        loss = loss_fn(out, labels)
 
     # TODO FIXME Just experimenting with covariance matrix loss thingy
     # if vector_input is None:
@@ -120,12 +203,145 @@ def updateWithoutScaler(loss_fn, net, image_input, vector_input, labels,
     # layer_norm = torch.linalg.matrix_norm(net.neck[0].weight).sum() + torch.linalg.matrix_norm(net.neck[1].weight).sum()
     # loss = loss_fn(out, labels) + 0.001 * layer_norm
 
-    loss.backward()
-    optimizer.step()
+    with profiler.phase("backward"):
+        loss.backward()
+    with profiler.phase("optimizer"):
+        optimizer.step()
 
     return out, loss
 
 
+def learningRateScale(rule, batch_size, reference_batch_size):
+    """Return the factor that adapts learning rates tuned for one batch size to another.
+
+    Arguments:
+        rule                 (str): "linear" to scale with the batch size (Goyal et al. 2017), "sqrt"
+                                    to scale with its square root (Krizhevsky 2014), or "none".
+        batch_size           (int): The batch size used for training.
+        reference_batch_size (int): The batch size that the learning rates were tuned with.
+    """
+    if "linear" == rule:
+        return batch_size / reference_batch_size
+    elif "sqrt" == rule:
+        return math.sqrt(batch_size / reference_batch_size)
+    return 1.0
+
+
+def scaleLearningRate(optimizer, lr_scheduler, factor):
+    """Multiply the learning rates of an optimizer, and the base rates of its scheduler, by factor."""
+    for group in optimizer.param_groups:
+        group["lr"] *= factor
+        if "initial_lr" in group:
+            group["initial_lr"] *= factor
+    if lr_scheduler is not None:
+        lr_scheduler.base_lrs = [lr * factor for lr in lr_scheduler.base_lrs]
+
+
+def availableMemory(device):
+    """Return the number of bytes of free memory on the device, or of available RAM on the cpu."""
+    if "cuda" == device.type:
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def probeTrainingStep(net, batch_size, in_dimensions, vector_size, device):
+    """Run a forward and backward pass with a batch of zeros, for finding the batch size."""
+    images = torch.zeros((batch_size, *in_dimensions), device=device)
+    if 0 < vector_size:
+        out = net(images, torch.zeros((batch_size, vector_size), device=device))
+    else:
+        out = net(images)
+    out.float().sum().backward()
+    net.zero_grad(set_to_none=True)
+
+
+def findBatchSize(net, in_dimensions, device, vector_size=0, max_batch_size=512, memory_fraction=0.8,
+                  memory_limit=None):
+    """Find the largest training batch that fits into the memory of the device.
+
+    On cuda devices batch sizes are tried with forward and backward passes, doubling the size until
+    one does not fit and then binary searching. On the cpu running out of memory kills the process
+    rather than raising an error, so the memory saved for the backward pass is measured with a small
+    batch and scaled up to fill the available RAM instead.
+    Only memory_fraction of the free memory is used, which leaves room for the optimizer state and the
+    data pipeline. Buffers of the network, such as batch norm statistics, are restored afterwards.
+
+    Arguments:
+        net   (torch.nn.Module): The network, already on the device.
+        in_dimensions   (tuple): Channels, height, and width of the network's image input.
+        device   (torch.device): The training device.
+        vector_size       (int): Size of the network's vector input, 0 if it has none.
+        max_batch_size    (int): The largest batch size to consider.
+        memory_fraction (float): Fraction of the free memory that a training step may use.
+        memory_limit      (int): Bytes of free memory to assume instead of asking the device.
+    Returns:
+        int: The batch size.
+    """
+    buffers = {name: buffer.clone() for name, buffer in net.named_buffers()}
+    free_memory = availableMemory(device) if memory_limit is None else memory_limit
+    try:
+        if "cuda" == device.type:
+            peak_limit = torch.cuda.memory_allocated(device) + free_memory * memory_fraction
+
+            def fits(batch_size):
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+                try:
+                    probeTrainingStep(net, batch_size, in_dimensions, vector_size, device)
+                except torch.cuda.OutOfMemoryError:
+                    net.zero_grad(set_to_none=True)
+                    return False
+                return torch.cuda.max_memory_allocated(device) <= peak_limit
+
+            # good fits, bad is either too large or one past the largest size to consider
+            good, bad = 1, max_batch_size + 1
+            if not fits(good):
+                logging.warning("A batch of one sample does not fit into the free device memory.")
+                return 1
+            while good * 2 < bad:
+                if fits(good * 2):
+                    good *= 2
+                else:
+                    bad = good * 2
+            while 1 < bad - good:
+                middle = (good + bad) // 2
+                if fits(middle):
+                    good = middle
+                else:
+                    bad = middle
+            batch_size = good
+        else:
+            sample_batch = 2
+            saved_bytes = [0]
+
+            def countSaved(tensor):
+                saved_bytes[0] += tensor.numel() * tensor.element_size()
+                return tensor
+
+            with torch.autograd.graph.saved_tensors_hooks(countSaved, lambda tensor: tensor):
+                probeTrainingStep(net, sample_batch, in_dimensions, vector_size, device)
+            # The backward pass holds the gradients of the activations as well as the saved tensors
+            sample_bytes = 2 * (saved_bytes[0] / sample_batch + 4 * math.prod(in_dimensions))
+            # Gradients and up to two optimizer states per parameter
+            param_bytes = sum(param.numel() * param.element_size() for param in net.parameters())
+            budget = free_memory * memory_fraction - 3 * param_bytes
+            batch_size = max(1, min(max_batch_size, int(budget // sample_bytes)))
+    finally:
+        net.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            for name, buffer in net.named_buffers():
+                buffer.copy_(buffers[name])
+    return batch_size
+
+
 class LabelHandler:
     """The label handler stores label processing variables and handles label pre-processing."""
 
@@ -206,6 +422,30 @@ def createPositionMask(height, width):
         return mask
 
 
+def sampleKeys(dl_tuple, offset, indices=None):
+    """Return an int64 key for each sample of a batch that identifies it within the epoch.
+
+    The keys seed per sample augmentation (see augment_utility.BatchAugmenter), so they must not
+    depend on the batch size or on how far into the epoch a resumed run started. Dataset indices
+    are used when the batch has them. Otherwise a sample is known by the process, the dataloader
+    worker that read it, and how many samples that worker read before it this epoch, which is the
+    same cursor that mid-epoch checkpoints resume from.
+
+    Arguments:
+        dl_tuple (tuple): Batch from the dataloader.
+        offset     (int): Samples read before this batch by the worker of the batch.
+        indices (tensor): Dataset indices of the samples, or None.
+    Returns:
+        torch.tensor: The int64 keys, on the cpu.
+    """
+    if indices is not None:
+        return torch.as_tensor(indices).to("cpu", torch.int64).flatten()
+    rank = torch.distributed.get_rank() if isDistributed() else 0
+    worker_id = getattr(dl_tuple, "worker_id", 0)
+    batch_size = dl_tuple[0].size(0)
+    return (rank << 48) + (worker_id << 32) + torch.arange(offset, offset + batch_size, dtype=torch.int64)
+
+
 # TODO This bit of state need not be a global variable. The caller of trainEpoch can track this.
 epoch = 0
 
@@ -227,6 +467,12 @@ def trainEpoch(
     worst_training=None,
     best_training=None,
     device="cuda",
+    amp_dtype=None,
+    sample_indices=False,
+    start_cursor=None,
+    progress_fn=None,
+    profiler=None,
+    augment=None,
 ):
     """
 
@@ -234,128 +480,146 @@ def trainEpoch(
     normalize_images (bool): True to normalize video inputs.
     save_worst_n      (int): Save the N worst images. Skipped if None.
     skip_metadata    (bool): True to skip loading metadata, slightly speeding training.
+    amp_dtype (torch.dtype): Autocast type when training without a scaler, e.g. torch.bfloat16.
+    sample_indices   (bool): True if the last entry of each batch holds the sample indices (see
+                             makeDataset), so that worst examples can be read again when saved.
+    start_cursor     (dict): Samples already read by each dataloader worker when resuming part way
+                             through the epoch, see progress_fn.
+    progress_fn  (function): Called as progress_fn(batches, cursor) after each batch, where cursor
+                             holds the number of samples that each dataloader worker has read this
+                             epoch, for mid-epoch checkpoints. Batches must come from collateFrames
+                             or packFrames so that their worker is known.
+    profiler (StepProfiler): Times the phases of each step, see profile_utility. The caller takes
+                             the report at the end of the epoch.
+    augment      (function): Called as augment(images, train_frames, keys) on the images of each
+                             batch on the device, with keys from sampleKeys, see
+                             augment_utility.BatchAugmenter.
     """
     global epoch
     epoch += 1
+    profiler = profiler or disabled_profiler
+    profiler.begin()
     net.train()
     position_mask = None
-    for batch_num, dl_tuple in enumerate(dataloader):
-        dateNow = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-        if (batch_num % 1000) == 1:
-            logging.info("Log: at batch %d at %s" % (batch_num, dateNow))
-
-        # No gradients for setup stuff
-        with torch.no_grad():
-            # Decoding only the luminance channel means that the channel dimension has gone away here.
-            if 1 == train_frames:
-                if 3 == dl_tuple[0].dim():
-                    net_input = dl_tuple[0].unsqueeze(1).to(device)
-                else:
-                    net_input = dl_tuple[0].to(device)
+    loss_total = torch.zeros((), device=device)
+    sample_count = 0
+    cursor = dict(start_cursor or {})
+    # DistributedDataParallel processes may have different numbers of batches. Joining lets the
+    # processes that finish first keep up with the gradient averaging of the others.
+    join_context = (net.join() if isinstance(net, torch.nn.parallel.DistributedDataParallel)
+                    else contextlib.nullcontext())
+    # The next batch is copied to the device while the current one trains
+    prefetcher = BatchPrefetcher(dataloader, device)
+    with join_context:
+        for batch_num, dl_tuple in enumerate(prefetcher):
+            dateNow = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+            if (batch_num % 1000) == 1:
+                logging.info("Log: at batch %d at %s" % (batch_num, dateNow))
+                logging.info(prefetcher.waitSummary())
+
+            # No gradients for setup stuff
+            with torch.no_grad(), profiler.phase("copy"):
+                net_input = batchImages(dl_tuple, train_frames, device)
+                worker_id = getattr(dl_tuple, "worker_id", 0)
+                if augment is not None:
+                    keys = sampleKeys(dl_tuple, cursor.get(worker_id, 0), dl_tuple[-1] if sample_indices else None)
+                    net_input = augment(net_input, train_frames, keys)
+                # Convert uint8 inputs to floats and normalize: input = (input - mean)/stddev
+                # Normalization is per channel, so it is computed over height and width
+                net_input = prepareImages(net_input, normalize_images)
+
+                if encode_position:
+                    if position_mask is None:
+                        position_mask = createPositionMask(
+                            net_input.size(-2), net_input.size(-1)).to(device)
+                    net_input = torch.cat(
+                        (net_input,
+                         position_mask.expand(net_input.size(0), -1, -1, -1)),
+                        dim=1,
+                    )
+
+                labels = extractVectors(dl_tuple, label_handler.range()).to(device)
+                # The loss function doesn't like a (batch x 1) tensor
+                if labels.size(-1) == 1:
+                    labels = labels.flatten()
+                vector_inputs = None
+                if vector_range.start != vector_range.stop:
+                    vector_inputs = extractVectors(dl_tuple,
+                                                   vector_range).to(device)
+
+            if scaler is not None:
+                out, loss = updateWithScaler(
+                    loss_fn,
+                    net,
+                    net_input,
+                    vector_inputs,
+                    label_handler.preprocess(labels),
+                    scaler,
+                    optimizer,
+                    profiler,
+                )
             else:
-                raw_input = []
-                for i in range(train_frames):
-                    if 3 == dl_tuple[i].dim():
-                        raw_input.append(dl_tuple[i].unsqueeze(1).to(device))
-                    else:
-                        raw_input.append(dl_tuple[i].to(device))
-                net_input = torch.cat(raw_input, dim=1)
-            # Normalize inputs: input = (input - mean)/stddev
-            if normalize_images:
-                # Normalize per channel, so compute over height and width
-                net_input = normalizeImages(net_input)
-
-            if encode_position:
-                if position_mask is None:
-                    position_mask = createPositionMask(
-                        net_input.size(-2), net_input.size(-1)).to(device)
-                net_input = torch.cat(
-                    (net_input,
-                     position_mask.expand(net_input.size(0), -1, -1, -1)),
-                    dim=1,
+                out, loss = updateWithoutScaler(
+                    loss_fn,
+                    net,
+                    net_input,
+                    vector_inputs,
+                    label_handler.preprocess(labels),
+                    optimizer,
+                    amp_dtype,
+                    profiler,
                 )
+            # Losses are summed on the device so that there is no synchronization every batch
+            loss_total += loss.detach().float() * labels.size(0)
+            sample_count += labels.size(0)
 
-            labels = extractVectors(dl_tuple, label_handler.range()).to(device)
-            # The loss function doesn't like a (batch x 1) tensor
-            if labels.size(-1) == 1:
-                labels = labels.flatten()
-            vector_inputs = None
-            if vector_range.start != vector_range.stop:
-                vector_inputs = extractVectors(dl_tuple,
-                                               vector_range).to(device)
-
-        if scaler is not None:
-            out, loss = updateWithScaler(
-                loss_fn,
-                net,
-                net_input,
-                vector_inputs,
-                label_handler.preprocess(labels),
-                scaler,
-                optimizer,
-            )
-        else:
-            out, loss = updateWithoutScaler(
-                loss_fn,
-                net,
-                net_input,
-                vector_inputs,
-                label_handler.preprocess(labels),
-                optimizer,
-            )
-
-        # Fill in the confusion matrix and worst examples.
-        with torch.no_grad():
-            # The postprocessesing could include Softmax, denormalization, etc.
-            post_out = nn_postprocess(out.detach())
-            # Labels may also require postprocessing, for example to convert to a one-hot
-            # encoding.
-            post_labels = label_handler.preeval(labels.detach())
-
-            # Update training statistics
-            train_stats.update(predictions=post_out, labels=post_labels)
-
-            if worst_training is not None or best_training is not None:
-                if skip_metadata:
-                    metadata = [
-                        ",,batch_{}-{}".format(batch_num, i)
-                        for i in range(labels.size(0))
-                    ]
-                else:
-                    # ! why is this not defined?
-                    metadata = dl_tuple[metadata_index.detach()]
-                # For each item in the batch see if it requires an update to the worst examples
-                # If the DNN should have predicted this image was a member of the labelled class
-                # then see if this image should be inserted into the worst_n queue for the
-                # labelled class based upon the DNN output for this class.
-                input_images = dl_tuple[0]
-                for i in range(post_labels.size(0)):
-                    # For both regression and classification just check the error per output
-                    # The best and worst comparisons use absolute values, so just get a difference
-                    for label_idx in range(post_labels[i].size()[0]):
-                        if worst_training is not None:
-                            worst_training.test(
-                                label_idx,
-                                post_labels[i].tolist(),
-                                post_out[i].tolist(),
-                                input_images[i],
-                                metadata[i],
-                            )
-                        if best_training is not None:
-                            best_training.test(
-                                label_idx,
-                                post_labels[i].tolist(),
-                                post_out[i].tolist(),
-                                input_images[i],
-                                metadata[i],
-                            )
+            # Fill in the confusion matrix and worst examples.
+            with torch.no_grad(), profiler.phase("metrics"):
+                # The postprocessesing could include Softmax, denormalization, etc.
+                post_out = nn_postprocess(out.detach())
+                # Labels may also require postprocessing, for example to convert to a one-hot
+                # encoding.
+                post_labels = label_handler.preeval(labels.detach())
 
+                # Update training statistics
+                train_stats.update(predictions=post_out, labels=post_labels)
+
+            with torch.no_grad(), profiler.phase("examples"):
+                if worst_training is not None or best_training is not None:
+                    if skip_metadata:
+                        metadata = [
+                            ",,batch_{}-{}".format(batch_num, i)
+                            for i in range(labels.size(0))
+                        ]
+                    else:
+                        # ! why is this not defined?
+                        metadata = dl_tuple[metadata_index.detach()]
+                    # Test the whole batch at once. If the DNN should have predicted this image was a
+                    # member of the labelled class then see if this image is among the worst
+                    # examples for the labelled class based upon the DNN output for this class.
+                    indices = dl_tuple[-1] if sample_indices else None
+                    for examples in [worst_training, best_training]:
+                        if examples is not None:
+                            examples.testBatch(post_labels, post_out, dl_tuple[0], metadata, indices)
+
+            cursor[worker_id] = cursor.get(worker_id, 0) + labels.size(0)
+            if progress_fn is not None:
+                progress_fn(batch_num + 1, cursor)
+            profiler.step(labels.size(0))
+
+    profiler.add("data", prefetcher.wait_seconds)
+    # Combine the results of all of the training processes
+    reduceStats(train_stats)
+    mean_loss = reduceMean(loss_total.item(), sample_count)
     logging.info(f"Training results:")
+    logging.info(prefetcher.waitSummary())
+    logging.info(f"Mean loss: {mean_loss}")
     logging.info(train_stats.makeResults())
     if worst_training is not None:
         worst_training.save()
     if best_training is not None:
         best_training.save()
+    return mean_loss
 
 
 def evalEpoch(
@@ -374,54 +638,58 @@ def evalEpoch(
     worst_eval=None,
     best_eval=None,
     device="cuda",
+    amp_dtype=None,
+    sample_indices=False,
+    profiler=None,
 ):
+    """
+    profiler (StepProfiler): Times the phases of each step, see profile_utility. The caller takes
+                             the report at the end of the epoch.
+    """
+    profiler = profiler or disabled_profiler
+    profiler.begin()
     net.eval()
+    # Evaluation has always been autocast to half precision on the GPU
+    if amp_dtype is None and "cuda" == torch.device(device).type:
+        amp_dtype = torch.float16
     position_mask = None
-    with torch.no_grad():
-        for batch_num, dl_tuple in enumerate(eval_dataloader):
-            # Decoding only the luminance channel means that the channel dimension has gone away here.
-            if 1 == train_frames:
-                if 3 == dl_tuple[0].dim():
-                    net_input = dl_tuple[0].unsqueeze(1).to(device)
-                else:
-                    net_input = dl_tuple[0].to(device)
-            else:
-                raw_input = []
-                for i in range(train_frames):
-                    if 3 == dl_tuple[i].dim():
-                        raw_input.append(dl_tuple[i].unsqueeze(1).to(device))
-                    else:
-                        raw_input.append(dl_tuple[i].to(device))
-                net_input = torch.cat(raw_input, dim=1)
-            # Normalize inputs: input = (input - mean)/stddev
-            if normalize_images:
-                net_input = normalizeImages(net_input)
-
-            if encode_position:
-                if position_mask is None:
-                    position_mask = createPositionMask(
-                        net_input.size(-2), net_input.size(-1)).to(device)
-                net_input = torch.cat(
-                    (net_input,
-                     position_mask.expand(net_input.size(0), -1, -1, -1)),
-                    dim=1,
-                )
-
-            with torch.amp.autocast("cuda"):
+    loss_total = torch.zeros((), device=device)
+    sample_count = 0
+    prefetcher = BatchPrefetcher(eval_dataloader, device)
+    # Inference mode skips the autograd bookkeeping that no_grad still does
+    with torch.inference_mode():
+        for batch_num, dl_tuple in enumerate(prefetcher):
+            with profiler.phase("copy"):
+                net_input = batchImages(dl_tuple, train_frames, device)
+                # Convert uint8 inputs to floats and normalize: input = (input - mean)/stddev
+                net_input = prepareImages(net_input, normalize_images)
+
+                if encode_position:
+                    if position_mask is None:
+                        position_mask = createPositionMask(
+                            net_input.size(-2), net_input.size(-1)).to(device)
+                    net_input = torch.cat(
+                        (net_input,
+                         position_mask.expand(net_input.size(0), -1, -1, -1)),
+                        dim=1,
+                    )
                 vector_input = None
                 if vector_range.start != vector_range.stop:
                     vector_input = extractVectors(dl_tuple,
                                                   vector_range).to(device)
-                out = net.forward(net_input, vector_input)
                 labels = extractVectors(dl_tuple,
                                         label_handler.range()).to(device)
                 # The loss function doesn't like a (batch x 1) tensor
                 if labels.size(-1) == 1:
                     labels = labels.flatten()
 
+            with profiler.phase("forward"), autocastContext(device, amp_dtype):
+                out = net.forward(net_input, vector_input)
                 loss = loss_fn(out, label_handler.preprocess(labels))
+            loss_total += loss.float() * labels.size(0)
+            sample_count += labels.size(0)
             # Fill in the loss statistics
-            with torch.no_grad():
+            with torch.no_grad(), profiler.phase("metrics"):
                 # The postprocessesing could include Softmax, denormalization, etc.
                 post_out = nn_postprocess(out)
                 # Labels may also require postprocessing, for example to convert to a one-hot
@@ -430,47 +698,37 @@ def evalEpoch(
 
                 # Update training statistics
                 eval_stats.update(predictions=post_out, labels=post_labels)
-                # Worst and best examples
+            # Worst and best examples
+            with torch.no_grad(), profiler.phase("examples"):
                 if worst_eval is not None or best_eval is not None:
                     metadata = [
                         ",,batch_{}-{}".format(batch_num, i)
                         for i in range(labels.size(0))
                     ]
-                    # For each item in the batch see if it requires an update to the worst examples
-                    # If the DNN should have predicted this image was a member of the labelled class
-                    # then see if this image should be inserted into the worst_n queue for the
-                    # labelled class based upon the DNN output for this class.
-                    input_images = dl_tuple[0]
-                    for i in range(post_labels.size(0)):
-                        # For both regression and classification just check the error per output
-                        # The best and worst comparisons use absolute values, so just get a difference
-                        for label_idx in range(post_labels[i].size()[0]):
-                            if worst_eval is not None:
-                                worst_eval.test(
-                                    label_idx,
-                                    post_labels[i].tolist(),
-                                    post_out[i].tolist(),
-                                    input_images[i],
-                                    metadata[i],
-                                )
-                            if best_eval is not None:
-                                best_eval.test(
-                                    label_idx,
-                                    post_labels[i].tolist(),
-                                    post_out[i].tolist(),
-                                    input_images[i],
-                                    metadata[i],
-                                )
+                    # Test the whole batch at once
+                    indices = dl_tuple[-1] if sample_indices else None
+                    for examples in [worst_eval, best_eval]:
+                        if examples is not None:
+                            examples.testBatch(post_labels, post_out, dl_tuple[0], metadata, indices)
+            profiler.step(labels.size(0))
+        profiler.add("data", prefetcher.wait_seconds)
+        # Combine the results of all of the training processes
+        reduceStats(eval_stats)
+        mean_loss = reduceMean(loss_total.item(), sample_count)
         # Print evaluation information
-        print(f"Evaluation results:")
-        print(eval_stats.makeResults())
+        logging.info(prefetcher.waitSummary())
+        if isMainProcess():
+            print(f"Evaluation results:")
+            print(f"Mean loss: {mean_loss}")
+            print(eval_stats.makeResults())
         if worst_eval is not None:
             worst_eval.save()
         if best_eval is not None:
             best_eval.save()
-        if write_to_description:
+        if write_to_description and isMainProcess():
             with open("RUN_DESCRIPTION.log", "a") as run_desc:
                 run_desc.write(f"\n-- Final Results for Evaluating {outname} --\n")
                 run_desc.write(f"{eval_stats.makeResults()}\n")
 
     net.train()
+    return mean_loss
@@ -58,7 +58,8 @@ def getImageInfo(tar_list):
         for name, val, dt in zip(image_info, example, datatypes)
     }
 
-def convertWebdataset(dataset, entries, output, shuffle, shardshuffle, overrides):
+def convertWebdataset(dataset, entries, output, shuffle, shardshuffle, overrides, raw_images=False,
+        compression=None, block_samples=64, layout_version=1):
     patch_info = {}
     loader = (
         wds.WebDataset(dataset)
@@ -73,7 +74,13 @@ def convertWebdataset(dataset, entries, output, shuffle, shardshuffle, overrides
            .map(strip_prefix)
            .to_tuple(*entries)
     )
-    dataloaderToFlatbin(loader, entries, output, patch_info, overrides)
+    # Raw images are read from the png entries of the tar but stored as uncompressed uint8 frames
+    if raw_images:
+        out_entries = [entry[:-len(".png")] + ".raw" if entry.endswith(".png") else entry for entry in entries]
+    else:
+        out_entries = entries
+    dataloaderToFlatbin(loader, out_entries, output, patch_info, overrides, compression=compression,
+            block_samples=block_samples, layout_version=layout_version)
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser(
@@ -91,6 +98,16 @@ if __name__ == "__main__":
                    help="WebDataset shard-shuffle buffer (parsed but not applied)")
     p.add_argument("--handler_overrides", nargs="*", default=[],
                    help="Pairs of ext type to override default handlers, e.g. cls stoi")
+    p.add_argument("--raw_images", action="store_true", default=False,
+                   help="Store png entries as raw uint8 frames (N.png becomes N.raw) so that "
+                        "training does not decode pngs")
+    p.add_argument("--compression", default="none", choices=["none", "zlib", "lz4", "zstd"],
+                   help="Compress blocks of samples (lz4 and zstd require the lz4 and zstandard packages)")
+    p.add_argument("--block_samples", type=int, default=64,
+                   help="Number of samples in each compressed block")
+    p.add_argument("--layout_version", type=int, default=1, choices=[1, 2],
+                   help="2 stores labels and other fixed-width entries as columns at the end of "
+                        "the file so they can be read without reading the images")
 
     args = p.parse_args()
 
@@ -115,6 +132,10 @@ if __name__ == "__main__":
         args.output,
         args.shuffle,
         args.shardshuffle,
-        overrides
+        overrides,
+        raw_images=args.raw_images,
+        compression=None if args.compression == "none" else args.compression,
+        block_samples=args.block_samples,
+        layout_version=args.layout_version,
     )
     logging.info("Binary conversion complete.")
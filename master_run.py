@@ -49,7 +49,7 @@ Arguments:
                                   (training) Convert and train with binary files.
     --use-dataloader-workers     (training) Use dataloader workers.
     --max-dataloader-workers MAX_DATALOADER_WORKERS
-                                  (training) Number of dataloader workers, default 3.
+                                  (training) Number of dataloader workers, default 3, or auto.
     --loss-fn LOSS_FN            (training) Loss function, default "CrossEntropyLoss".
     --gradcam-cnn-model-layer GRADCAM_CNN_MODEL_LAYER [GRADCAM_CNN_MODEL_LAYER ...]
                                   (training) Model layers for gradcam plots, default ['model_a.4.0', 'model_b.4.0'].